@@ -0,0 +1,53 @@
+# Measures how quickly dux_pending_rows drains after a bulk insert.
+#
+# Usage: python benchmarks/pending_rows.py [rows]
+import sqlite3
+import sys
+import tempfile
+import time
+import os
+
+from datasette_ui_extras.dux_command import dux_the_file, prepare_connection
+from datasette_ui_extras.column_stats import index_pending_rows
+
+def make_db(path, rows):
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute('CREATE TABLE data(id integer primary key, title text, tags text, age integer, ratio real)')
+    conn.close()
+
+    # Install the triggers on the empty table, so the inserts below are queued.
+    dux_the_file(path)
+
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            'INSERT INTO data(title, tags, age, ratio) VALUES (?, ?, ?, ?)',
+            (('title {}'.format(i % 1000), '["tag{}", "other"]'.format(i % 50), i, i / 7) for i in range(rows))
+        )
+    conn.close()
+
+def drain(path, batch_size):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    prepare_connection(conn, 'not-internal', None)
+
+    t = time.time()
+    while index_pending_rows(conn, batch_size=batch_size):
+        pass
+    elapsed = time.time() - t
+    conn.close()
+    return elapsed
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for batch_size in [1, 100, 1000]:
+            path = os.path.join(tmp, 'bench-{}.db'.format(batch_size))
+            make_db(path, rows)
+            elapsed = drain(path, batch_size)
+            print('batch_size={:>5}: {:>8} rows in {:.2f}s, {:.0f} rows/s'.format(batch_size, rows, elapsed, rows / elapsed))
+
+if __name__ == '__main__':
+    main()
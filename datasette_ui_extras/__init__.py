@@ -21,8 +21,9 @@ from .utils import is_row_page
 from .yolo_command import yolo_command
 from .dux_command import dux_command, prepare_connection
 from .undux_command import undux_command
-from .column_stats_schema import DUX_IDS, DUX_PENDING_ROWS, DUX_COLUMN_STATS, DUX_COLUMN_STATS_OPS, DUX_COLUMN_STATS_VALUES
-from .column_stats import prepare_dux_column_stats, autosuggest_column, start_dux_column_stats_indexer
+from .column_stats_schema import DUX_IDS, DUX_PENDING_ROWS, DUX_COLUMN_STATS, DUX_COLUMN_STATS_OPS, DUX_COLUMN_STATS_VALUES, DUX_COLUMN_STATS_PREFIXES, DUX_COLUMN_STATS_TRIGRAMS, DUX_TABLE_OPS, DUX_META
+from .column_stats import prepare_dux_column_stats, start_dux_column_stats_indexer
+from .autosuggest_cache import get_autosuggest_cache, cached_autosuggest_column
 
 PLUGIN = 'datasette-ui-extras'
 
@@ -215,6 +216,8 @@ def startup(datasette):
     enable_yolo_view_row_pages()
     enable_yolo_edit_row_pages()
 
+    get_autosuggest_cache(datasette)
+
     async def inner():
         await prepare_dux_column_stats(datasette)
 
@@ -287,9 +290,15 @@ async def handle_autosuggest_column(datasette, request):
 
     db = datasette.get_database(dbname)
 
-    def fn(conn):
-        return autosuggest_column(conn, tablename, column, q)
-    suggestions = await db.execute_fn(fn)
+    # If the column is in the cache, we don't need a read connection. The cache
+    # only holds its lock for in-memory work, so this is fine on the event loop.
+    cache = get_autosuggest_cache(datasette)
+    suggestions = cache.suggest(db.name, tablename, column, q) if cache else None
+
+    if suggestions is None:
+        def fn(conn):
+            return cached_autosuggest_column(cache, db.name, conn, tablename, column, q)
+        suggestions = await db.execute_fn(fn)
     return Response.json(
         suggestions
     )
@@ -331,7 +340,11 @@ def get_metadata(datasette, key, database, table):
                 DUX_PENDING_ROWS: { 'hidden': True },
                 DUX_COLUMN_STATS: { 'hidden': True },
                 DUX_COLUMN_STATS_OPS: { 'hidden': True },
+                DUX_TABLE_OPS: { 'hidden': True },
                 DUX_COLUMN_STATS_VALUES: { 'hidden': True },
+                DUX_COLUMN_STATS_PREFIXES: { 'hidden': True },
+                DUX_COLUMN_STATS_TRIGRAMS: { 'hidden': True },
+                DUX_META: { 'hidden': True },
             }
         }
 
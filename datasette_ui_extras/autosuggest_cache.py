@@ -0,0 +1,346 @@
+import bisect
+import json
+import sys
+import threading
+from collections import OrderedDict
+from .column_stats import autosuggest_column, autosuggest_query_key, lookup_autosuggest_column, fold_key, indexed_length, get_prefixes, compute_prefix_tops, is_prefix_top_complete, update_prefix_top, AUTOSUGGEST_WINDOW, AUTOSUGGEST_LIMIT, PREFIX_LENGTH, PREFIX_TOP_SIZE, TRIGRAM_LENGTH
+
+# An optional in-memory copy of dux_column_stats_values, for the columns that
+# autosuggest is asked about, so that suggestions don't need a trip to SQLite.
+# See the autosuggest-cache-mb plugin setting.
+#
+# Each column is loaded lazily, the first time it's asked about. The indexer
+# refreshes the entries it changes, see refresh_values. Other processes may also
+# write to the stats tables, so when the indexer notices that they have, it
+# drops everything we have for the database, see check_stats_generation.
+#
+# The cache is used from the event loop, read connections and the write
+# connection, so everything that touches its state holds its lock.
+
+# Columns where the indexer changes more entries than this in one batch are
+# dropped and reloaded when next needed, rather than refreshed entry by entry.
+MAX_REFRESH_KEYS = 100
+
+# A rough estimate of the memory used by an entry, beyond its strings.
+ENTRY_OVERHEAD_BYTES = 150
+
+# A rough estimate of the memory used by the most common entries of a prefix.
+PREFIX_TOP_BYTES = ENTRY_OVERHEAD_BYTES * PREFIX_TOP_SIZE
+
+def entry_size(entry):
+    value, hash, count, pks, display = entry
+    return ENTRY_OVERHEAD_BYTES + sys.getsizeof(value) + sys.getsizeof(pks) + (sys.getsizeof(display) if display is not None else 0)
+
+def get_prefix_tops(entries):
+    # Like rebuild_prefix_tops, for entries in index order: returns prefix -> (top, floor),
+    # where top is the most common entries that start with prefix, as [value, hash, count].
+    tops = {}
+    for length in range(1, PREFIX_LENGTH + 1):
+        for prefix, top, floor in compute_prefix_tops(entries, length):
+            tops[prefix] = (top, floor)
+
+    return tops
+
+class AutosuggestCache:
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.lock = threading.Lock()
+
+        # (db_name, table, column) -> {'ids', 'key_length', 'trigrams', 'keys', 'entries', 'tops', 'size'}, least recently used first.
+        # keys are the (value, hash) of each entry, in index order. tops are the
+        # most common entries for each short prefix, see get_prefix_tops.
+        self.columns = OrderedDict()
+
+        # (db_name, table_id, column_id) -> (db_name, table, column)
+        self.columns_by_id = {}
+
+        # Columns that don't fit in the budget, so we don't keep trying to load them.
+        self.too_big = set()
+
+        # Bumped whenever a database's entries change, so that a load that raced
+        # with a change is discarded rather than installed.
+        self.generations = {}
+
+        # db_name -> the last stats generation we know of, see bump_stats_generation
+        self.stats_generations = {}
+
+        self.size = 0
+
+    def suggest(self, db_name, table, column, q):
+        # Returns the same thing as autosuggest_column, or None if we can't answer
+        # without asking SQLite.
+        if not q:
+            return []
+
+        with self.lock:
+            cached = self.columns.get((db_name, table, column), None)
+            if cached is None:
+                return None
+
+            self.columns.move_to_end((db_name, table, column))
+
+            # Like autosuggest_column, take the most common entries for short prefixes.
+            # Otherwise, consider the first few entries that match the prefix, then
+            # take the most common of those.
+            key = autosuggest_query_key(q, cached['key_length'])
+            length = indexed_length(cached['key_length'])
+
+            # Infix search is better served by dux_column_stats_trigrams than by
+            # scanning every entry.
+            if cached['trigrams'] and len(key) >= TRIGRAM_LENGTH:
+                return None
+
+            if len(key) <= PREFIX_LENGTH and len(key) <= length:
+                top, floor = cached['tops'].get(key, ([], 0))
+                hits = [cached['entries'][bisect.bisect_left(cached['keys'], (value, hash))] for value, hash, count in top[0:AUTOSUGGEST_LIMIT]]
+            else:
+                start = bisect.bisect_left(cached['keys'], (key[0:length],))
+                # Like autosuggest_window, check keys longer than the indexed part
+                # of the values against the display values.
+                window = []
+                i = start
+                while i < len(cached['keys']) and len(window) < AUTOSUGGEST_WINDOW and cached['keys'][i][0].startswith(key[0:length]):
+                    entry = cached['entries'][i]
+                    i += 1
+
+                    if len(key) > length and (entry[4] is None or not fold_key(entry[4], cached['key_length']).startswith(key)):
+                        continue
+
+                    window.append(entry)
+
+                hits = sorted(window, key=lambda entry: -entry[2])[0:AUTOSUGGEST_LIMIT]
+
+        rows = []
+        for value, hash, count, pks, display in hits:
+            pks = json.loads(pks)
+            if not pks:
+                continue
+
+            # Entries from before we stored display values need a lookup in the table.
+            if display is None:
+                return None
+
+            rows.append({
+                'value': display,
+                'count': count,
+                'pks': pks
+            })
+
+        return rows
+
+    def load(self, db_name, conn, table, column):
+        # Load a column's entries, on a read connection.
+        with self.lock:
+            if (db_name, table, column) in self.columns or (db_name, table, column) in self.too_big:
+                return
+
+            generation = self.generations.get(db_name, 0)
+
+        column_info = lookup_autosuggest_column(conn, table, column)
+        if column_info is None:
+            return
+
+        table_id, column_id, key_length, trigrams = column_info
+        ids = (table_id, column_id)
+
+        keys = []
+        entries = []
+        size = 0
+        too_big = False
+        for entry in conn.execute('SELECT value, hash, count, pks, display FROM dux_column_stats_values WHERE table_id = ? AND column_id = ? ORDER BY value, hash', ids):
+            entry = tuple(entry)
+            keys.append((entry[0], entry[1]))
+            entries.append(entry)
+            size += entry_size(entry)
+
+            if size > self.budget_bytes:
+                too_big = True
+                break
+
+        tops = {}
+        if not too_big:
+            tops = get_prefix_tops(entries)
+            size += len(tops) * PREFIX_TOP_BYTES
+            too_big = size > self.budget_bytes
+
+        with self.lock:
+            if generation != self.generations.get(db_name, 0):
+                return
+
+            if too_big:
+                self.too_big.add((db_name, table, column))
+                return
+
+            self.columns[(db_name, table, column)] = {'ids': ids, 'key_length': key_length, 'trigrams': trigrams, 'keys': keys, 'entries': entries, 'tops': tops, 'size': size}
+            self.columns_by_id[(db_name, ids[0], ids[1])] = (db_name, table, column)
+            self.size += size
+
+            while self.size > self.budget_bytes:
+                self.drop(next(iter(self.columns)))
+
+    def refresh_values(self, db_name, conn, keys):
+        # Called by the indexer, on the write connection, once it has committed
+        # changes to these entries of dux_column_stats_values. keys are
+        # (table_id, column_id, value, hash), as in add_value_index_deltas.
+        #
+        # Like load, we read the entries without holding the lock, and discard
+        # what we read if something else changed the database in the meantime.
+        with self.lock:
+            self.generations[db_name] = self.generations.get(db_name, 0) + 1
+            generation = self.generations[db_name]
+
+            keys_by_column = {}
+            for table_id, column_id, value, hash in keys:
+                column_key = self.columns_by_id.get((db_name, table_id, column_id), None)
+                if column_key is not None:
+                    keys_by_column.setdefault(column_key, []).append((value, hash))
+
+            for column_key, column_keys in list(keys_by_column.items()):
+                if len(column_keys) > MAX_REFRESH_KEYS:
+                    self.drop(column_key)
+                    del keys_by_column[column_key]
+
+            ids_by_column = dict([(column_key, self.columns[column_key]['ids']) for column_key in keys_by_column])
+
+        entries_by_column = {}
+        for column_key, column_keys in keys_by_column.items():
+            entries = []
+            for value, hash in column_keys:
+                entry = conn.execute('SELECT value, hash, count, pks, display FROM dux_column_stats_values WHERE table_id = ? AND column_id = ? AND value = ? AND hash = ?', [*ids_by_column[column_key], value, hash]).fetchone()
+                entries.append(((value, hash), tuple(entry) if entry else None))
+            entries_by_column[column_key] = entries
+
+        with self.lock:
+            for column_key, entries in entries_by_column.items():
+                cached = self.columns.get(column_key, None)
+                if cached is None or cached['ids'] != ids_by_column[column_key]:
+                    continue
+
+                if generation != self.generations.get(db_name, 0):
+                    self.drop(column_key)
+                    continue
+
+                for key, entry in entries:
+                    self.replace_entry(cached, key, entry)
+
+                if not self.update_prefix_tops(cached, entries):
+                    self.drop(column_key)
+
+            while self.size > self.budget_bytes:
+                self.drop(next(iter(self.columns)))
+
+    def update_prefix_tops(self, cached, entries):
+        # Like update_prefix_tops in column_stats. Returns False if we've lost track
+        # of a prefix's most common entries, in which case the column should be
+        # dropped and reloaded, rather than rescanned while holding the lock.
+        counts_by_prefix = {}
+        for (value, hash), entry in entries:
+            for prefix in get_prefixes(value):
+                counts_by_prefix.setdefault(prefix, {})[(value, hash)] = entry[2] if entry else 0
+
+        for prefix, counts in counts_by_prefix.items():
+            top, floor = update_prefix_top(*cached['tops'].get(prefix, ([], 0)), counts)
+            if not is_prefix_top_complete(top, floor):
+                return False
+
+            size = 0
+            if prefix in cached['tops']:
+                size -= PREFIX_TOP_BYTES
+
+            if top:
+                cached['tops'][prefix] = (top, floor)
+                size += PREFIX_TOP_BYTES
+            else:
+                cached['tops'].pop(prefix, None)
+
+            cached['size'] += size
+            self.size += size
+
+        return True
+
+    def replace_entry(self, cached, key, entry):
+        i = bisect.bisect_left(cached['keys'], key)
+        found = i < len(cached['keys']) and cached['keys'][i] == key
+
+        if found:
+            size = entry_size(cached['entries'][i])
+            cached['size'] -= size
+            self.size -= size
+
+        if entry is None:
+            if found:
+                del cached['keys'][i]
+                del cached['entries'][i]
+            return
+
+        if found:
+            cached['entries'][i] = entry
+        else:
+            cached['keys'].insert(i, key)
+            cached['entries'].insert(i, entry)
+
+        size = entry_size(entry)
+        cached['size'] += size
+        self.size += size
+
+    def drop(self, column_key):
+        cached = self.columns.pop(column_key)
+        self.size -= cached['size']
+        del self.columns_by_id[(column_key[0], *cached['ids'])]
+
+    def invalidate(self, db_name):
+        # Forget everything about a database, eg because its stats were reset.
+        with self.lock:
+            self.generations[db_name] = self.generations.get(db_name, 0) + 1
+
+            for column_key in [column_key for column_key in self.columns if column_key[0] == db_name]:
+                self.drop(column_key)
+
+            self.too_big = set([column_key for column_key in self.too_big if column_key[0] != db_name])
+
+    def note_stats_generation(self, db_name, previous, generation):
+        # Called once this process has bumped the stats generation from previous,
+        # see bump_stats_generation. If that's ahead of what we knew of, another
+        # process changed the stats in the meantime.
+        self.check_stats_generation(db_name, previous)
+        with self.lock:
+            self.stats_generations[db_name] = max(generation, self.stats_generations.get(db_name, 0))
+
+    def check_stats_generation(self, db_name, generation):
+        # Called by the indexer with the stats generation it has read from the database.
+        # Generations only go up, and this process records its own bumps, so one
+        # that's ahead of what we know of means another process has written to
+        # the stats tables behind our back.
+        with self.lock:
+            known = self.stats_generations.get(db_name, None)
+            if known is None or generation > known:
+                self.stats_generations[db_name] = generation
+
+        if known is not None and generation > known:
+            self.invalidate(db_name)
+
+def get_autosuggest_cache(datasette):
+    # The cache is off unless the autosuggest-cache-mb plugin setting is given.
+    if not hasattr(datasette, '_dux_autosuggest_cache'):
+        config = datasette.plugin_config('datasette-ui-extras') or {}
+        budget_mb = config.get('autosuggest-cache-mb', None)
+        datasette._dux_autosuggest_cache = AutosuggestCache(budget_mb * 1024 * 1024) if budget_mb else None
+
+    return datasette._dux_autosuggest_cache
+
+def cached_autosuggest_column(cache, db_name, conn, table, column, q):
+    # Like autosuggest_column, but answer from the cache if we can, loading the
+    # column into it if need be. conn is a read connection.
+    if cache is None:
+        return autosuggest_column(conn, table, column, q)
+
+    rv = cache.suggest(db_name, table, column, q)
+    if rv is not None:
+        return rv
+
+    cache.load(db_name, conn, table, column)
+    rv = cache.suggest(db_name, table, column, q)
+    if rv is not None:
+        return rv
+
+    return autosuggest_column(conn, table, column, q)
@@ -1,8 +1,14 @@
 import sqlite3
 import time
 import json
+import hashlib
+import pathlib
 import asyncio
-from .column_stats_schema import ensure_schema_and_triggers, DUX_COLUMN_STATS, DUX_COLUMN_STATS_VALUES, indexable_tables, indexable_columns
+import random
+import unicodedata
+import heapq
+import itertools
+from .column_stats_schema import ensure_schema_and_triggers, is_schema_reconciled, record_schema_fingerprint, get_stats_generation, bump_stats_generation, sidecar_path, DUX_SIDECAR_SCHEMA, DUX_COLUMN_STATS, DUX_COLUMN_STATS_VALUES, indexable_tables, indexable_columns, get_table_sample, get_column_policy, get_column_trigrams, DEFAULT_MAX_LENGTH, DEFAULT_KEY_LENGTH, PENDING_ROWS_FORMAT
 import traceback
 import sys
 
@@ -10,6 +16,7 @@ async def prepare_dux_column_stats(ds):
     t = time.time()
 
     dbs_to_watch = []
+    reconciled_dbs = set()
     for db_name, db in ds.databases.items():
         if db.is_memory or not db.is_mutable:
             continue
@@ -17,10 +24,27 @@ async def prepare_dux_column_stats(ds):
         if hasattr(db, 'engine') and db.engine == 'duckdb':
             continue
 
-        await db.execute_write_fn(ensure_schema_and_triggers)
         dbs_to_watch.append(db_name)
+        policy = get_indexing_policy(ds, db_name)
+
+        # If nothing has changed since we last reconciled this database, there's nothing to do.
+        def ensure(conn):
+            if is_schema_reconciled(conn, policy):
+                return True
+
+            ensure_schema_and_triggers(conn, policy)
+            return False
+
+        if await db.execute_write_fn(ensure):
+            reconciled_dbs.add(db_name)
 
     ds._dux_dbs_to_index = dbs_to_watch
+    ds._dux_reconciled_dbs = reconciled_dbs
+
+def get_indexing_policy(ds, db_name):
+    # See get_column_policy for what the indexing setting looks like.
+    config = ds.plugin_config('datasette-ui-extras', database=db_name) or {}
+    return config.get('indexing', None)
 
 def start_dux_column_stats_indexer(datasette):
     if not datasette._dux_dbs_to_index:
@@ -54,35 +78,55 @@ def ensure_ids(conn, ids, needles):
     for name in missing:
         ids[name] = ensure_id(conn, name)
 
-def ensure_empty_rows_for_db(conn):
+def ensure_empty_rows_for_db(conn, policy=None):
     with conn:
         known_tables = {}
-        tables = indexable_tables(conn)
+        tables = indexable_tables(conn, policy)
 
         ids = {}
         all_ids = list(conn.execute('SELECT id, name FROM dux_ids'))
         for row in all_ids:
             ids[row['name']] = row['id']
 
-        known_ops_raw = list(conn.execute('SELECT table_id, column_id FROM dux_column_stats_ops'))
+        known_ops_raw = list(conn.execute('SELECT table_id, column_id, stats, value_index, max_length, trigrams, key_length FROM dux_column_stats_ops'))
         known_ops = {}
-        for table_id, column_id in known_ops_raw:
-            known_ops[(table_id, column_id)] = True
+        known_trigrams = {}
+        known_key_lengths = {}
+        for table_id, column_id, stats, value_index, max_length, trigrams, key_length in known_ops_raw:
+            known_ops[(table_id, column_id)] = (bool(stats), bool(value_index), max_length)
+            known_trigrams[(table_id, column_id)] = bool(trigrams)
+            known_key_lengths[(table_id, column_id)] = key_length
 
         known_stats_raw = list(conn.execute('SELECT table_id, column_id FROM dux_column_stats'))
         known_stats = {}
         for table_id, column_id in known_stats_raw:
             known_stats[(table_id, column_id)] = True
 
+        known_samples = {}
+        for table_id, sample in conn.execute('SELECT table_id, sample FROM dux_table_ops'):
+            known_samples[table_id] = sample
+
         ensure_ids(conn, ids, tables)
 
+        expected_ops = {}
         for table in tables:
             table_id = ids[table]
-            columns = indexable_columns(conn, table)
+            columns = indexable_columns(conn, table, policy)
             ensure_ids(conn, ids, columns)
             column_ids = []
             known_tables[table_id] = column_ids
 
+            # Sampled tables are never backfilled. If a table starts or stops being
+            # sampled, start over.
+            sample = get_table_sample(conn, policy, table)
+            pending = 0 if sample is not None else 1
+            if sample != known_samples.get(table_id, None):
+                conn.execute('INSERT INTO dux_table_ops(table_id, sample) VALUES (?, ?) ON CONFLICT(table_id) DO UPDATE SET sample = excluded.sample', [table_id, sample])
+
+                for column in columns:
+                    known_ops.pop((table_id, ids[column]), None)
+                    reset_column_stats(conn, table_id, ids[column], pending)
+
             column_infos = list(conn.execute('select name, type, "notnull", pk from pragma_table_info(?)', [table]))
             column_info_by_name = {}
             for column_info in column_infos:
@@ -98,148 +142,721 @@ def ensure_empty_rows_for_db(conn):
 
                 column, type, notnull, pk = column_info
                 nullable = notnull == 0
-
-                if not (table_id, column_id) in known_ops:
-                    conn.execute(
-                        'INSERT INTO dux_column_stats_ops(table_id, column_id, pending) SELECT ?, ?, 1 WHERE NOT EXISTS(SELECT * FROM dux_column_stats_ops WHERE table_id = ? AND column_id = ?)',
-                       [table_id, column_id, table_id, column_id]
-                    )
-
-                if not (table_id, column_id) in known_stats:
+                keep_stats, keep_values, max_length, key_length = get_column_policy(policy, table, column)
+                keep_trigrams = get_column_trigrams(policy, table, column)
+                expected_ops[(table_id, column_id)] = True
+
+                # If the policy for a column changes, start over.
+                existing = known_ops.get((table_id, column_id), None)
+                if existing is not None and existing != (keep_stats, keep_values, max_length):
+                    reset_column_stats(conn, table_id, column_id, pending)
+
+                conn.execute(
+                    'INSERT INTO dux_column_stats_ops(table_id, column_id, pending, stats, value_index, max_length, trigrams, key_length) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(table_id, column_id) DO UPDATE SET stats = excluded.stats, value_index = excluded.value_index, max_length = excluded.max_length, trigrams = excluded.trigrams',
+                    [table_id, column_id, pending, keep_stats, keep_values, max_length, keep_trigrams, key_length]
+                )
+
+                # Nor does changing how values are keyed, see rekey_value_index.
+                known_key_length = known_key_lengths.get((table_id, column_id), None)
+                if known_key_length is not None and known_key_length != key_length:
+                    rekey_value_index(conn, table, column, table_id, column_id, key_length)
+
+                # Turning trigrams on doesn't need a backfill, ensure_trigrams builds them from the value index.
+                if not keep_trigrams and known_trigrams.get((table_id, column_id), False):
+                    conn.execute('DELETE FROM dux_column_stats_trigrams WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+
+                if not keep_stats:
+                    conn.execute('DELETE FROM dux_column_stats WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+                elif not (table_id, column_id) in known_stats:
                     conn.execute(
                         'INSERT INTO dux_column_stats(table_id, column_id, type, nullable, pk) SELECT ?, ?, ?, ?, ? WHERE NOT EXISTS(SELECT * FROM dux_column_stats WHERE table_id = ? AND column_id = ?)',
                        [table_id, column_id, type, nullable, pk, table_id, column_id]
                     )
 
+                if not keep_values:
+                    conn.execute('DELETE FROM dux_column_stats_values WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+                    conn.execute('DELETE FROM dux_column_stats_prefixes WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+                    conn.execute('DELETE FROM dux_column_stats_trigrams WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+
         # Remove entries for tables that no longer exist
         # Eventually we'll want to be able to do this online, but for now you have to restart.
         known_table_ids = ', '.join([str(x) for x in known_tables.keys()])
         if known_table_ids:
             conn.execute('DELETE FROM dux_column_stats_ops WHERE NOT table_id IN ({})'.format(known_table_ids))
             conn.execute('DELETE FROM dux_column_stats_values WHERE NOT table_id IN ({})'.format(known_table_ids))
+            conn.execute('DELETE FROM dux_column_stats_prefixes WHERE NOT table_id IN ({})'.format(known_table_ids))
+            conn.execute('DELETE FROM dux_column_stats_trigrams WHERE NOT table_id IN ({})'.format(known_table_ids))
             conn.execute('DELETE FROM dux_column_stats WHERE NOT table_id IN ({})'.format(known_table_ids))
 
+        # Remove entries for columns that the policy no longer indexes.
+        for table_id, column_id in known_ops.keys():
+            if table_id in known_tables and not (table_id, column_id) in expected_ops:
+                conn.execute('DELETE FROM dux_column_stats_ops WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+                conn.execute('DELETE FROM dux_column_stats_values WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+                conn.execute('DELETE FROM dux_column_stats_prefixes WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+                conn.execute('DELETE FROM dux_column_stats_trigrams WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+                conn.execute('DELETE FROM dux_column_stats WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+
         # TODO: delete entries that are in dux_column_stats but no longer in columns
         # TODO: delete entries that are in dux_column_stats_values but no longer in columns
 
+        ensure_prefix_tops(conn)
+        ensure_trigrams(conn)
+
+
+# How many databases the indexer works on at once, see the
+# indexer-concurrency plugin setting.
+INDEXER_CONCURRENCY = 4
 
 async def index_loop(ds, dbs_to_watch):
+    data_versions = {}
+    tasks = []
     try:
         # Ensure that there are default empty rows in dux_column_stats_ops, dux_column_stats for every column.
         t = time.time()
         for db_name in dbs_to_watch:
             db = ds.databases[db_name]
-            await db.execute_write_fn(ensure_empty_rows_for_db)
+
+            if not db_name in ds._dux_reconciled_dbs:
+                policy = get_indexing_policy(ds, db_name)
+                def ensure(conn):
+                    ensure_empty_rows_for_db(conn, policy)
+                    record_schema_fingerprint(conn, policy)
+                    note_stats_change(conn, ds._dux_autosuggest_cache, db_name)
+                await db.execute_write_fn(ensure)
+
+                # Some stats may have been reset.
+                if ds._dux_autosuggest_cache:
+                    ds._dux_autosuggest_cache.invalidate(db_name)
+
+            # Give big tables estimated stats while we wait for their backfill.
+            sampled_stats = await db.execute_fn(plan_sampled_stats)
+            if sampled_stats:
+                def apply(conn):
+                    apply_sampled_stats(conn, sampled_stats)
+                    note_stats_change(conn, ds._dux_autosuggest_cache, db_name)
+                await db.execute_write_fn(apply)
 
         print('datasette-ui-extras: stats schemas ensured in {} s'.format(time.time() - t))
 
-        while True:
-            did_work = False
-            for db_name in dbs_to_watch:
-                await asyncio.sleep(0)
+        # Each database gets its own task, so a big backfill in one database doesn't
+        # starve the others. The semaphore caps how many are working at once; its
+        # waiters are served in FIFO order, so databases take turns one batch at a time.
+        config = ds.plugin_config('datasette-ui-extras') or {}
+        semaphore = asyncio.Semaphore(config.get('indexer-concurrency', INDEXER_CONCURRENCY))
 
+        # Every database might have work when we start. After that, we only wake
+        # a database's task once a commit has been seen on it, see data_version_changed.
+        wakeups = {}
+        for db_name in dbs_to_watch:
+            wakeups[db_name] = asyncio.Event()
+            wakeups[db_name].set()
+            tasks.append(asyncio.create_task(index_db_loop(ds, db_name, wakeups[db_name], semaphore)))
+
+        # Checking opens and queries SQLite, so it happens off the event loop. The
+        # same read-only connections tell the cache whether another process has
+        # written to the stats tables.
+        cache = ds._dux_autosuggest_cache
+        def check_data_versions():
+            rv = []
+            for db_name in dbs_to_watch:
                 db = ds.databases[db_name]
-                did_work = await index_db(db) or did_work
+                config = ds.plugin_config('datasette-ui-extras', database=db_name) or {}
+                if data_version_changed(data_versions, db_name, db, sidecar=bool(config.get('sidecar'))):
+                    rv.append(db_name)
+
+                if cache:
+                    cache.check_stats_generation(db_name, get_stats_generation(data_versions[db_name][0]))
+
+            return rv
+
+        loop = asyncio.get_running_loop()
+        while True:
+            for db_name in await loop.run_in_executor(None, check_data_versions):
+                wakeups[db_name].set()
 
-            if not did_work:
-                await asyncio.sleep(1)
+            for task in tasks:
+                if task.done():
+                    # Re-raise the task's exception, if any.
+                    task.result()
+
+            await asyncio.sleep(1)
 
     except Exception as e:
        print('datasette-ui-extras: error during index_loop; exiting', file=sys.stderr)
        traceback.print_exc()
        sys.exit(1)
 
+    finally:
+        # Datasette cancels us when it shuts down.
+        for task in tasks:
+            task.cancel()
+
+        close_data_version_connections(data_versions)
+
+async def index_db_loop(ds, db_name, wakeup, semaphore):
+    db = ds.databases[db_name]
+    state = {}
+
+    while True:
+        await wakeup.wait()
+        # Clear before working: a commit seen while we work will wake us again.
+        wakeup.clear()
+
+        config = ds.plugin_config('datasette-ui-extras', database=db_name) or {}
+        target_ms = config.get('index-batch-ms', INDEX_BATCH_MS)
+
+        cache = ds._dux_autosuggest_cache
+
+        did_work = True
+        while did_work:
+            async with semaphore:
+                did_work = await index_db(db, target_ms, state, cache)
+
+            # Give any database waiting on the semaphore a turn before we take it again.
+            await asyncio.sleep(0)
+
+def data_version_changed(data_versions, db_name, db, sidecar=False):
+    # PRAGMA data_version changes when another connection commits to the database,
+    # whether that's Datasette's write connection (our indexer, the write API) or
+    # another process. It's only meaningful for a single connection, so we keep
+    # a dedicated read-only connection per database for asking the question. It's
+    # used from whichever thread the executor runs us on, one call at a time.
+    #
+    # With sidecar, the connection also has the stats tables attached, so it can
+    # be used to read their generation, see get_stats_generation.
+    #
+    # data_versions maps db_name to (conn, last seen version).
+    conn, last_version = data_versions.get(db_name, (None, None))
+
+    if not conn:
+        conn = sqlite3.connect(pathlib.Path(db.path).resolve().as_uri() + '?mode=ro', uri=True, check_same_thread=False)
+        if sidecar and sidecar_path(db.path).exists():
+            conn.execute('ATTACH DATABASE ? AS {}'.format(DUX_SIDECAR_SCHEMA), [sidecar_path(db.path).resolve().as_uri() + '?mode=ro'])
+
+    version = conn.execute('PRAGMA data_version').fetchone()[0]
+    data_versions[db_name] = (conn, version)
+
+    return version != last_version
+
+def close_data_version_connections(data_versions):
+    for conn, version in data_versions.values():
+        conn.close()
+
+    data_versions.clear()
+
 def get_next_backfill_batch(conn):
-    next_row = list(conn.execute('select table_id, column_id, last_key, (select name from dux_ids ids where ids.id = ops.table_id) AS table_name, (select name from dux_ids ids where ids.id = ops.column_id) AS column_name, updated_at from dux_column_stats_ops ops where pending order by updated_at asc limit 1'))
+    # Find the column that has waited longest for progress. We'll index it along with every
+    # other pending column of the same table at the same position, so that a table
+    # is scanned once, not once per column. Columns added later have their own
+    # last_key, so they get their own pass.
+    next_row = conn.execute('select table_id, last_key, (select name from dux_ids ids where ids.id = ops.table_id) AS table_name from dux_column_stats_ops ops where pending order by updated_at asc limit 1').fetchone()
 
     if not next_row:
         return None
 
-    return next_row[0]
+    table_id, last_key, table_name = next_row
+    return get_backfill_batch(conn, table_id, table_name, last_key)
 
-def index_next_backfill_batch(conn):
-    next_row = get_next_backfill_batch(conn)
+def get_table_backfill_batches(conn, table_name):
+    # Every batch of pending columns for the table, one per distinct position.
+    rows = conn.execute('select distinct ops.table_id, ops.last_key from dux_column_stats_ops ops join dux_ids ids on ids.id = ops.table_id where pending and ids.name = ? order by ops.last_key', [table_name]).fetchall()
 
-    if not next_row:
-        return False
+    return [get_backfill_batch(conn, table_id, table_name, last_key) for table_id, last_key in rows]
+
+def get_backfill_batch(conn, table_id, table_name, last_key):
+    columns = conn.execute('select column_id, (select name from dux_ids ids where ids.id = ops.column_id) AS column_name, updated_at, stats, value_index, max_length, key_length from dux_column_stats_ops ops where pending and table_id = ? and last_key = ? order by column_id', [table_id, last_key]).fetchall()
+
+    return {
+        'table_id': table_id,
+        'table_name': table_name,
+        'last_key': last_key,
+        'columns': [(row['column_id'], row['column_name'], row['updated_at']) for row in columns],
+        # What to index for each column, see get_column_policy
+        'policies': dict([(row['column_id'], (bool(row['stats']), bool(row['value_index']), row['max_length'], row['key_length'])) for row in columns]),
+    }
+
+# How many rows to read per backfill chunk, when not sizing chunks adaptively.
+BACKFILL_CHUNK_SIZE = 1000
+
+# The default target duration of an indexer batch, see the
+# index-batch-ms plugin setting.
+INDEX_BATCH_MS = 100
+
+# Bounds for adaptively-sized backfill chunks. We start small for tables
+# we haven't seen before, as their rows may be huge.
+MIN_BACKFILL_CHUNK_SIZE = 10
+INITIAL_BACKFILL_CHUNK_SIZE = 100
+MAX_BACKFILL_CHUNK_SIZE = 50000
+
+def get_backfill_chunk_size(rows_per_ms, target_ms):
+    if target_ms is None:
+        return BACKFILL_CHUNK_SIZE
+
+    if not rows_per_ms:
+        return INITIAL_BACKFILL_CHUNK_SIZE
+
+    return max(MIN_BACKFILL_CHUNK_SIZE, min(MAX_BACKFILL_CHUNK_SIZE, int(rows_per_ms * target_ms)))
+
+def record_backfill_rate(conn, table_id, rows_per_ms, rows, elapsed_ms):
+    # Keep an exponentially-weighted average of throughput, so one slow chunk
+    # (a checkpoint, a burst of huge cells) doesn't swing the chunk size too far.
+    observed = rows / max(elapsed_ms, 0.1)
+    if rows_per_ms:
+        observed = (rows_per_ms + observed) / 2
+
+    conn.execute(
+        'INSERT INTO dux_table_ops(table_id, rows_per_ms) VALUES (?, ?) ON CONFLICT(table_id) DO UPDATE SET rows_per_ms = excluded.rows_per_ms',
+        [table_id, observed]
+    )
+
+def fetch_backfill_chunk(conn, table_name, pks, columns, last_key, limit):
+    # Keyset-paginate through the table: returns up to `limit` rows of
+    # (key, *columns) after `last_key`, where key is a JSON object of the pks.
+    key_expr = 'json_object({})'.format(
+        ', '.join(["'{}'".format(pk) + ', ' + '"{}"'.format(pk) for pk in pks])
+    )
+    order_by = ', '.join(['"{}"'.format(pk) for pk in pks])
+    where = ''
+    where_args = []
+    if last_key:
+        where = 'WHERE ({pks}) > ({last_keys})'.format(
+            pks=', '.join(['"{}"'.format(pk) for pk in pks]),
+            last_keys = ', '.join(['?' for pk in pks]),
+        )
+        where_args = [last_key[pk] for pk in pks]
+
+    sql = 'SELECT {key} AS key, {columns} FROM {table_name} {where} ORDER BY {order_by} LIMIT {limit}'.format(
+        key=key_expr,
+        columns=', '.join(['"{}"'.format(column) for column in columns]),
+        table_name='"{}"'.format(table_name),
+        where=where,
+        order_by=order_by,
+        limit=limit
+    )
+
+    return conn.execute(sql, where_args).fetchall()
+
+def plan_backfill_batch(conn, target_ms=None, batch=None, rows_per_ms=None):
+    # The read phase of the backfill: read the next chunk and compute the changes to
+    # make, without writing anything. This can run on a read-only connection.
+    #
+    # If target_ms is given, size the chunk so that reading and applying it takes
+    # about that long, based on the throughput we've seen for this table.
+    #
+    # If batch is given, plan it rather than the next batch from dux_column_stats_ops.
+    # If rows_per_ms is given, use it rather than the throughput from dux_table_ops.
+    if batch is None:
+        batch = get_next_backfill_batch(conn)
+
+    if not batch:
+        return None
+
+    t = time.time()
+    table_id = batch['table_id']
+    table_name = batch['table_name']
+    column_ids = [column_id for column_id, column_name, updated_at in batch['columns']]
+    column_names = [column_name for column_id, column_name, updated_at in batch['columns']]
+
+    pks = get_pk_columns(conn, table_name)
+
+    if rows_per_ms is None:
+        rows_per_ms = conn.execute('SELECT rows_per_ms FROM dux_table_ops WHERE table_id = ?', [table_id]).fetchone()
+        rows_per_ms = rows_per_ms[0] if rows_per_ms else None
+    chunk_size = get_backfill_chunk_size(rows_per_ms, target_ms)
+
+    # Read the chunk once, and compute the summary stats, the distinct values and
+    # the distinct JSON array values for every column in a single pass over it.
+    rows = fetch_backfill_chunk(conn, table_name, pks, column_names, json.loads(batch['last_key']), chunk_size)
+
+    policies = [batch['policies'].get(column_id, (True, True, DEFAULT_MAX_LENGTH, DEFAULT_KEY_LENGTH)) for column_id in column_ids]
+    stats_by_column = [new_stats() for column_id in column_ids]
+    value_deltas = {}
+    for row in rows:
+        key = row[0]
+        for i, column_id in enumerate(column_ids):
+            value = row[i + 1]
+            keep_stats, keep_values, max_length, key_length = policies[i]
+            if keep_stats:
+                add_value_to_stats(stats_by_column[i], value, 1)
+
+            if keep_values and isinstance(value, str):
+                add_value_index_deltas(value_deltas, table_id, column_id, 'insert', value, key, max_length, key_length)
+
+    # Determine what new value for last_key should be.
+    next_key = '{}'
+    if len(rows) == chunk_size:
+        next_key = rows[-1][0]
+
+    return {
+        'table_id': table_id,
+        'last_key': batch['last_key'],
+        'columns': [(column_id, updated_at) for column_id, column_name, updated_at in batch['columns']],
+        'stats': [(column_id, stats) for column_id, stats, policy in zip(column_ids, stats_by_column, policies) if policy[0]],
+        'value_deltas': value_deltas,
+        'next_key': next_key,
+        'rows': len(rows),
+        'rows_per_ms': rows_per_ms,
+        'read_ms': (time.time() - t) * 1000,
+    }
+
+def plan_table_backfill(conn, table_name, target_ms=None):
+    # Plan the rest of the table's backfill, chunk by chunk, without waiting for
+    # the plans to be applied. Each plan starts where the previous one ends, so
+    # they must be applied in order.
+    rows_per_ms = None
+    for batch in get_table_backfill_batches(conn, table_name):
+        while True:
+            plan = plan_backfill_batch(conn, target_ms, batch, rows_per_ms)
+            yield plan
+
+            # Size chunks by how quickly we're reading them. The rates recorded in
+            # dux_table_ops lag behind, as the writer may not have committed them yet.
+            if plan['rows']:
+                rows_per_ms = plan['rows'] / max(plan['read_ms'], 0.1)
+
+            if plan['next_key'] == '{}':
+                break
 
+            # We can't know what updated_at the previous plan will leave behind, so
+            # later plans in the chain rely on last_key alone to detect staleness.
+            batch = dict(batch, last_key=plan['next_key'], columns=[(column_id, column_name, None) for column_id, column_name, updated_at in batch['columns']])
+
+def apply_backfill_plan(conn, plan):
+    # The write phase of the backfill: merge a plan from plan_backfill_batch into
+    # the stats tables and advance the ops table, in one short transaction.
     with conn:
-        # print([x for x in next_row])
-        table_id, column_id, last_key, table_name, column_name, updated_at = next_row
+        return merge_backfill_plan(conn, plan)
 
-        pks = list(conn.execute('select name from pragma_table_info(?) where pk', [table_name]))
-        pks = [row[0] for row in pks]
-        if not pks:
-            pks = ['rowid']
+def merge_backfill_plan(conn, plan, value_deltas=None):
+    # Merge a plan into the current transaction. If value_deltas is given, the plan's
+    # changes to dux_column_stats_values are added to it, for the caller to apply
+    # later, rather than applied now.
+    t = time.time()
+    table_id = plan['table_id']
 
-        key_expr = 'json_object({})'.format(
-            ', '.join(["'{}'".format(pk) + ', ' + '"{}"'.format(pk) for pk in pks])
-        )
-        order_by = ', '.join(['"{}"'.format(pk) for pk in pks])
-        last_key = json.loads(last_key)
-        where = ''
-        where_args = []
-        if last_key:
-            where = 'WHERE ({pks}) > ({last_keys})'.format(
-                pks=', '.join(['"{}"'.format(pk) for pk in pks]),
-                last_keys = ', '.join(['?' for pk in pks]),
-            )
-            where_args = [last_key[pk] for pk in pks]
-
-        chunk_size = 1000
-        def make_base_sql(include_value=True, limit=chunk_size):
-            value = ""
-
-            if include_value:
-                value = ", {value} AS value ".format(value = '"{}"'.format(column_name))
-            base_sql = 'SELECT {key} AS key {value} FROM {table_name} {where} ORDER BY {order_by} LIMIT {limit}'.format(
-                key=key_expr,
-                value=value,
-                table_name='"{}"'.format(table_name),
-                where=where,
-                order_by=order_by,
-                limit=limit
-            )
-            return base_sql
-
-        sql_including_values = make_base_sql(True)
-
-        update_summary_stats(conn, table_id, column_id, sql_including_values, where_args)
-        update_distincts(conn, table_id, column_id, sql_including_values, where_args)
-        update_json_distincts(conn, table_id, column_id, sql_including_values, where_args)
-
-        # Fetch and update distinct json array values
-
-        # Determine what new value for last_key should be and update the ops table.
-        next_key = list(conn.execute('{} OFFSET {}'.format(make_base_sql(False, 1), chunk_size - 1), where_args))
-
-
-        if next_key:
-            next_key = next_key[0][0]
+    # Another writer may have moved these columns on since the plan was made (or
+    # reset them, which changes updated_at). If so, discard the plan: the next
+    # plan will start from wherever they are now.
+    for column_id, updated_at in plan['columns']:
+        current = conn.execute('SELECT last_key, pending, updated_at FROM dux_column_stats_ops WHERE table_id = ? AND column_id = ?', [table_id, column_id]).fetchone()
+
+        if not current or current[0] != plan['last_key'] or not current[1]:
+            return True
+
+        if updated_at is not None and current[2] != updated_at:
+            return True
+
+    next_key = plan['next_key']
+    for column_id, stats in plan['stats']:
+        merge_backfill_stats(conn, table_id, column_id, stats, next_key == '{}')
+
+    if value_deltas is None:
+        apply_value_index_deltas(conn, plan['value_deltas'])
+    else:
+        merge_value_index_deltas(value_deltas, plan['value_deltas'])
+
+    conn.executemany(
+        "UPDATE dux_column_stats_ops SET last_key = ?, pending = ?, updated_at = strftime('%Y-%m-%d %H:%M:%f') || 'Z' WHERE table_id = ? AND column_id = ?",
+        [[next_key, 0 if next_key == '{}' else 1, table_id, column_id] for column_id, updated_at in plan['columns']]
+    )
+
+    # Prefix tops aren't maintained during a backfill, see update_prefix_tops. Any
+    # value_deltas we've held back are applied to the rebuilt tops as usual.
+    if next_key == '{}':
+        for column_id, updated_at in plan['columns']:
+            rebuild_prefix_tops(conn, table_id, column_id)
+
+    if plan['rows']:
+        elapsed_ms = plan['read_ms'] + (time.time() - t) * 1000
+        record_backfill_rate(conn, table_id, plan['rows_per_ms'], plan['rows'], elapsed_ms)
+
+    return True
+
+def merge_backfill_stats(conn, table_id, column_id, stats, done):
+    estimated, partial_stats = conn.execute('SELECT stats.estimated, ops.partial_stats FROM dux_column_stats stats JOIN dux_column_stats_ops ops USING (table_id, column_id) WHERE table_id = ? AND column_id = ?', [table_id, column_id]).fetchone() or (False, None)
+
+    if not estimated:
+        merge_column_stats(conn, table_id, column_id, stats)
+        return
+
+    # The stats are estimates from a sample. Rather than add to them, we accumulate
+    # the exact stats on the side, and swap them in once the backfill is done.
+    if partial_stats:
+        stats = merge_stats(json.loads(partial_stats), stats)
+
+    if done:
+        set_column_stats(conn, table_id, column_id, stats, False)
+        partial_stats = None
+    else:
+        partial_stats = json.dumps(stats)
+
+    conn.execute('UPDATE dux_column_stats_ops SET partial_stats = ? WHERE table_id = ? AND column_id = ?', [partial_stats, table_id, column_id])
+
+def index_next_backfill_batch(conn, target_ms=None):
+    plan = plan_backfill_batch(conn, target_ms)
+
+    if not plan:
+        return False
+
+    return apply_backfill_plan(conn, plan)
+
+# Tables with at least this many rows get estimated stats from a sample of this
+# many rows, so that the UI has something to go on while the backfill runs.
+SAMPLED_STATS_MIN_ROWS = 1000000
+SAMPLED_STATS_ROWS = 1000
+
+def get_tables_to_sample(conn):
+    # Tables that the indexing policy says to sample, and tables we haven't started
+    # to backfill and have no stats for. Returns (table_id, table_name, sample).
+    return conn.execute('''
+SELECT ops.table_id, ids.name, table_ops.sample
+FROM dux_column_stats_ops ops
+JOIN dux_ids ids ON ids.id = ops.table_id
+LEFT JOIN dux_table_ops table_ops ON table_ops.table_id = ops.table_id
+GROUP BY ops.table_id
+HAVING table_ops.sample IS NOT NULL OR (
+  min(ops.pending) = 1 AND min(ops.last_key) = '{}' AND max(ops.last_key) = '{}'
+  AND NOT EXISTS(SELECT * FROM dux_column_stats stats WHERE stats.table_id = ops.table_id AND (stats.count != 0 OR stats.estimated))
+)
+''').fetchall()
+
+def plan_sampled_stats(conn):
+    # Estimate stats for big tables from a sample of their rows. Rather than scan the
+    # table, we probe it at random rowids, so this is quick however big it is.
+    #
+    # Like plan_backfill_batch, this can run on a read-only connection.
+    rv = []
+    for table_id, table_name, sample in get_tables_to_sample(conn):
+        # WITHOUT ROWID tables can't be probed cheaply, so they get the usual backfill.
+        if list(conn.execute('SELECT * FROM pragma_index_info(?)', [table_name])):
+            continue
+
+        min_rowid, max_rowid = conn.execute('SELECT min(rowid), max(rowid) FROM "{}"'.format(table_name)).fetchone()
+
+        # We estimate the table's size from its range of rowids, which is an overestimate
+        # if there are gaps, but doesn't need a scan.
+        if min_rowid is None:
+            continue
+
+        span = max_rowid - min_rowid + 1
+        if sample is not None:
+            # Tables sampled by policy are resampled every time, however small they are.
+            sample_rows = max(1, min(span, round(span * sample)))
+        elif span >= SAMPLED_STATS_MIN_ROWS:
+            sample_rows = SAMPLED_STATS_ROWS
         else:
-            next_key = '{}'
+            continue
 
-        conn.execute(
-            "UPDATE dux_column_stats_ops SET last_key = ?, pending = ?, updated_at = strftime('%Y-%m-%d %H:%M:%f') || 'Z' WHERE table_id = ? AND column_id = ?",
-            [next_key, 0 if next_key == '{}' else 1, table_id, column_id]
-        )
+        columns = conn.execute('SELECT column_id, (SELECT name FROM dux_ids ids WHERE ids.id = ops.column_id) FROM dux_column_stats_ops ops WHERE table_id = ? AND stats ORDER BY column_id', [table_id]).fetchall()
+        if not columns:
+            continue
+        select = 'SELECT {} FROM "{}" WHERE rowid >= ? ORDER BY rowid LIMIT 1'.format(', '.join(['"{}"'.format(column_name) for column_id, column_name in columns]), table_name)
 
-        return True
+        stats_by_column = [new_stats() for column in columns]
+        for i in range(sample_rows):
+            row = conn.execute(select, [random.randint(min_rowid, max_rowid)]).fetchone()
 
-async def index_db(db):
-    # Look for a column that needs some progress.
-    next_row = await db.execute_fn(get_next_backfill_batch)
+            for j, value in enumerate(row):
+                add_value_to_stats(stats_by_column[j], value, 1)
 
-    if next_row:
-        return await db.execute_write_fn(index_next_backfill_batch)
+        scale = span / sample_rows
+        rv.append((table_id, [(column_id, scale_stats(stats, scale)) for (column_id, column_name), stats in zip(columns, stats_by_column)]))
 
-    has_pending = list(await db.execute('select exists(select * from dux_pending_rows)'))
+    return rv
 
-    if has_pending[0][0]:
-        return await db.execute_write_fn(index_pending_rows)
+def apply_sampled_stats(conn, plan):
+    with conn:
+        # Only use the estimates if nobody has started on the tables in the meantime.
+        unsampled = set([table_id for table_id, table_name, sample in get_tables_to_sample(conn)])
+
+        for table_id, stats_by_column in plan:
+            if not table_id in unsampled:
+                continue
+
+            for column_id, stats in stats_by_column:
+                set_column_stats(conn, table_id, column_id, stats, True)
+
+def sample_large_tables(conn):
+    apply_sampled_stats(conn, plan_sampled_stats(conn))
+
+async def index_db(db, target_ms=INDEX_BATCH_MS, state=None, cache=None):
+    # Look for a column that needs some progress. The heavy lifting of reading
+    # the chunk happens on a read connection; only merging the results needs
+    # the write connection.
+    #
+    # While a backfill is in progress, it takes turns with draining dux_pending_rows,
+    # so that changes made in the meantime are indexed as they happen, rather than
+    # once the backfill is done. See apply_pending_rows for how they interact.
+    #
+    # state is an optional dict that persists between calls for the same database.
+    # cache is an optional AutosuggestCache to keep up to date with our changes.
+    if state is None:
+        state = {}
+
+    has_pending = list(await db.execute('select exists(select * from dux_pending_rows)'))[0][0]
+
+    if not (has_pending and state.get('drain_next', False)):
+        def plan(conn):
+            return plan_backfill_batch_and_queue(conn, target_ms)
+        backfill_plan = await db.execute_fn(plan)
+
+        if backfill_plan:
+            state['drain_next'] = True
+
+            def backfill(conn):
+                # Entries queued before the chunk was read are already reflected in it,
+                # so they're drained before the plan moves last_key past their rows.
+                touched = set()
+                index_pending_rows(conn, touched=touched, max_id=backfill_plan['pending_id'])
+                rv = True
+                if not conn.execute('select exists(select * from dux_pending_rows where id <= ?)', [backfill_plan['pending_id']]).fetchone()[0]:
+                    rv = apply_backfill_plan(conn, backfill_plan)
+                    touched.update(backfill_plan['value_deltas'].keys())
+
+                if cache:
+                    cache.refresh_values(db.name, conn, touched)
+                note_stats_change(conn, cache, db.name)
+                return rv
+            return await db.execute_write_fn(backfill)
+
+    if has_pending:
+        state['drain_next'] = False
+
+        def drain(conn):
+            if rebackfill_bulk_loaded_tables(conn, state):
+                if cache:
+                    cache.invalidate(db.name)
+                note_stats_change(conn, cache, db.name)
+                return True
+
+            touched = set()
+            rv = index_pending_rows(conn, time_budget=target_ms / 1000, touched=touched)
+            if cache:
+                cache.refresh_values(db.name, conn, touched)
+            note_stats_change(conn, cache, db.name)
+            return rv
+        return await db.execute_write_fn(drain)
 
     return False
 
+def note_stats_change(conn, cache, db_name):
+    # Let other processes know that we've written to the stats tables, and let our
+    # cache know that it was us, see AutosuggestCache.check_stats_generation.
+    previous, generation = bump_stats_generation(conn)
+    if cache:
+        cache.note_stats_generation(db_name, previous, generation)
+
+def plan_backfill_batch_and_queue(conn, target_ms=None):
+    # Like plan_backfill_batch, but also note the last entry in dux_pending_rows as
+    # of the same snapshot, as pending_id.
+    in_transaction = conn.in_transaction
+    if not in_transaction:
+        conn.execute('BEGIN')
+
+    try:
+        pending_id = conn.execute('SELECT coalesce(max(id), 0) FROM dux_pending_rows').fetchone()[0]
+        plan = plan_backfill_batch(conn, target_ms)
+    finally:
+        if not in_transaction:
+            conn.execute('COMMIT')
+
+    if plan:
+        plan['pending_id'] = pending_id
+
+    return plan
+
+# A table whose pending queue has at least this many entries, and at least
+# this many per row already in the table, is re-backfilled rather than drained.
+# Draining costs a few times more per row than a backfill, so past about half
+# the table's size, rescanning the whole table is cheaper.
+BULK_LOAD_MIN_PENDING = 10000
+BULK_LOAD_PENDING_RATIO = 0.5
+
+def rebackfill_bulk_loaded_tables(conn, state=None):
+    # Bulk loads (eg sqlite-utils insert) leave a very long queue in dux_pending_rows.
+    # When a table's queue is large relative to the table, throw it away and
+    # backfill the table from scratch instead.
+    #
+    # If state is given, we remember how far we've checked, so that draining a
+    # long queue that doesn't qualify doesn't re-count it on every batch.
+    min_id, max_id = conn.execute('SELECT min(id), max(id) FROM dux_pending_rows').fetchone()
+
+    if min_id is None or max_id - min_id + 1 < BULK_LOAD_MIN_PENDING:
+        return False
+
+    if state is not None:
+        if max_id - state.get('bulk_load_checked_id', min_id - 1) < BULK_LOAD_MIN_PENDING:
+            return False
+
+        state['bulk_load_checked_id'] = max_id
+
+    reset = False
+    with conn:
+        for table, pending in conn.execute('SELECT "table", count(*) FROM dux_pending_rows GROUP BY "table"').fetchall():
+            if pending < BULK_LOAD_MIN_PENDING:
+                continue
+
+            table_id, row_count = conn.execute('SELECT ids.id, max(stats.count) FROM dux_ids ids JOIN dux_column_stats stats ON stats.table_id = ids.id WHERE ids.name = ?', [table]).fetchone()
+
+            if table_id is None or pending < row_count * BULK_LOAD_PENDING_RATIO:
+                continue
+
+            reset_table_stats(conn, table, table_id)
+            reset = True
+
+    return reset
+
+RESET_COLUMN_STATS_SQL = '''
+UPDATE dux_column_stats SET
+    min = NULL,
+    max = NULL,
+    count = 0,
+    nulls = 0,
+    integers = 0,
+    reals = 0,
+    texts = 0,
+    blobs = 0,
+    json_strings = 0,
+    json_arrays = 0,
+    json_objects = 0,
+    texts_min_length = 0,
+    texts_max_length = 0,
+    texts_whitespace = 0,
+    texts_newline = 0,
+    blobs_min_length = 0,
+    blobs_max_length = 0,
+    estimated = 0
+'''
+
+RESET_COLUMN_STATS_OPS_SQL = '''
+UPDATE dux_column_stats_ops SET
+    last_key = '{}',
+    pending = ?,
+    updated_at = strftime('%Y-%m-%d %H:%M:%f') || 'Z',
+    partial_stats = NULL
+'''
+
+def reset_table_stats(conn, table, table_id):
+    # Forget everything we know about the table, and queue it for a fresh backfill.
+    # Bumping updated_at also invalidates any backfill plan that's in flight.
+    conn.execute('DELETE FROM dux_column_stats_values WHERE table_id = ?', [table_id])
+    conn.execute('DELETE FROM dux_column_stats_prefixes WHERE table_id = ?', [table_id])
+    conn.execute('DELETE FROM dux_column_stats_trigrams WHERE table_id = ?', [table_id])
+    conn.execute(RESET_COLUMN_STATS_SQL + 'WHERE table_id = ?', [table_id])
+    conn.execute(RESET_COLUMN_STATS_OPS_SQL + 'WHERE table_id = ?', [1, table_id])
+
+    # Write to the main database last, so that with a sidecar, we hold its lock briefly.
+    conn.execute('DELETE FROM dux_pending_rows WHERE "table" = ?', [table])
+
+def reset_column_stats(conn, table_id, column_id, pending):
+    # Like reset_table_stats, but for a single column whose indexing policy changed.
+    conn.execute('DELETE FROM dux_column_stats_values WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+    conn.execute('DELETE FROM dux_column_stats_prefixes WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+    conn.execute('DELETE FROM dux_column_stats_trigrams WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+    conn.execute(RESET_COLUMN_STATS_SQL + 'WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+    conn.execute(RESET_COLUMN_STATS_OPS_SQL + 'WHERE table_id = ? AND column_id = ?', [pending, table_id, column_id])
+
 def get_pk_columns(conn, table):
     pks = list(conn.execute('select name from pragma_table_info(?) where pk', [table]))
     pks = [row[0] for row in pks]
@@ -248,222 +865,1000 @@ def get_pk_columns(conn, table):
 
     return pks
 
-def fixup(obj):
-    # Entries in obj are either foo_literal, in which case their value should be taken as is,
-    # or foo_blob, in which case their value is a bytes array hex-encoded.
+class BlobValue:
+    # dux_pending_rows records only the length of a blob, not its contents.
+    # This stands in for the blob when computing stats.
+    def __init__(self, length):
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+def fixup(payload, format=PENDING_ROWS_FORMAT):
+    # Decode the old or new column of a dux_pending_rows entry into a dict of
+    # column name to value, or None for the missing side of an insert or delete.
+    if payload is None:
+        return None
+
+    obj = json.loads(payload)
+
+    # Entries queued before schema version 9 have no format. The indexer drains
+    # them on its first pass after the upgrade, so this can go once we no longer
+    # support upgrading databases from before then.
+    if format is None:
+        return fixup_legacy(obj)
+
+    return decode_payload(obj)
+
+def decode_payload(obj):
+    # Values are taken as is, except for blobs, which are recorded as [length].
+    rv = {}
+    for k, v in obj.items():
+        if isinstance(v, list):
+            rv[k] = BlobValue(v[0])
+        else:
+            rv[k] = v
+
+    return rv
+
+def fixup_legacy(obj):
+    # Entries written by the original triggers have keys that are either foo_literal,
+    # in which case their value should be taken as is, or foo_blob, in which case
+    # their value is a bytes array hex-encoded. Entries queued by later triggers,
+    # before we recorded the format, are in the current format, so we have to
+    # guess from the keys.
+    if not obj or not all([k.endswith('_literal') or k.endswith('_blob') for k in obj.keys()]):
+        return decode_payload(obj)
+
     rv = {}
     for k, v in obj.items():
         if k.endswith('_literal'):
             rv[k[0:-8]] = v
-        elif k.endswith('_blob'):
-            rv[k[0:-5]] = bytes.fromhex(v)
         else:
-            raise Exception('unexpected key {}'.format(k))
+            rv[k[0:-5]] = bytes.fromhex(v)
+
+    return rv
+
+def lookup_id(conn, ids, name):
+    # Like ensure_id, but never creates an ID. Results (including misses) are
+    # memoized in `ids`.
+    if not name in ids:
+        row = conn.execute('SELECT id FROM dux_ids WHERE name = ?', [name]).fetchone()
+        ids[name] = row[0] if row else None
+
+    return ids[name]
+
+def sqlite_typeof(value):
+    # Mirrors SQLite's typeof() for a value as returned by the sqlite3 module.
+    if value is None:
+        return 'null'
+
+    if isinstance(value, int):
+        return 'integer'
+
+    if isinstance(value, float):
+        return 'real'
+
+    if isinstance(value, str):
+        return 'text'
+
+    return 'blob'
+
+def reject_json_constant(value):
+    # SQLite's JSON parser doesn't accept NaN, Infinity or -Infinity, but Python's does.
+    raise ValueError('unsupported JSON constant {}'.format(value))
+
+def might_be_json(value, starts):
+    # A cheap pre-check before paying for json.loads: does the value start with
+    # one of the characters in `starts`, ignoring leading whitespace?
+    first = value[0:1]
+    if first.isspace():
+        first = value.lstrip()[0:1]
+
+    return first != '' and first in starts
+
+def json_typeof(value):
+    # Mirrors json_type(value) for the strings, arrays and objects we count,
+    # returns None for anything else, including invalid JSON.
+    if not isinstance(value, str) or not might_be_json(value, '"[{'):
+        return None
+
+    try:
+        parsed = json.loads(value, parse_constant=reject_json_constant)
+    except (ValueError, RecursionError):
+        return None
+
+    if isinstance(parsed, str):
+        return 'text'
+
+    if isinstance(parsed, list):
+        return 'array'
+
+    if isinstance(parsed, dict):
+        return 'object'
+
+    return None
+
+STATS_TYPE_COUNTERS = {
+    'null': 'nulls',
+    'integer': 'integers',
+    'real': 'reals',
+    'text': 'texts',
+    'blob': 'blobs',
+}
+
+STATS_JSON_COUNTERS = {
+    'text': 'json_strings',
+    'array': 'json_arrays',
+    'object': 'json_objects',
+}
+
+def new_stats():
+    return {
+        'count': 0,
+        'nulls': 0,
+        'integers': 0,
+        'reals': 0,
+        'texts': 0,
+        'blobs': 0,
+        'json_strings': 0,
+        'json_arrays': 0,
+        'json_objects': 0,
+        'texts_whitespace': 0,
+        'texts_newline': 0,
+        'texts_min_length': None,
+        'texts_max_length': None,
+        'blobs_min_length': None,
+        'blobs_max_length': None,
+        'min': None,
+        'max': None,
+    }
+
+def sqlite_sort_key(value):
+    # Numbers sort before text; we never compare NULLs or blobs.
+    return (1 if isinstance(value, str) else 0, value)
+
+def merge_extreme(stats, key, value, is_min):
+    if value is None:
+        return
+
+    existing = stats[key]
+    if existing is None:
+        stats[key] = value
+    elif is_min and sqlite_sort_key(value) < sqlite_sort_key(existing):
+        stats[key] = value
+    elif not is_min and sqlite_sort_key(value) > sqlite_sort_key(existing):
+        stats[key] = value
+
+def add_value_to_stats(stats, value, delta):
+    # Accumulate the effect of inserting (delta = 1) or deleting (delta = -1) `value`.
+    #
+    # This mirrors the SQL we used to run per pending row. As there, deletes
+    # only adjust counts: we can't know the new min/max without a scan.
+    kind = sqlite_typeof(value)
+
+    stats['count'] += delta
+    stats[STATS_TYPE_COUNTERS[kind]] += delta
+
+    if kind == 'text':
+        json_kind = json_typeof(value)
+        if json_kind:
+            stats[STATS_JSON_COUNTERS[json_kind]] += delta
+
+        if ' ' in value:
+            stats['texts_whitespace'] += delta
+
+        if '\n' in value:
+            stats['texts_newline'] += delta
+
+    if delta < 0:
+        return
+
+    if kind == 'text':
+        merge_extreme(stats, 'texts_min_length', len(value), True)
+        merge_extreme(stats, 'texts_max_length', len(value), False)
+    elif kind == 'blob':
+        merge_extreme(stats, 'blobs_min_length', len(value), True)
+        merge_extreme(stats, 'blobs_max_length', len(value), False)
+
+    if kind == 'null' or kind == 'blob' or (kind == 'text' and len(value) > 100):
+        return
+
+    merge_extreme(stats, 'min', value, True)
+    merge_extreme(stats, 'max', value, False)
+
+MERGE_COLUMN_STATS_SQL = '''
+UPDATE dux_column_stats SET
+    count = count + :count,
+    nulls = nulls + :nulls,
+    integers = integers + :integers,
+    reals = reals + :reals,
+    texts = texts + :texts,
+    blobs = blobs + :blobs,
+    json_strings = json_strings + :json_strings,
+    json_arrays = json_arrays + :json_arrays,
+    json_objects = json_objects + :json_objects,
+    texts_whitespace = texts_whitespace + :texts_whitespace,
+    texts_newline = texts_newline + :texts_newline,
+    texts_min_length = CASE WHEN :texts_min_length IS NULL THEN texts_min_length WHEN texts_min_length IS NULL THEN :texts_min_length ELSE min(texts_min_length, :texts_min_length) END,
+    texts_max_length = CASE WHEN :texts_max_length IS NULL THEN texts_max_length WHEN texts_max_length IS NULL THEN :texts_max_length ELSE max(texts_max_length, :texts_max_length) END,
+    blobs_min_length = CASE WHEN :blobs_min_length IS NULL THEN blobs_min_length WHEN blobs_min_length IS NULL THEN :blobs_min_length ELSE min(blobs_min_length, :blobs_min_length) END,
+    blobs_max_length = CASE WHEN :blobs_max_length IS NULL THEN blobs_max_length WHEN blobs_max_length IS NULL THEN :blobs_max_length ELSE max(blobs_max_length, :blobs_max_length) END,
+    min = CASE WHEN :min IS NULL THEN min WHEN min IS NULL THEN :min ELSE min(min, :min) END,
+    max = CASE WHEN :max IS NULL THEN max WHEN max IS NULL THEN :max ELSE max(max, :max) END
+WHERE table_id = :table_id AND column_id = :column_id
+'''
+
+def merge_column_stats(conn, table_id, column_id, stats):
+    args = dict(stats)
+    args['table_id'] = table_id
+    args['column_id'] = column_id
+    conn.execute(MERGE_COLUMN_STATS_SQL, args)
+
+SET_COLUMN_STATS_SQL = '''
+UPDATE dux_column_stats SET
+    count = :count,
+    nulls = :nulls,
+    integers = :integers,
+    reals = :reals,
+    texts = :texts,
+    blobs = :blobs,
+    json_strings = :json_strings,
+    json_arrays = :json_arrays,
+    json_objects = :json_objects,
+    texts_whitespace = :texts_whitespace,
+    texts_newline = :texts_newline,
+    texts_min_length = :texts_min_length,
+    texts_max_length = :texts_max_length,
+    blobs_min_length = :blobs_min_length,
+    blobs_max_length = :blobs_max_length,
+    min = :min,
+    max = :max,
+    estimated = :estimated
+WHERE table_id = :table_id AND column_id = :column_id
+'''
+
+def set_column_stats(conn, table_id, column_id, stats, estimated):
+    args = dict(stats)
+    args['table_id'] = table_id
+    args['column_id'] = column_id
+    args['estimated'] = estimated
+    conn.execute(SET_COLUMN_STATS_SQL, args)
+
+# The stats that count rows, as opposed to recording extremes.
+STATS_COUNTERS = ['count', 'nulls', 'integers', 'reals', 'texts', 'blobs', 'json_strings', 'json_arrays', 'json_objects', 'texts_whitespace', 'texts_newline']
+
+def merge_stats(stats, more_stats):
+    # The Python equivalent of MERGE_COLUMN_STATS_SQL.
+    rv = dict(stats)
+    for key in STATS_COUNTERS:
+        rv[key] += more_stats[key]
+
+    for key in ['texts_min_length', 'blobs_min_length', 'min']:
+        merge_extreme(rv, key, more_stats[key], True)
+
+    for key in ['texts_max_length', 'blobs_max_length', 'max']:
+        merge_extreme(rv, key, more_stats[key], False)
 
     return rv
 
-def index_pending_rows(conn):
+def scale_stats(stats, scale):
+    rv = dict(stats)
+    for key in STATS_COUNTERS:
+        rv[key] = round(rv[key] * scale)
+
+    return rv
+
+def get_row_changes(old, new):
+    # Diff old and new to determine what stats need to be updated. For updates,
+    # old and new hold only the columns that changed, plus the primary key.
+    changes = []
+
+    if old is not None and new is not None:
+        for column, old_value in old.items():
+            if not column in new:
+                continue
+
+            new_value = new[column]
+            if old_value != new_value or sqlite_typeof(old_value) != sqlite_typeof(new_value):
+                changes.append(('delete', column, old_value))
+                changes.append(('insert', column, new_value))
+    elif old is not None:
+        for column, value in old.items():
+            changes.append(('delete', column, value))
+    elif new is not None:
+        for column, value in new.items():
+            changes.append(('insert', column, value))
+
+    return changes
+
+def coalesce_row_change(changed_rows, pk_columns, the_rowid, table, old, new):
+    # Fold one dux_pending_rows entry into the net change for its row, keeping the
+    # oldest value of each column in old and the newest in new.
+    #
+    # Rows are identified by rowid when the table has one, otherwise by their
+    # primary key before the change.
+    if the_rowid is not None:
+        key = (table, the_rowid)
+    else:
+        key = (table, tuple([(old if old is not None else new)[pk_column] for pk_column in pk_columns]))
+
+    if not key in changed_rows:
+        changed_rows[key] = [the_rowid, table, old, new]
+        return
+
+    change = changed_rows[key]
+
+    # If the row didn't exist before the first change, there's no old to merge into.
+    if change[2] is not None and old is not None:
+        for column, value in old.items():
+            if not column in change[2]:
+                change[2][column] = value
+
+    if new is None:
+        # Deleted.
+        change[3] = None
+    elif change[3] is None:
+        # (Re-)inserted, so new has every column.
+        change[3] = new
+    else:
+        change[3].update(new)
+
+# How many dux_pending_rows entries to consume in a single write transaction.
+PENDING_ROWS_BATCH_SIZE = 1000
+
+# Within a transaction, entries are read, indexed and applied this many at a time,
+# so that we can stop once the time budget is spent.
+PENDING_ROWS_SUB_BATCH_SIZE = 100
+
+def index_pending_rows(conn, batch_size=PENDING_ROWS_BATCH_SIZE, time_budget=None, touched=None, max_id=None):
+    # Consume up to `batch_size` entries from dux_pending_rows, stopping early once
+    # `time_budget` seconds have elapsed. The budget is checked after each sub-batch
+    # has been applied, so we overrun it by at most one sub-batch.
+    #
+    # If touched is given, the keys of the dux_column_stats_values entries we
+    # change are added to it. If max_id is given, later entries are left alone.
+    #
+    # The consumed entries are removed with a single ranged DELETE.
     with conn:
-        next_row = list(conn.execute('select id, the_rowid, "table", "old", "new" from dux_pending_rows order by id limit 1'))
+        t = time.time()
+        lookups = {'ids': {}, 'pk_columns_by_table': {}, 'policies': {}}
+        first_id = None
+        last_id = None
+        consumed = 0
+        counts = {}
+
+        while consumed < batch_size:
+            pending = conn.execute(
+                'select id, the_rowid, "table", "old", "new", "format" from dux_pending_rows where id > ? and (? is null or id <= ?) order by id limit ?',
+                [last_id if last_id is not None else -1, max_id, max_id, min(PENDING_ROWS_SUB_BATCH_SIZE, batch_size - consumed)]
+            ).fetchall()
+
+            if not pending:
+                break
 
-        if not next_row:
+            if first_id is None:
+                first_id = pending[0][0]
+            last_id = pending[-1][0]
+            consumed += len(pending)
+
+            apply_pending_rows(conn, pending, lookups, touched, counts)
+
+            if time_budget is not None and time.time() - t >= time_budget:
+                break
+
+        if not consumed:
             return False
 
-        id, the_rowid, table, old, new = next_row[0]
-
-        old = json.loads(old or '{}')
-        new = json.loads(new or '{}')
-
-        old = fixup(old)
-        new = fixup(new)
-
-        pk_columns = get_pk_columns(conn, table)
-
-        # Diff old and new to determine what stats need to be updated.
-        changes = []
-
-        # The keys will be the same in each object, so enumerate the first non-empty object
-        for column in (old or new).keys():
-            if old and new:
-                if old[column] != new[column]:
-                    changes.append(('delete', column, old[column]))
-                    changes.append(('insert', column, new[column]))
-            elif old:
-                changes.append(('delete', column, old[column]))
-            elif new:
-                changes.append(('insert', column, new[column]))
-
-        stats_updates = []
-
-        # We don't support updating all the stats columns, for example, we can update counts,
-        # and we can update min/max when an addition sets a new min/max. But if we deleted
-        # a value that was a min/max, we can't know what the new min/max should be without
-        # scanning all the values, which we're not going to do.
-        for kind, column, value in changes:
-            # Try to mimic the SQL we use in the backfilling.
-            #
-            # Note: there is a semantic difference between:
-            # SELECT CASE WHEN json_valid(column) THEN json_type(column) == 'text' ELSE 0 END FROM table;
-            # and
-            # SELECT CASE WHEN json_valid('literal') THEN json_type('literal') == 'text' ELSE 0 END FROM table;
-            #
-            # In the former case, the json_type(...) is not evaluated eagerly. In the literal case,
-            # it is, meaning you will get a malformed JSON error.
-            #
-            # Instead, we do:
-            # SELECT json_type(CASE WHEN json_valid('literal') THEN 'literal' ELSE 0 END)
-            #
-            # This differs from the backfill SQL.
-            conn.execute('''
-    UPDATE dux_column_stats
-    SET
-      count = count + :delta,
-      nulls = CASE WHEN typeof(:value) == 'null' THEN nulls + :delta ELSE nulls END,
-      integers = CASE WHEN typeof(:value) == 'integer' THEN integers + :delta ELSE integers END,
-      reals = CASE WHEN typeof(:value) == 'real' THEN reals + :delta ELSE reals END,
-      blobs = CASE WHEN typeof(:value) == 'blob' THEN blobs + :delta ELSE blobs END,
-      texts = CASE WHEN typeof(:value) == 'text' THEN texts + :delta ELSE texts END,
-      json_strings = json_strings + CASE WHEN json_type(CASE WHEN json_valid(:value) THEN :value ELSE 0 END) = 'text' THEN :delta ELSE 0 END,
-      json_arrays = json_arrays + CASE WHEN json_type(CASE WHEN json_valid(:value) THEN :value ELSE 0 END) = 'array' THEN :delta ELSE 0 END,
-      json_objects = json_objects + CASE WHEN json_type(CASE WHEN json_valid(:value) THEN :value ELSE 0 END) = 'object' THEN :delta ELSE 0 END,
-      texts_whitespace = texts_whitespace + CASE WHEN typeof(:value) = 'text' AND :value LIKE '% %' THEN :delta ELSE 0 END,
-      texts_newline = texts_newline + CASE WHEN typeof(:value) = 'text' AND :value LIKE '%' || x'0a' || '%' THEN :delta ELSE 0 END,
-      texts_min_length = CASE WHEN typeof(:value) != 'text' OR :delta = -1 THEN texts_min_length
-        ELSE MIN(COALESCE(texts_min_length, length(:value)), length(:value)) END,
-      texts_max_length = CASE WHEN typeof(:value) != 'text' OR :delta = -1 THEN texts_max_length
-        ELSE MAX(COALESCE(texts_max_length, length(:value)), length(:value)) END,
-      blobs_min_length = CASE WHEN typeof(:value) != 'blob' OR :delta = -1 THEN blobs_min_length
-        ELSE MIN(COALESCE(blobs_min_length, length(:value)), length(:value)) END,
-      blobs_max_length = CASE WHEN typeof(:value) != 'blob' OR :delta = -1 THEN blobs_max_length
-        ELSE MAX(COALESCE(blobs_max_length, length(:value)), length(:value)) END,
-      min = CASE WHEN :delta = -1 OR typeof(:value) = 'blob' OR (typeof(:value) = 'text' AND LENGTH(:value) > 100) THEN min
-      ELSE min(coalesce(min, :value), :value) END,
-      max = CASE WHEN :delta = -1 OR typeof(:value) = 'blob' OR (typeof(:value) = 'text' AND LENGTH(:value) > 100) THEN max
-      ELSE max(coalesce(max, :value), :value) END
-
-    WHERE
-      table_id = (SELECT id FROM dux_ids WHERE name = :table)
-      AND column_id = (SELECT id FROM dux_ids WHERE name = :column)
-    ''', {
-        'delta': 1 if kind == 'insert' else -1,
-        'table': table,
-        'column': column,
-        'value': value
-    })
-            # Index the actual values, but only for strings, and only some strings.
-            # We don't index all string values - check if we should ignore this.
-            #
-            if isinstance(value, str):
-                items = [value]
-
-                try:
-                    # If this is a JSON-serialized array of strings, use those strings instead.
-                    maybe_items = json.loads(value)
-                    if isinstance(maybe_items, list):
-                        items = maybe_items
-                except:
-                    # Not a JSON array of strings.
-                    pass
-
-
-
-                for item in items:
-                    if is_ignored_string(item):
-                        continue
-
-                    # Compute the string and hash values for the lookup key.
-                    # This could be done in python, but I'm lazy.
-                    value_key, hash_key = list(conn.execute('SELECT substr(lower(:value), 1, 20), substr(md5(:value), 1, 8)', { 'value': item }))[0]
-                    #print('value_key={} hash_key={}'.format(value_key, hash_key))
-
-                    where = '''
-    table_id = (SELECT id FROM dux_ids WHERE name = :table)
-    AND column_id = (SELECT id FROM dux_ids WHERE name = :column)
-    AND value = :value_key
-    AND hash = :hash_key
-    '''
-
-                    where_args = {
-                        'value_key': value_key,
-                        'hash_key': hash_key,
-                        'table': table,
-                        'column': column,
-                    }
-
-                    if kind == 'delete':
-                        # 1) Get the pkey for the old row
-                        pk = {}
-                        for pk_column in pk_columns:
-                            pk[pk_column] = the_rowid if pk_column == 'rowid' else old[pk_column]
-
-                        old_row = list(conn.execute('SELECT count, pks FROM dux_column_stats_values WHERE {where}'.format(where = where), where_args))
-
-                        if not old_row:
-                            return
-
-                        old_row = old_row[0]
-                        # 4) Delete the entire row if count is now negative
-
-                        count, pks = old_row
-                        # 2) Decrement the count of old entries
-                        count -= 1
-                        # 3) Delete the old pkey from the list of pkeys
-                        pks = json.loads(pks)
-                        pks = [x for x in pks if x != pk]
-
-                        # 4) Delete the whole row if count <= 0.
-                        if count <= 0:
-                            conn.execute('DELETE FROM dux_column_stats_values WHERE {where}'.format(where=where), where_args)
-                        else:
-                            where_args['count'] = count
-                            where_args['pks'] = json.dumps(pks)
-                            conn.execute('UPDATE dux_column_stats_values SET count = :count, pks = :pks WHERE {where}'.format(where=where), where_args)
-
-                    elif kind == 'insert':
-                        # 1) Get the pkey for the new row
-                        pk = {}
-                        for pk_column in pk_columns:
-                            pk[pk_column] = the_rowid if pk_column == 'rowid' else new[pk_column]
-
-                        # 2) Ensure there is a row with 0 count and empty pkey array
-                        old_row = list(conn.execute('SELECT count, pks FROM dux_column_stats_values WHERE {where}'.format(where = where), where_args))
-
-                        count = 0
-                        pks = []
-                        if not old_row:
-                            # Insert the empty row
-                            where_args['count'] = 0
-                            where_args['pks'] = '[]'
-                            conn.execute('INSERT INTO dux_column_stats_values(table_id, column_id, value, hash, count, pks) VALUES ((SELECT id FROM dux_ids WHERE name = :table), (SELECT id FROM dux_ids WHERE name = :column), :value_key, :hash_key, :count, :pks)', where_args)
-
-                        else:
-                            old_row = old_row[0]
-                            # 4) Delete the entire row if count is now negative
-
-                            count, pks = old_row
-                            pks = json.loads(pks)
-
-                        # 3) Increment the coutn
-                        count += 1
-                        # 4) Insert the pkey
-                        pks = [x for x in pks if x != pk][0:9] + [pk]
-
-                        where_args['count'] = count
-                        where_args['pks'] = json.dumps(pks)
-                        conn.execute('UPDATE dux_column_stats_values SET count = :count, pks = :pks WHERE {where}'.format(where=where), where_args)
-
-
-
-
-        conn.execute('DELETE FROM dux_pending_rows WHERE id = :id', [id])
+        # Sub-batches often touch the same prefixes, so we update them once.
+        update_prefix_tops(conn, counts)
+
+        # Last, as it's the only write to the main database when there's a sidecar.
+        conn.execute('DELETE FROM dux_pending_rows WHERE id >= ? AND id <= ?', [first_id, last_id])
         return True
 
-def is_ignored_string(value):
-    # from the SQL backfill code:
-    # WHERE typeof(value) == 'text' AND length(value) <= 100 and not (value >= '1800-01-01' and value <= '9999-12-31') and not value like 'http://%' and not value like 'https://%' and cast(cast(value as integer) as text) != value and not (value like '[%' and json_valid(value))
+def apply_pending_rows(conn, pending, lookups, touched=None, counts=None):
+    # Index some entries from dux_pending_rows. Summary stats are accumulated in
+    # Python and applied with one UPDATE per touched column.
+    #
+    # lookups caches ids, pk columns and policies between calls. If counts is
+    # given, it's passed to apply_value_index_deltas.
+    ids = lookups['ids']
+    pk_columns_by_table = lookups['pk_columns_by_table']
+    policies = lookups['policies']
+    stats_by_column = {}
+    partial_stats_by_column = {}
+    backfills_by_table = {}
+    value_changes = []
+    value_pks = []
+    value_deltas = {}
+
+    # Collapse the entries for each row into a single net change, so that
+    # a row updated 50 times costs one diff, not 50.
+    changed_rows = {}
+    for id, the_rowid, table, old, new, format in pending:
+        if not table in pk_columns_by_table:
+            pk_columns_by_table[table] = get_pk_columns(conn, table)
+
+        coalesce_row_change(changed_rows, pk_columns_by_table[table], the_rowid, table, fixup(old, format), fixup(new, format))
+
+    for the_rowid, table, old, new in changed_rows.values():
+        table_id = lookup_id(conn, ids, table)
+        if table_id is None:
+            continue
+
+        pk_columns = pk_columns_by_table[table]
+
+        if not table_id in backfills_by_table:
+            backfills_by_table[table_id] = get_backfills(conn, table_id, pk_columns)
+        backfills = backfills_by_table[table_id]
+
+        for kind, column, value in get_row_changes(old, new):
+            column_id = lookup_id(conn, ids, column)
+            if column_id is None:
+                continue
+
+            key = (table_id, column_id)
+            if not key in policies:
+                policies[key] = lookup_column_policy(conn, table_id, column_id)
+
+            # Columns without an ops row aren't indexed, see get_column_policy.
+            if policies[key] is None:
+                continue
+
+            row = old if kind == 'delete' else new
+            pk = {}
+            for pk_column in pk_columns:
+                pk[pk_column] = the_rowid if pk_column == 'rowid' else row[pk_column]
+
+            # A column that's being backfilled only takes changes to rows the backfill
+            # has already scanned. It will see the others as they are when it gets there.
+            backfill = backfills.get(column_id, None)
+            if backfill is not None and not is_backfilled(pk_columns, pk, backfill[0]):
+                continue
+
+            keep_stats, keep_values, max_length, key_length = policies[key]
+            if keep_stats:
+                if not key in stats_by_column:
+                    stats_by_column[key] = new_stats()
+
+                add_value_to_stats(stats_by_column[key], value, 1 if kind == 'insert' else -1)
+
+                # The backfill of an estimated column accumulates its exact stats in
+                # partial_stats, which replace the estimate when it's done, so they
+                # get the change too.
+                if backfill is not None and backfill[1]:
+                    if not key in partial_stats_by_column:
+                        partial_stats_by_column[key] = new_stats()
+
+                    add_value_to_stats(partial_stats_by_column[key], value, 1 if kind == 'insert' else -1)
+
+            # Index the actual values, but only for strings, and only some strings.
+            if not keep_values or not isinstance(value, str):
+                continue
+
+            value_changes.append((table_id, column_id, kind, value, max_length, key_length))
+            value_pks.append(pk)
+
+    for (table_id, column_id, kind, value, max_length, key_length), pk in zip(value_changes, render_pks(conn, value_pks)):
+        add_value_index_deltas(value_deltas, table_id, column_id, kind, value, pk, max_length, key_length)
+
+    for (table_id, column_id), stats in stats_by_column.items():
+        merge_column_stats(conn, table_id, column_id, stats)
+
+    apply_value_index_deltas(conn, value_deltas, counts)
+    if touched is not None:
+        touched.update(value_deltas.keys())
+
+    for (table_id, column_id), stats in partial_stats_by_column.items():
+        merge_partial_stats(conn, table_id, column_id, stats)
+
+def get_backfills(conn, table_id, pk_columns):
+    # The columns of a table that are being backfilled, mapped to (last_key, estimated),
+    # where last_key is the pk_sort_key of the last row the backfill scanned, or
+    # None if it hasn't started.
+    rows = conn.execute('SELECT ops.column_id, ops.last_key, stats.estimated FROM dux_column_stats_ops ops LEFT JOIN dux_column_stats stats USING (table_id, column_id) WHERE ops.table_id = ? AND ops.pending', [table_id]).fetchall()
+
+    rv = {}
+    for column_id, last_key, estimated in rows:
+        last_key = json.loads(last_key)
+        rv[column_id] = (pk_sort_key(pk_columns, last_key) if last_key else None, bool(estimated))
+
+    return rv
+
+def pk_sort_key(pk_columns, pk):
+    # Order pks the way fetch_backfill_chunk does: NULLs, then numbers, then text.
+    return tuple([(-1, 0) if pk[pk_column] is None else sqlite_sort_key(pk[pk_column]) for pk_column in pk_columns])
+
+def is_backfilled(pk_columns, pk, last_key):
+    # Whether the row with this pk is at or before last_key, from get_backfills.
+    return last_key is not None and pk_sort_key(pk_columns, pk) <= last_key
+
+def merge_partial_stats(conn, table_id, column_id, stats):
+    partial_stats = conn.execute('SELECT partial_stats FROM dux_column_stats_ops WHERE table_id = ? AND column_id = ?', [table_id, column_id]).fetchone()[0]
+    if partial_stats:
+        stats = merge_stats(json.loads(partial_stats), stats)
+
+    conn.execute('UPDATE dux_column_stats_ops SET partial_stats = ? WHERE table_id = ? AND column_id = ?', [json.dumps(stats), table_id, column_id])
+
+def lookup_column_policy(conn, table_id, column_id):
+    row = conn.execute('SELECT stats, value_index, max_length, key_length FROM dux_column_stats_ops WHERE table_id = ? AND column_id = ?', [table_id, column_id]).fetchone()
+
+    if not row:
+        return None
+
+    return bool(row[0]), bool(row[1]), row[2], row[3]
+
+# Values are keyed by their folded text, so that autosuggest ignores case and
+# accents, truncated to the column's key-length. Columns with a key_length of 0
+# still have the original keys, substr(lower(value), 1, 20), until
+# rekey_value_index replaces them.
+ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+LEGACY_KEY_LENGTH = 20
+
+def fold_text(text):
+    # Casefold and strip accents, so that 'École', 'ECOLE' and 'ecole' all fold to 'ecole'.
+    if text.isascii():
+        return text.lower()
+
+    text = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join([c for c in text if not unicodedata.combining(c)]).casefold()
+
+def fold_key(text, key_length):
+    if not key_length:
+        # SQLite's lower() only folds ASCII characters.
+        return text.translate(ASCII_LOWER)
+
+    return fold_text(text)
+
+def indexed_length(key_length):
+    return key_length or LEGACY_KEY_LENGTH
+
+def value_index_key(item, key_length=DEFAULT_KEY_LENGTH):
+    # The hash is the Python equivalent of substr(md5(item), 1, 8).
+    return fold_key(item, key_length)[0:indexed_length(key_length)], hashlib.md5(item.encode('utf-8')).digest()[0:8]
+
+def rekey_value_index(conn, table, column, table_id, column_id, key_length):
+    # Key a column's entries for a new key_length, keeping their counts and pks.
+    # Their prefixes and trigrams refer to the old keys, so they're dropped, to
+    # be rebuilt by ensure_prefix_tops and ensure_trigrams.
+    #
+    # This runs in ensure_empty_rows_for_db's transaction, so we read the entries
+    # with one query and rewrite them with one UPDATE, rather than entry by entry.
+    # Folding happens in Python, so the new keys are computed here.
+    entries = conn.execute('SELECT rowid, hash, pks, display FROM dux_column_stats_values WHERE table_id = ? AND column_id = ?', [table_id, column_id]).fetchall()
+
+    # Entries from before we stored display values only have an index key, so we
+    # fetch the actual value from the underlying table, as autosuggest_column does.
+    displays = {}
+    if any([display is None for rowid, hash, pks, display in entries]):
+        displays = lookup_display_values(conn, table, column, table_id, column_id)
+
+    rows = []
+    for rowid, hash, pks, display in entries:
+        if display is None:
+            display = displays.get(rowid, None)
+
+        # If we can't, leave the column on its current keys, which autosuggest
+        # still understands, rather than lose its values.
+        if display is None:
+            return
+
+        rows.append([rowid, value_index_key(display, key_length)[0], display])
+
+    conn.execute('DELETE FROM dux_column_stats_prefixes WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+    conn.execute('DELETE FROM dux_column_stats_trigrams WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+    # An entry's hash is derived from its display value, as is its new key, so
+    # no entry's new key can collide with another's old key.
+    conn.execute(
+        "UPDATE dux_column_stats_values SET value = json_extract(k.value, '$[1]'), display = json_extract(k.value, '$[2]') FROM json_each(?) k WHERE dux_column_stats_values.rowid = json_extract(k.value, '$[0]')",
+        [json.dumps(rows)]
+    )
+    conn.execute('UPDATE dux_column_stats_ops SET key_length = ? WHERE table_id = ? AND column_id = ?', [key_length, table_id, column_id])
+
+def render_pks(conn, pks):
+    # Render pks as JSON the way json_object does in fetch_backfill_chunk, so that
+    # the pks we add and remove match the ones the backfill stored. Python's json
+    # module doesn't format reals the way SQLite does, eg 1e+20 for 1.0e+20.
+    if not pks:
+        return []
+
+    return [row[0] for row in conn.execute(
+        'SELECT (SELECT json_group_object(field.key, field.value) FROM json_each(pk.value) field) FROM json_each(?) pk ORDER BY pk.key',
+        [json.dumps(pks)]
+    )]
+
+def indexable_items(value, max_length=DEFAULT_MAX_LENGTH):
+    items = [value]
+
+    if might_be_json(value, '['):
+        try:
+            # If this is a JSON-serialized array of strings, use those strings instead.
+            maybe_items = json.loads(value)
+            if isinstance(maybe_items, list):
+                items = maybe_items
+        except:
+            # Not a JSON array of strings.
+            pass
+
+    # We don't index all string values - check if we should ignore this.
+    return [item for item in items if isinstance(item, str) and not is_ignored_string(item, max_length)]
+
+def add_value_index_deltas(deltas, table_id, column_id, kind, value, pk, max_length=DEFAULT_MAX_LENGTH, key_length=DEFAULT_KEY_LENGTH):
+    # Accumulate the changes to dux_column_stats_values implied by inserting or deleting
+    # `value`. For each key, we track the net count and the last operation per pk.
+    #
+    # pk is the row's primary key, as a JSON string.
+    for item in indexable_items(value, max_length):
+        value_key, hash_key = value_index_key(item, key_length)
+        key = (table_id, column_id, value_key, hash_key)
+
+        entry = deltas.get(key, None)
+        if not entry:
+            entry = {'count': 0, 'pks': {}, 'trim_at': MIN_PKS_TRIM_AT, 'display': item}
+            deltas[key] = entry
+
+        entry['count'] += 1 if kind == 'insert' else -1
+        # Re-insert so that iteration order reflects the most recent operation.
+        entry['pks'].pop(pk, None)
+        entry['pks'][pk] = kind == 'insert'
+
+        if len(entry['pks']) >= entry['trim_at']:
+            trim_value_index_pks(entry)
+
+# Only the 10 most recently added pks are kept, so we drop older ones as we go.
+# Removals are always kept. We trim when pks doubles in size, so the cost of
+# trimming is amortized across additions.
+MIN_PKS_TRIM_AT = 20
+
+def trim_value_index_pks(entry):
+    added = [pk for pk, present in entry['pks'].items() if present]
+    for pk in added[:-10]:
+        del entry['pks'][pk]
+
+    entry['trim_at'] = max(MIN_PKS_TRIM_AT, len(entry['pks']) * 2)
+
+def merge_value_index_deltas(deltas, more_deltas):
+    # Fold more_deltas, from add_value_index_deltas, into deltas, as if they had
+    # been accumulated together.
+    for key, more_entry in more_deltas.items():
+        entry = deltas.get(key, None)
+        if not entry:
+            deltas[key] = more_entry
+            continue
+
+        entry['count'] += more_entry['count']
+        for pk, present in more_entry['pks'].items():
+            entry['pks'].pop(pk, None)
+            entry['pks'][pk] = present
+
+        if len(entry['pks']) >= entry['trim_at']:
+            trim_value_index_pks(entry)
+
+# Merges a batch of changes into dux_column_stats_values:
+# - count is adjusted by the delta
+# - display is filled in, if it was missing
+# - pks is the most recent :added pks, topped up to 10 with the existing pks,
+#   less any that were :removed
+UPSERT_VALUE_INDEX_SQL = '''
+INSERT INTO dux_column_stats_values(table_id, column_id, value, hash, count, pks, display)
+VALUES (:table_id, :column_id, :value, :hash, :count, :added, :display)
+ON CONFLICT(table_id, column_id, value, hash) DO UPDATE SET
+  count = count + excluded.count,
+  display = coalesce(display, excluded.display),
+  pks = (
+    SELECT json_group_array(json(merged.value)) FROM (
+      SELECT value FROM (
+        SELECT existing.value FROM json_each(dux_column_stats_values.pks) existing
+        WHERE existing.value NOT IN (SELECT removed.value FROM json_each(:removed) removed)
+        AND existing.value NOT IN (SELECT added.value FROM json_each(:added) added)
+        LIMIT max(0, 10 - json_array_length(:added))
+      )
+      UNION ALL
+      SELECT added.value FROM json_each(:added) added
+    ) merged
+  )
+RETURNING count
+'''
+
+DELETE_EMPTY_VALUE_INDEX_SQL = '''
+DELETE FROM dux_column_stats_values
+WHERE table_id = :table_id AND column_id = :column_id AND value = :value AND hash = :hash AND count <= 0
+'''
+
+def upsert_value_index(conn, rows):
+    # rows is a list of dicts with keys table_id, column_id, value, hash, count, added, removed and display.
+    # Visiting them in primary key order keeps the b-tree writes local.
+    #
+    # Returns the new count of each entry, keyed by (table_id, column_id, value, hash),
+    # with 0 for those that were deleted. executemany can't return rows, so we
+    # run the upsert row by row.
+    rows = sorted(rows, key=lambda row: (row['table_id'], row['column_id'], row['value'], row['hash']))
+    counts = {}
+    empty = []
+    for row in rows:
+        count = conn.execute(UPSERT_VALUE_INDEX_SQL, row).fetchone()[0]
+        if count <= 0:
+            empty.append(row)
+            count = 0
+
+        counts[(row['table_id'], row['column_id'], row['value'], row['hash'])] = count
+
+    conn.executemany(DELETE_EMPTY_VALUE_INDEX_SQL, empty)
+    return counts
+
+def apply_value_index_deltas(conn, deltas, counts=None):
+    # If counts is given, the new counts of the entries are added to it, for the
+    # caller to pass to update_prefix_tops later, rather than updating them now.
+    rows = []
+    for (table_id, column_id, value, hash), entry in deltas.items():
+        added = [pk for pk, present in entry['pks'].items() if present][-10:]
+        removed = [pk for pk, present in entry['pks'].items() if not present]
+
+        rows.append({
+            'table_id': table_id,
+            'column_id': column_id,
+            'value': value,
+            'hash': hash,
+            'count': entry['count'],
+            'added': '[' + ','.join(added) + ']',
+            'removed': '[' + ','.join(removed) + ']',
+            'display': entry['display'],
+        })
+
+    new_counts = upsert_value_index(conn, rows)
+    update_trigrams(conn, deltas, new_counts)
+
+    if counts is None:
+        update_prefix_tops(conn, new_counts)
+    else:
+        counts.update(new_counts)
+
+# Short prefixes match so many values that the first AUTOSUGGEST_WINDOW of them,
+# in alphabetical order, are unlikely to include the most common ones. So for
+# prefixes of up to PREFIX_LENGTH characters, we keep the most common values that
+# start with them in dux_column_stats_prefixes. We keep more than AUTOSUGGEST_LIMIT,
+# so that when counts change, we can usually fix up the list without a rescan.
+PREFIX_LENGTH = 2
+PREFIX_TOP_SIZE = 20
+
+def get_prefixes(value):
+    return [value[0:i] for i in range(1, min(len(value), PREFIX_LENGTH) + 1)]
+
+def compute_prefix_top(conn, table_id, column_id, prefix):
+    # Returns the most common entries that start with prefix, as [value, hex(hash), count],
+    # and the count of the next most common.
+    rows = conn.execute(
+        "SELECT value, hex(hash), count FROM dux_column_stats_values WHERE table_id = ? AND column_id = ? AND value >= ? AND value < ? || x'ffffffff' ORDER BY count DESC, value, hash LIMIT ?",
+        [table_id, column_id, prefix, prefix, PREFIX_TOP_SIZE + 1]
+    ).fetchall()
+
+    top = [list(row) for row in rows[0:PREFIX_TOP_SIZE]]
+    floor = rows[PREFIX_TOP_SIZE][2] if len(rows) > PREFIX_TOP_SIZE else 0
+    return top, floor
+
+def compute_prefix_tops(entries, length):
+    # Like compute_prefix_top, for every prefix of the given length at once. entries
+    # are (value, hash, count, ...) in index order. Yields (prefix, top, floor).
+    long_enough = (entry for entry in entries if len(entry[0]) >= length)
+    for prefix, group in itertools.groupby(long_enough, key=lambda entry: entry[0][0:length]):
+        rows = heapq.nsmallest(PREFIX_TOP_SIZE + 1, group, key=lambda entry: (-entry[2], entry[0], entry[1]))
+        top = [[entry[0], entry[1], entry[2]] for entry in rows[0:PREFIX_TOP_SIZE]]
+        floor = rows[PREFIX_TOP_SIZE][2] if len(rows) > PREFIX_TOP_SIZE else 0
+        yield prefix, top, floor
+
+def rebuild_prefix_tops(conn, table_id, column_id):
+    # Replace a column's prefix tops, with one pass over its entries per prefix length.
+    conn.execute('DELETE FROM dux_column_stats_prefixes WHERE table_id = ? AND column_id = ?', [table_id, column_id])
+    for length in range(1, PREFIX_LENGTH + 1):
+        entries = conn.execute('SELECT value, hex(hash), count FROM dux_column_stats_values WHERE table_id = ? AND column_id = ? ORDER BY value, hash', [table_id, column_id])
+        set_prefix_tops(conn, [(table_id, column_id, prefix, top, floor) for prefix, top, floor in compute_prefix_tops(entries, length)])
+
+def is_prefix_top_complete(top, floor):
+    # The first AUTOSUGGEST_LIMIT entries are right if nothing outside top could beat them.
+    if len(top) < AUTOSUGGEST_LIMIT:
+        return floor == 0
+
+    return top[AUTOSUGGEST_LIMIT - 1][2] >= floor
+
+def update_prefix_top(top, floor, counts):
+    # counts maps (value, hex(hash)) to the new count of each entry that changed.
+    #
+    # Every entry that isn't in top has a count of at most floor. So an entry whose
+    # count rises above floor must join top, and an entry that drops off the end
+    # of top raises floor.
+    entries = dict([((entry[0], entry[1]), entry) for entry in top])
+    for key, count in counts.items():
+        if key in entries:
+            entries[key][2] = count
+            if count <= 0:
+                del entries[key]
+        elif count > floor:
+            entries[key] = [key[0], key[1], count]
+
+    top = sorted(entries.values(), key=lambda entry: (-entry[2], entry[0], entry[1]))
+    for entry in top[PREFIX_TOP_SIZE:]:
+        floor = max(floor, entry[2])
+
+    return top[0:PREFIX_TOP_SIZE], floor
+
+def update_prefix_tops(conn, counts):
+    # Bring dux_column_stats_prefixes up to date. counts maps the (table_id, column_id, value, hash)
+    # of the dux_column_stats_values entries whose counts have changed to their
+    # new counts, as returned by upsert_value_index.
+    #
+    # Columns that are being backfilled are skipped: it's cheaper to rebuild their
+    # prefix tops once the backfill is done, see merge_backfill_plan.
+    #
+    # An entry in top whose count goes up can only move up, so we leave top alone
+    # and let its stored count lag behind. Autosuggest orders by the counts in
+    # dux_column_stats_values, so the stored counts only matter here, and we
+    # refresh them before we rewrite a top.
+    if not counts:
+        return
+
+    backfills = set([tuple(row) for row in conn.execute('SELECT table_id, column_id FROM dux_column_stats_ops WHERE pending')])
+
+    counts_by_column = {}
+    for (table_id, column_id, value, hash), count in counts.items():
+        if (table_id, column_id) in backfills:
+            continue
+
+        for prefix in get_prefixes(value):
+            counts_by_column.setdefault((table_id, column_id), {}).setdefault(prefix, {})[(value, hash.hex().upper())] = count
+
+    # Read each column's prefixes in one go, and write them all at once, rather
+    # than one by one.
+    tops = []
+    for (table_id, column_id), counts_by_prefix in counts_by_column.items():
+        rows = conn.execute(
+            'SELECT p.prefix, p.top, p.floor FROM json_each(?) k CROSS JOIN dux_column_stats_prefixes p ON p.table_id = ? AND p.column_id = ? AND p.prefix = k.value',
+            [json.dumps(list(counts_by_prefix.keys())), table_id, column_id]
+        ).fetchall()
+        existing = dict([(row[0], (json.loads(row[1]), row[2])) for row in rows])
+
+        changed = []
+        for prefix, prefix_counts in counts_by_prefix.items():
+            if not prefix in existing:
+                tops.append((table_id, column_id, prefix, *compute_prefix_top(conn, table_id, column_id, prefix)))
+                continue
+
+            top, floor = existing[prefix]
+            stored = dict([((entry[0], entry[1]), entry[2]) for entry in top])
+            if all([count >= stored[key] if key in stored else count <= floor for key, count in prefix_counts.items()]):
+                continue
+
+            changed.append(prefix)
+
+        current = get_prefix_top_counts(conn, table_id, column_id, [existing[prefix][0] for prefix in changed])
+        for prefix in changed:
+            top, floor = existing[prefix]
+            prefix_counts = dict([((entry[0], entry[1]), current.get((entry[0], entry[1]), 0)) for entry in top])
+            prefix_counts.update(counts_by_prefix[prefix])
+            top, floor = update_prefix_top(top, floor, prefix_counts)
+
+            # If we've lost track of what's most common, start over.
+            if not is_prefix_top_complete(top, floor):
+                top, floor = compute_prefix_top(conn, table_id, column_id, prefix)
+
+            tops.append((table_id, column_id, prefix, top, floor))
+
+    set_prefix_tops(conn, tops)
+
+def get_prefix_top_counts(conn, table_id, column_id, tops):
+    # Returns the current counts of the entries in tops, keyed by (value, hex(hash)).
+    values = sorted(set([entry[0] for top in tops for entry in top]))
+    if not values:
+        return {}
+
+    rows = conn.execute(
+        'SELECT v.value, hex(v.hash), v.count FROM json_each(?) k CROSS JOIN dux_column_stats_values v ON v.table_id = ? AND v.column_id = ? AND v.value = k.value',
+        [json.dumps(values), table_id, column_id]
+    ).fetchall()
+    return dict([((row[0], row[1]), row[2]) for row in rows])
+
+def set_prefix_tops(conn, tops):
+    # tops is a list of (table_id, column_id, prefix, top, floor). Prefixes with an empty top are deleted.
+    deleted = [[table_id, column_id, prefix] for table_id, column_id, prefix, top, floor in tops if not top]
+    if deleted:
+        conn.executemany('DELETE FROM dux_column_stats_prefixes WHERE table_id = ? AND column_id = ? AND prefix = ?', deleted)
+
+    upserted = [[table_id, column_id, prefix, json.dumps(top), floor] for table_id, column_id, prefix, top, floor in tops if top]
+    if upserted:
+        conn.executemany(
+            'INSERT INTO dux_column_stats_prefixes(table_id, column_id, prefix, top, floor) VALUES (?, ?, ?, ?, ?) ON CONFLICT(table_id, column_id, prefix) DO UPDATE SET top = excluded.top, floor = excluded.floor',
+            upserted
+        )
+
+def ensure_prefix_tops(conn):
+    # Fill in dux_column_stats_prefixes for columns that have values, but no
+    # prefixes, like those indexed before we kept them. Columns that are being
+    # backfilled get theirs when it's done.
+    columns = conn.execute('''
+SELECT table_id, column_id FROM dux_column_stats_ops ops
+WHERE value_index AND NOT pending
+AND EXISTS(SELECT * FROM dux_column_stats_values v WHERE v.table_id = ops.table_id AND v.column_id = ops.column_id)
+AND NOT EXISTS(SELECT * FROM dux_column_stats_prefixes p WHERE p.table_id = ops.table_id AND p.column_id = ops.column_id)
+''').fetchall()
+
+    for table_id, column_id in columns:
+        rebuild_prefix_tops(conn, table_id, column_id)
+
+# Prefix search can't find "smith" in "John Smith". For columns with the trigrams
+# indexing policy, dux_column_stats_trigrams maps every three consecutive characters
+# of each entry's display value to the entry, so that autosuggest can find the
+# entries that contain a query of at least TRIGRAM_LENGTH characters, see
+# autosuggest_trigrams.
+TRIGRAM_LENGTH = 3
+
+def trigram_key(item):
+    return fold_text(item)
+
+def get_trigrams(item):
+    key = trigram_key(item)
+    return sorted(set([key[i:i + TRIGRAM_LENGTH] for i in range(len(key) - TRIGRAM_LENGTH + 1)]))
+
+def lookup_column_trigrams(conn, table_id, column_id):
+    row = conn.execute('SELECT trigrams FROM dux_column_stats_ops WHERE table_id = ? AND column_id = ?', [table_id, column_id]).fetchone()
+    return bool(row and row[0])
+
+def update_trigrams(conn, deltas, counts):
+    # Entries get their trigrams when they're added to dux_column_stats_values, and
+    # lose them when they're deleted. Changes to the counts of existing entries
+    # don't affect them. counts are the new counts, from upsert_value_index.
+    trigrams_by_column = {}
+    added = []
+    removed = []
+    for (table_id, column_id, value, hash), entry in deltas.items():
+        if not (table_id, column_id) in trigrams_by_column:
+            trigrams_by_column[(table_id, column_id)] = lookup_column_trigrams(conn, table_id, column_id)
+
+        if not trigrams_by_column[(table_id, column_id)]:
+            continue
+
+        count = counts[(table_id, column_id, value, hash)]
+
+        # Empty entries are deleted, so if the count is all ours, the entry is new.
+        if count <= 0:
+            postings = removed
+        elif count == entry['count']:
+            postings = added
+        else:
+            continue
+
+        for trigram in get_trigrams(entry['display']):
+            postings.append([table_id, column_id, trigram, value, hash])
+
+    conn.executemany('INSERT OR IGNORE INTO dux_column_stats_trigrams(table_id, column_id, trigram, value, hash) VALUES (?, ?, ?, ?, ?)', sorted(added))
+    conn.executemany('DELETE FROM dux_column_stats_trigrams WHERE table_id = ? AND column_id = ? AND trigram = ? AND value = ? AND hash = ?', sorted(removed))
+
+def ensure_trigrams(conn):
+    # Fill in dux_column_stats_trigrams for columns that have values, but no trigrams,
+    # like those whose policy just turned them on. Entries from before we stored
+    # display values are skipped.
+    columns = conn.execute('''
+SELECT table_id, column_id FROM dux_column_stats_ops ops
+WHERE value_index AND trigrams
+AND EXISTS(SELECT * FROM dux_column_stats_values v WHERE v.table_id = ops.table_id AND v.column_id = ops.column_id)
+AND NOT EXISTS(SELECT * FROM dux_column_stats_trigrams t WHERE t.table_id = ops.table_id AND t.column_id = ops.column_id)
+''').fetchall()
+
+    for table_id, column_id in columns:
+        postings = []
+        for value, hash, display in conn.execute('SELECT value, hash, display FROM dux_column_stats_values WHERE table_id = ? AND column_id = ? AND display IS NOT NULL', [table_id, column_id]):
+            for trigram in get_trigrams(display):
+                postings.append([table_id, column_id, trigram, value, hash])
+
+        conn.executemany('INSERT OR IGNORE INTO dux_column_stats_trigrams(table_id, column_id, trigram, value, hash) VALUES (?, ?, ?, ?, ?)', sorted(postings))
+
+def is_ignored_string(value, max_length=DEFAULT_MAX_LENGTH):
+    # We don't index long strings, dates, URLs, integers or JSON arrays.
     if not isinstance(value, str):
         return False
 
+    if len(value) > max_length:
+        return True
+
     if value >= '1800-01-01' and value <= '9999-12-31':
         return True
 
@@ -485,197 +1880,184 @@ def is_ignored_string(value):
 
     return False
 
-def update_distincts(conn, table_id, column_id, sql, where_args):
-    # Fetch and update distinct values
-    distincts_sql = '''
-WITH xs AS ({}),
-distincts AS (
-SELECT
-  substr(lower(value), 1, 20) AS value,
-  substr(md5(value), 1, 8) AS hash,
-  count(*) as count,
-  json_group_array(json(key)) AS keys
-FROM xs
-WHERE typeof(value) == 'text' AND length(value) <= 100 and not (value >= '1800-01-01' and value <= '9999-12-31') and not value like 'http://%' and not value like 'https://%' and cast(cast(value as integer) as text) != value and not (value like '[%' and json_valid(value))
-GROUP BY 1, 2
-ORDER BY 3 DESC
-)
-SELECT value, hash, count, (select json_group_array(json(value)) from (select value from json_each(keys) limit 10)) AS keys
-FROM distincts
-'''.format(sql)
-
-    distincts = conn.execute(distincts_sql, where_args).fetchall()
-
-    for value, hash, count, pks in distincts:
-        pks = json.loads(pks)
-        exists = conn.execute('SELECT pks FROM dux_column_stats_values WHERE table_id = ? and column_id = ? AND value = ? AND hash = ?', [table_id, column_id, value, hash]).fetchone()
-
-        new_pks = []
-        if exists:
-            new_pks = json.loads(exists[0])
-        else:
-            conn.execute("INSERT INTO dux_column_stats_values(table_id, column_id, value, hash, count, pks) VALUES (?, ?, ?, ?, 0, '[]')", [table_id, column_id, value, hash]).fetchall()
-
-        new_pks = [pk for pk in new_pks if not pk in pks]
-        new_pks = new_pks[0:10 - len(pks)]
-        new_pks = new_pks + pks
-
-        conn.execute("UPDATE dux_column_stats_values SET count = count + ?, pks = ? WHERE table_id = ? AND column_id = ? AND value = ? AND hash = ?", [count, json.dumps(new_pks), table_id, column_id, value, hash]).fetchall()
-
-def update_json_distincts(conn, table_id, column_id, sql, where_args):
-    # Fetch and update distinct values from JSON string arrays
-    json_distincts_sql = '''
-WITH raw_xs AS ({}),
-array_xs AS (SELECT key, value FROM raw_xs WHERE json_valid(value) AND json_type(value) = 'array'),
-xs AS (SELECT array_xs.key, js_value.value FROM array_xs, json_each(array_xs.value) js_value),
-distincts AS (
-SELECT
-  substr(lower(value), 1, 20) AS value,
-  substr(md5(value), 1, 8) AS hash,
-  count(*) as count,
-  json_group_array(json(key)) AS keys
-FROM xs
-WHERE typeof(value) == 'text' AND length(value) <= 100 and not (value >= '1800-01-01' and value <= '9999-12-31') and not value like 'http://%' and not value like 'https://%' and cast(cast(value as integer) as text) != value and not (value like '[%' and json_valid(value))
-GROUP BY 1, 2
-ORDER BY 3 DESC
-)
-SELECT value, hash, count, (select json_group_array(json(value)) from (select value from json_each(keys) limit 10)) AS keys
-FROM distincts
-'''.format(sql)
+# Consider max 100 things before sorting - gives generally good results, and is defensive
+# against someone autocompleting the empty string
+AUTOSUGGEST_WINDOW = 100
+AUTOSUGGEST_LIMIT = 10
 
-    distincts = conn.execute(json_distincts_sql, where_args).fetchall()
+def autosuggest_query_key(q, key_length=DEFAULT_KEY_LENGTH):
+    # Queries are folded like the values, see value_index_key, but not truncated.
+    return fold_key(q, key_length)
 
-    for value, hash, count, pks in distincts:
-        pks = json.loads(pks)
-        exists = conn.execute('SELECT pks FROM dux_column_stats_values WHERE table_id = ? and column_id = ? AND value = ? AND hash = ?', [table_id, column_id, value, hash]).fetchone()
+def lookup_autosuggest_column(conn, table, column):
+    # Returns (table_id, column_id, key_length, trigrams) for a column with a value index, or None.
+    row = conn.execute('SELECT table_id, column_id, key_length, trigrams FROM dux_column_stats_ops WHERE table_id = (SELECT id FROM dux_ids WHERE name = ?) AND column_id = (SELECT id FROM dux_ids WHERE name = ?) AND value_index', [table, column]).fetchone()
 
-        new_pks = []
-        if exists:
-            new_pks = json.loads(exists[0])
-        else:
-            conn.execute("INSERT INTO dux_column_stats_values(table_id, column_id, value, hash, count, pks) VALUES (?, ?, ?, ?, 0, '[]')", [table_id, column_id, value, hash]).fetchall()
-
-        new_pks = [pk for pk in new_pks if not pk in pks]
-        new_pks = new_pks[0:10 - len(pks)]
-        new_pks = new_pks + pks
-
-        conn.execute("UPDATE dux_column_stats_values SET count = count + ?, pks = ? WHERE table_id = ? AND column_id = ? AND value = ? AND hash = ?", [count, json.dumps(new_pks), table_id, column_id, value, hash]).fetchall()
-
-def update_summary_stats(conn, table_id, column_id, sql, where_args):
-    # Fetch and update summary stats
-    summary_stats = list(conn.execute('''
-WITH xs AS ({})
-SELECT
-  min(case when typeof(value) == 'blob' or (typeof(value) == 'text' and length(value) > 100) then null else value end) as min,
-  max(case when typeof(value) == 'blob' or (typeof(value) == 'text' and length(value) > 100) then null else value end) as max,
-  count(*) as count,
-  count(*) filter (where typeof(value) == 'null') as nulls,
-  count(*) filter (where typeof(value) == 'integer') as integers,
-  count(*) filter (where typeof(value) == 'real') as reals,
-  count(*) filter (where typeof(value) == 'text') as texts,
-  count(*) filter (where typeof(value) == 'blob') as blobs,
-  coalesce(sum(case when json_valid(value) then json_type(value) = 'text' else 0 end), 0) as json_strings,
-  coalesce(sum(case when json_valid(value) then json_type(value) = 'array' else 0 end), 0) as json_arrays,
-  coalesce(sum(case when json_valid(value) then json_type(value) = 'object' else 0 end), 0) as json_objects,
-  min(length(value)) filter (where typeof(value) == 'text') as texts_min_length,
-  max(length(value)) filter (where typeof(value) == 'text') as texts_max_length,
-  coalesce(sum(case when typeof(value) == 'text' and value like '% %' then 1 else 0 end), 0) as texts_whitespace,
-  coalesce(sum(case when typeof(value) == 'text' and value like '%' || x'0a' || '%' then 1 else 0 end), 0) as texts_newline,
-  min(length(value)) filter (where typeof(value) == 'blob') as blobs_min_length,
-  max(length(value)) filter (where typeof(value) == 'blob') as blobs_max_length
-FROM xs
-'''.format(sql), where_args))
-
-    # texts_whitespace, texts_newline
-    if summary_stats:
-        summary_stats = summary_stats[0]
-        #print('jsons={}'.format(summary_stats['jsons']))
-        conn.execute('''
-    UPDATE dux_column_stats SET
-        count = count + :count,
-        max = CASE WHEN max IS NULL THEN :max ELSE max(max, :max) END,
-        min = CASE WHEN min IS NULL THEN :min ELSE min(min, :min) END,
-        nulls = nulls + :nulls,
-        integers = integers + :integers,
-        reals = reals + :reals,
-        texts = texts + :texts,
-        blobs = blobs + :blobs,
-        json_strings = json_strings + :json_strings,
-        json_arrays = json_arrays + :json_arrays,
-        json_objects = json_objects + :json_objects,
-        texts_min_length = CASE WHEN texts_min_length IS NULL THEN :texts_min_length ELSE min(texts_min_length, :texts_min_length) END,
-        texts_max_length = CASE WHEN texts_max_length IS NULL THEN :texts_max_length ELSE max(texts_max_length, :texts_max_length) END,
-        blobs_min_length = CASE WHEN blobs_min_length IS NULL THEN :blobs_min_length ELSE min(blobs_min_length, :blobs_min_length) END,
-        blobs_max_length = CASE WHEN blobs_max_length IS NULL THEN :blobs_max_length ELSE max(blobs_max_length, :blobs_max_length) END,
-        texts_whitespace = texts_whitespace + :texts_whitespace,
-        texts_newline = texts_newline + :texts_newline
-    WHERE table_id = :table_id AND column_id = :column_id
-    ''', {
-        'table_id': table_id,
-        'column_id': column_id,
-        'count': summary_stats['count'],
-        'min': summary_stats['min'],
-        'max': summary_stats['max'],
-        'nulls': summary_stats['nulls'],
-        'integers': summary_stats['integers'],
-        'reals': summary_stats['reals'],
-        'texts': summary_stats['texts'],
-        'blobs': summary_stats['blobs'],
-        'json_strings': summary_stats['json_strings'],
-        'json_arrays': summary_stats['json_arrays'],
-        'json_objects': summary_stats['json_objects'],
-        'texts_min_length': summary_stats['texts_min_length'],
-        'texts_max_length': summary_stats['texts_max_length'],
-        'blobs_min_length': summary_stats['blobs_min_length'],
-        'blobs_max_length': summary_stats['blobs_max_length'],
-        'texts_whitespace': summary_stats['texts_whitespace'],
-        'texts_newline': summary_stats['texts_newline'],
-    })
+    if not row:
+        return None
 
+    return row[0], row[1], row[2], bool(row[3])
 
 def autosuggest_column(conn, table, column, q):
     if not q:
         return []
 
-    # Consider max 100 things before sorting - gives generally good results, and is defensive
-    # against someone autocompleting the empty string
-    raw_rows = conn.execute(
-        ('WITH xs AS (SELECT value, hash, count, pks FROM {} WHERE "table_id" = (SELECT id FROM dux_ids WHERE name = ?) AND "column_id" = (SELECT id FROM dux_ids WHERE name = ?) AND value >= ? AND value < ? || ' + "x'ffffffff'" + ' LIMIT 100) SELECT * FROM xs ORDER BY count DESC LIMIT 10').format(DUX_COLUMN_STATS_VALUES),
-        [table, column, q.lower(), q.lower()]
-    ).fetchall()
+    column_info = lookup_autosuggest_column(conn, table, column)
+    if column_info is None:
+        return []
+
+    table_id, column_id, key_length, trigrams = column_info
+    key = autosuggest_query_key(q, key_length)
+
+    raw_rows = None
+    if trigrams and len(key) >= TRIGRAM_LENGTH:
+        raw_rows = autosuggest_trigrams(conn, table_id, column_id, trigram_key(q))
+    elif len(key) <= PREFIX_LENGTH and len(key) <= indexed_length(key_length):
+        # Short prefixes have their most common values precomputed, see update_prefix_tops.
+        raw_rows = conn.execute('''
+SELECT v.value, v.hash, v.count, v.pks, v.display
+FROM dux_column_stats_prefixes p, json_each(p.top) top
+JOIN dux_column_stats_values v ON v.table_id = p.table_id AND v.column_id = p.column_id AND v.value = json_extract(top.value, '$[0]') AND hex(v.hash) = json_extract(top.value, '$[1]')
+WHERE p.table_id = ? AND p.column_id = ? AND p.prefix = ?
+ORDER BY v.count DESC, v.value, v.hash
+LIMIT ?
+''', [table_id, column_id, key, AUTOSUGGEST_LIMIT]).fetchall() or None
+
+    if raw_rows is None:
+        raw_rows = autosuggest_window(conn, table_id, column_id, key, key_length)
 
-    # The value stored is just for indexing -- we need to fetch the actual value
-    # from the underlying table, by looking up the entries in `pks`.
     rows = []
-    for value, hash, count, pks in raw_rows:
+    for value, hash, count, pks, display in raw_rows:
         pks = json.loads(pks)
         if not pks:
             continue
 
-        pk = pks[0]
-        keys = list(pk.items())
-        rv = conn.execute(
-            '''
-WITH xs as (SELECT "{column}" AS value FROM "{table}" WHERE ({keys}) = ({key_bindings})),
-choices AS (SELECT json.value, substr(md5(json.value), 1, 8) as hash FROM xs, json_each(CASE WHEN json_valid(xs.value) AND json_type(xs.value) = 'array' THEN xs.value ELSE json_array(xs.value) END) AS json)
-SELECT value FROM choices WHERE hash = ?
-            '''.format(
-                column = column,
-                table = table,
-                keys = ', '.join([k[0] for k in keys]),
-                key_bindings = ', '.join(['?' for k in keys])
-            ),
-            [k[1] for k in keys] + [hash]
-        ).fetchone()
-
-        if not rv:
+        # Entries from before we stored display values only have an index key, so we
+        # fetch the actual value from the underlying table.
+        if display is None:
+            display = lookup_display_value(conn, table, column, pks[0], hash)
+
+        if display is None:
             continue
 
         rows.append({
-            'value': rv[0],
+            'value': display,
             'count': count,
             'pks': pks
         })
 
 
     return rows
+
+def autosuggest_window(conn, table_id, column_id, key, key_length):
+    # Returns the most common of the first AUTOSUGGEST_WINDOW entries that start with key.
+    length = indexed_length(key_length)
+    if len(key) <= length:
+        return conn.execute(
+            ('WITH xs AS (SELECT value, hash, count, pks, display FROM {} WHERE "table_id" = ? AND "column_id" = ? AND value >= ? AND value < ? || ' + "x'ffffffff'" + ' LIMIT {}) SELECT * FROM xs ORDER BY count DESC LIMIT {}').format(DUX_COLUMN_STATS_VALUES, AUTOSUGGEST_WINDOW, AUTOSUGGEST_LIMIT),
+            [table_id, column_id, key, key]
+        ).fetchall()
+
+    # Keys longer than the indexed part of the values narrow the range as far as
+    # they can, then we check the rest against the display values.
+    window = []
+    candidates = conn.execute(
+        "SELECT value, hash, count, pks, display FROM {} WHERE table_id = ? AND column_id = ? AND value >= ? AND value < ? || x'ffffffff' ORDER BY value, hash".format(DUX_COLUMN_STATS_VALUES),
+        [table_id, column_id, key[0:length], key[0:length]]
+    )
+    for candidate in candidates:
+        display = candidate[4]
+        if display is not None and fold_key(display, key_length).startswith(key):
+            window.append(candidate)
+
+            if len(window) == AUTOSUGGEST_WINDOW:
+                break
+
+    return sorted(window, key=lambda candidate: -candidate[2])[0:AUTOSUGGEST_LIMIT]
+
+# To pick the rarest of a query's trigrams, we count at most this many postings of each.
+TRIGRAM_COUNT_LIMIT = 1000
+
+def autosuggest_trigrams(conn, table_id, column_id, key):
+    # Returns the most common entries whose display value contains key. Like
+    # autosuggest_window, we only consider AUTOSUGGEST_WINDOW candidates, but
+    # they're the most common ones, not the first ones.
+    #
+    # The candidates are the entries with the rarest of key's trigrams that also
+    # have all of the others. Every entry that contains key has all of its
+    # trigrams, but not every entry with all of its trigrams contains key, so we
+    # check each candidate.
+    trigrams = get_trigrams(key)
+    postings = dict([(trigram, conn.execute(
+        'SELECT count(*) FROM (SELECT 1 FROM dux_column_stats_trigrams WHERE table_id = ? AND column_id = ? AND trigram = ? LIMIT ?)',
+        [table_id, column_id, trigram, TRIGRAM_COUNT_LIMIT]
+    ).fetchone()[0]) for trigram in trigrams])
+    rarest = min(trigrams, key=lambda trigram: postings[trigram])
+    if not postings[rarest]:
+        return []
+
+    others = [trigram for trigram in trigrams if trigram != rarest]
+    candidates = conn.execute('''
+SELECT v.value, v.hash, v.count, v.pks, v.display
+FROM dux_column_stats_trigrams t
+CROSS JOIN dux_column_stats_values v ON v.table_id = t.table_id AND v.column_id = t.column_id AND v.value = t.value AND v.hash = t.hash
+WHERE t.table_id = ? AND t.column_id = ? AND t.trigram = ?
+{}
+ORDER BY v.count DESC, v.value, v.hash
+LIMIT {}
+'''.format(
+        '\n'.join(['AND EXISTS(SELECT * FROM dux_column_stats_trigrams o WHERE o.table_id = t.table_id AND o.column_id = t.column_id AND o.trigram = ? AND o.value = t.value AND o.hash = t.hash)' for trigram in others]),
+        AUTOSUGGEST_WINDOW
+    ), [table_id, column_id, rarest, *others])
+
+    rv = []
+    for candidate in candidates:
+        display = candidate[4]
+        if display is not None and key in trigram_key(display):
+            rv.append(candidate)
+
+            if len(rv) == AUTOSUGGEST_LIMIT:
+                break
+
+    return rv
+
+def lookup_display_values(conn, table, column, table_id, column_id):
+    # Like lookup_display_value, for every entry of a column without a display
+    # value, using its first pk. Returns rowid -> display value.
+    pk_columns = get_pk_columns(conn, table)
+    rows = conn.execute(
+        '''
+SELECT v.rowid, (
+  SELECT json.value
+  FROM "{table}" t, json_each(CASE WHEN json_valid(t."{column}") AND json_type(t."{column}") = 'array' THEN t."{column}" ELSE json_array(t."{column}") END) AS json
+  WHERE {keys} AND substr(md5(json.value), 1, 8) = v.hash
+)
+FROM dux_column_stats_values v
+WHERE v.table_id = ? AND v.column_id = ? AND v.display IS NULL
+        '''.format(
+            table = table,
+            column = column,
+            keys = ' AND '.join(['t."{}" = json_extract(v.pks, ?)'.format(pk) for pk in pk_columns])
+        ),
+        ['$[0]."{}"'.format(pk) for pk in pk_columns] + [table_id, column_id]
+    ).fetchall()
+
+    return dict([(row[0], row[1]) for row in rows if row[1] is not None])
+
+def lookup_display_value(conn, table, column, pk, hash):
+    keys = list(pk.items())
+    rv = conn.execute(
+        '''
+WITH xs as (SELECT "{column}" AS value FROM "{table}" WHERE ({keys}) = ({key_bindings})),
+choices AS (SELECT json.value, substr(md5(json.value), 1, 8) as hash FROM xs, json_each(CASE WHEN json_valid(xs.value) AND json_type(xs.value) = 'array' THEN xs.value ELSE json_array(xs.value) END) AS json)
+SELECT value FROM choices WHERE hash = ?
+        '''.format(
+            column = column,
+            table = table,
+            keys = ', '.join([k[0] for k in keys]),
+            key_bindings = ', '.join(['?' for k in keys])
+        ),
+        [k[1] for k in keys] + [hash]
+    ).fetchone()
+
+    return rv[0] if rv else None
@@ -1,10 +1,18 @@
 import sqlite3
+import pathlib
+import json
+import hashlib
+import importlib.metadata
 
 DUX_COLUMN_STATS = 'dux_column_stats'
 DUX_COLUMN_STATS_OPS = 'dux_column_stats_ops'
+DUX_TABLE_OPS = 'dux_table_ops'
 DUX_COLUMN_STATS_VALUES = 'dux_column_stats_values'
+DUX_COLUMN_STATS_PREFIXES = 'dux_column_stats_prefixes'
+DUX_COLUMN_STATS_TRIGRAMS = 'dux_column_stats_trigrams'
 DUX_PENDING_ROWS = 'dux_pending_rows'
 DUX_IDS = 'dux_ids'
+DUX_META = 'dux_meta'
 
 # This table should have reasonable defaults so we can insert new rows
 # without having knowledge about what stats are being collected.
@@ -32,6 +40,7 @@ CREATE TABLE {}(
   texts_newline integer not null default 0, -- # of texts that have a newline
   blobs_min_length integer default 0,
   blobs_max_length integer default 0,
+  estimated boolean not null default 0, -- 1 if extrapolated from a sample of rows, see sample_large_tables
   primary key (table_id, column_id)
 )
 '''.format(DUX_COLUMN_STATS).strip()
@@ -44,10 +53,33 @@ CREATE TABLE {}(
   hash blob not null,
   count integer not null,
   pks text not null, -- JSON array of pkeys that have this value
+  display text, -- the value as it appears in the table, or NULL if we only know it from pks
   primary key (table_id, column_id, value, hash)
 )
 '''.format(DUX_COLUMN_STATS_VALUES).strip()
 
+CREATE_DUX_COLUMN_STATS_PREFIXES = '''
+CREATE TABLE {}(
+  table_id integer not null references dux_ids(id),
+  column_id integer not null references dux_ids(id),
+  prefix text not null,
+  top text not null, -- JSON array of the most common [value, hex(hash), count] in dux_column_stats_values that start with prefix
+  floor integer not null, -- no value that isn't in top has a count greater than this, see update_prefix_tops
+  primary key (table_id, column_id, prefix)
+)
+'''.format(DUX_COLUMN_STATS_PREFIXES).strip()
+
+CREATE_DUX_COLUMN_STATS_TRIGRAMS = '''
+CREATE TABLE {}(
+  table_id integer not null references dux_ids(id),
+  column_id integer not null references dux_ids(id),
+  trigram text not null, -- three consecutive characters of the entry's folded display value, see get_trigrams
+  value text not null, -- the value and hash of the entry in dux_column_stats_values
+  hash blob not null,
+  primary key (table_id, column_id, trigram, value, hash)
+) WITHOUT ROWID
+'''.format(DUX_COLUMN_STATS_TRIGRAMS).strip()
+
 CREATE_DUX_IDS = '''
 CREATE TABLE {}(
   id integer primary key,
@@ -62,10 +94,31 @@ CREATE TABLE {}(
   last_key text not null default '{{}}',
   pending integer not null check (pending in (0, 1)),
   updated_at text not null default '1970-01-01 00:00:00Z',
+  partial_stats text, -- if the stats are estimated, the exact stats of the rows backfilled so far, as JSON
+  stats boolean not null default 1, -- keep dux_column_stats for this column, see get_column_policy
+  value_index boolean not null default 1, -- keep dux_column_stats_values for this column
+  max_length integer not null default 100, -- don't put strings longer than this in dux_column_stats_values
+  trigrams boolean not null default 0, -- keep dux_column_stats_trigrams for this column, see get_column_trigrams
+  key_length integer not null default 0, -- how much of each folded value is in dux_column_stats_values.value, or 0 for the original keys, see rekey_value_index
   primary key (table_id, column_id)
 )
 '''.format(DUX_COLUMN_STATS_OPS).strip()
 
+CREATE_DUX_TABLE_OPS = '''
+CREATE TABLE {}(
+  table_id integer primary key references dux_ids(id),
+  rows_per_ms real, -- observed backfill throughput, used to size the next chunk
+  sample real -- if set, the table is never backfilled, its stats are estimated from this fraction of its rows
+)
+'''.format(DUX_TABLE_OPS).strip()
+
+CREATE_DUX_META = '''
+CREATE TABLE {}(
+  key text primary key,
+  value text not null
+)
+'''.format(DUX_META).strip()
+
 CREATE_DUX_PENDING_ROWS = '''
 CREATE TABLE {}(
   id integer primary key,
@@ -73,26 +126,132 @@ CREATE TABLE {}(
   the_rowid integer, -- for rowid tables, store the rowid
   old text,
   new text,
-  timestamp integer not null default (strftime('%Y-%m-%d %H:%M:%fZ'))
+  timestamp integer not null default (strftime('%Y-%m-%d %H:%M:%fZ')),
+  format integer -- PENDING_ROWS_FORMAT for entries written by get_stats_triggers, NULL for entries from older triggers, see fixup
 )
 '''.format(DUX_PENDING_ROWS).strip()
 
+# The format of the payloads that get_stats_triggers writes to dux_pending_rows.
+PENDING_ROWS_FORMAT = 1
+
 table_schemas = {
     DUX_PENDING_ROWS: CREATE_DUX_PENDING_ROWS,
     DUX_IDS: CREATE_DUX_IDS,
     DUX_COLUMN_STATS_OPS: CREATE_DUX_COLUMN_STATS_OPS,
+    DUX_TABLE_OPS: CREATE_DUX_TABLE_OPS,
     DUX_COLUMN_STATS: CREATE_DUX_COLUMN_STATS,
     DUX_COLUMN_STATS_VALUES: CREATE_DUX_COLUMN_STATS_VALUES,
+    DUX_COLUMN_STATS_PREFIXES: CREATE_DUX_COLUMN_STATS_PREFIXES,
+    DUX_COLUMN_STATS_TRIGRAMS: CREATE_DUX_COLUMN_STATS_TRIGRAMS,
+    DUX_META: CREATE_DUX_META,
 }
 
-def ensure_schema_and_triggers(conn):
-    # We take a very brute force approach: if any table has the wrong schema,
-    # we'll drop all the tables.
+# With the sidecar plugin setting, every table but dux_pending_rows lives in
+# a separate database, attached under this name. Triggers can only write
+# to tables in their own database, so the queue has to stay behind.
+DUX_SIDECAR_SCHEMA = 'dux'
+
+def sidecar_path(path):
+    # mydb.db -> mydb.dux.db
+    path = pathlib.Path(path)
+    return path.with_name(path.stem + '.dux' + path.suffix)
+
+def attach_sidecar(conn, path, read_only=False):
+    sidecar = sidecar_path(path)
+
+    # Bundles built by datasette dux --bundle are never written to, like the
+    # immutable databases they're built for.
+    if read_only:
+        conn.execute('ATTACH DATABASE ? AS {}'.format(DUX_SIDECAR_SCHEMA), [sidecar.resolve().as_uri() + '?immutable=1'])
+        return
+
+    # Read-only connections can't create the file, so make sure it exists.
+    if not sidecar.exists():
+        sqlite3.connect(str(sidecar)).close()
+
+    conn.execute('ATTACH DATABASE ? AS {}'.format(DUX_SIDECAR_SCHEMA), [str(sidecar)])
+    conn.execute('PRAGMA {}.journal_mode = WAL'.format(DUX_SIDECAR_SCHEMA))
+    conn.execute('PRAGMA {}.synchronous = NORMAL'.format(DUX_SIDECAR_SCHEMA))
+
+def get_stats_schema(conn):
+    # Which schema the stats tables live in. Queries don't need to know: SQLite
+    # resolves unqualified names against main, then attached databases.
+    for row in conn.execute('PRAGMA database_list'):
+        if row[1] == DUX_SIDECAR_SCHEMA:
+            return DUX_SIDECAR_SCHEMA
+
+    return 'main'
+
+def get_plugin_version():
+    try:
+        return importlib.metadata.version('datasette-ui-extras')
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+PLUGIN_VERSION = get_plugin_version()
+
+def get_schema_fingerprint(conn, policy=None):
+    # Everything that reconciling the stats tables and triggers with the database
+    # depends on. PRAGMA schema_version changes whenever a table, column or
+    # trigger is added, dropped or altered.
+    schema_versions = {}
+    for row in conn.execute('PRAGMA database_list'):
+        if row[1] in ['main', DUX_SIDECAR_SCHEMA]:
+            schema_versions[row[1]] = conn.execute('PRAGMA {}.schema_version'.format(row[1])).fetchone()[0]
+
+    return json.dumps({
+        'plugin_version': PLUGIN_VERSION,
+        'table_schemas': hashlib.sha256(json.dumps(table_schemas, sort_keys=True).encode('utf-8')).hexdigest(),
+        'schema_versions': schema_versions,
+        'policy': policy,
+    }, sort_keys=True)
+
+def is_schema_reconciled(conn, policy=None):
+    # True if nothing has changed since record_schema_fingerprint, so that
+    # startup can skip ensure_schema_and_triggers and ensure_empty_rows_for_db.
+    try:
+        row = conn.execute("SELECT value FROM {} WHERE key = 'fingerprint'".format(DUX_META)).fetchone()
+    except sqlite3.OperationalError:
+        # No dux_meta table yet.
+        return False
+
+    return row is not None and row[0] == get_schema_fingerprint(conn, policy)
+
+def record_schema_fingerprint(conn, policy=None):
+    # Call this once the stats tables, triggers and ops rows are up to date.
+    # Writing a row doesn't change the schema_version, so this doesn't invalidate itself.
+    with conn:
+        conn.execute(
+            "INSERT INTO {}(key, value) VALUES ('fingerprint', ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value".format(DUX_META),
+            [get_schema_fingerprint(conn, policy)]
+        )
+
+def get_stats_generation(conn):
+    # A counter in dux_meta that every writer of the stats tables bumps, so that a
+    # process can tell when another process has changed them, see AutosuggestCache.
+    try:
+        row = conn.execute("SELECT value FROM {} WHERE key = 'stats_generation'".format(DUX_META)).fetchone()
+    except sqlite3.OperationalError:
+        # No dux_meta table yet.
+        return 0
+
+    return int(row[0]) if row else 0
+
+def bump_stats_generation(conn):
+    # Returns the generation before and after the bump.
+    with conn:
+        conn.execute("INSERT INTO {}(key, value) VALUES ('stats_generation', 1) ON CONFLICT(key) DO UPDATE SET value = value + 1".format(DUX_META))
+        generation = get_stats_generation(conn)
+
+    return generation - 1, generation
+
+def ensure_schema_and_triggers(conn, policy=None):
     ensure_schema(conn)
-    ensure_triggers(conn)
+    ensure_triggers(conn, policy)
 
-def ensure_triggers(conn):
-    tables = indexable_tables(conn)
+def ensure_triggers(conn, policy=None):
+    # Sampled tables are never backfilled, so there's no point capturing their changes.
+    tables = [table for table in indexable_tables(conn, policy) if get_table_sample(conn, policy, table) is None and indexable_columns(conn, table, policy)]
 
     actual_triggers = conn.execute("SELECT name, tbl_name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'dux_stats_%'")
     actual_triggers = [(row[0], row[1], row[2]) for row in actual_triggers]
@@ -107,7 +266,7 @@ def ensure_triggers(conn):
         if list(conn.execute('SELECT * FROM pragma_index_info(?)', [table])):
             is_rowid_table = False
 
-        for name, tbl_name, sql in get_stats_triggers(conn, table, is_rowid_table):
+        for name, tbl_name, sql in get_stats_triggers(conn, table, is_rowid_table, policy):
             expected_triggers.append((name, tbl_name, sql))
 
     for actual in actual_triggers:
@@ -118,20 +277,54 @@ def ensure_triggers(conn):
         if not expected in actual_triggers:
             conn.execute(expected[2])
 
-def get_stats_triggers(conn, table, is_rowid_table):
-    columns = indexable_columns(conn, table)
+# Beyond this many columns, update triggers fire on any update of an indexed
+# column, rather than checking which values actually changed.
+MAX_WHEN_COLUMNS = 200
 
-    def generate_json_object(prefix):
-        rv = ['json_object(']
+# SQLite functions accept at most 127 arguments by default, so we build wide
+# JSON objects a chunk of columns at a time.
+MAX_JSON_COLUMNS = 60
+
+def get_stats_triggers(conn, table, is_rowid_table, policy=None):
+    columns = indexable_columns(conn, table, policy)
+    pks = [row[0] for row in conn.execute('select name from pragma_table_info(?) where pk', [table])]
+
+    # The primary key is needed to maintain dux_column_stats_values, even if it isn't indexed itself.
+    columns = columns + [pk for pk in pks if not pk in columns]
 
-        sep = ''
+    # The payload maps each column to its value. Blobs are never indexed, so
+    # rather than their contents, we record a JSON array of their length,
+    # eg [1024]. Column values can't otherwise be JSON arrays, so this is unambiguous.
+    def generate_json_object(prefix):
+        def value(column):
+            return "CASE WHEN typeof({prefix}.\"{column}\") == 'blob' THEN json_array(length({prefix}.\"{column}\")) ELSE {prefix}.\"{column}\" END".format(column=column, prefix=prefix)
+
+        rv = 'json_object()'
+        for i in range(0, len(columns), MAX_JSON_COLUMNS):
+            chunk = columns[i:i + MAX_JSON_COLUMNS]
+            if i == 0:
+                rv = 'json_object({})'.format(', '.join(["'{}', {}".format(column, value(column)) for column in chunk]))
+            else:
+                rv = 'json_set({}, {})'.format(rv, ', '.join(["'$.\"{}\"', {}".format(column, value(column)) for column in chunk]))
+
+        return rv
+
+    # For updates, we only record the columns whose value (or type) changed, plus
+    # the primary key, which we need to maintain dux_column_stats_values.
+    def generate_json_diff(prefix):
+        paths = []
         for column in columns:
-            rv.append("{sep}CASE WHEN typeof({prefix}.\"{column}\") == 'blob' THEN '{column}_blob' ELSE '{column}_literal' END, CASE WHEN typeof({prefix}.\"{column}\") == 'blob' THEN hex({prefix}.\"{column}\") ELSE {prefix}.\"{column}\" END".format(column=column, prefix=prefix, sep=sep))
-            sep = ', '
+            if column in pks:
+                continue
+
+            # Removing $[0] from an object is a no-op.
+            paths.append("CASE WHEN old.\"{column}\" IS new.\"{column}\" AND typeof(old.\"{column}\") == typeof(new.\"{column}\") THEN '$.\"{column}\"' ELSE '$[0]' END".format(column=column))
 
-        rv.append(')')
+        rv = generate_json_object(prefix)
+        for i in range(0, len(paths), MAX_JSON_COLUMNS):
+            rv = 'json_remove({}, {})'.format(rv, ', '.join(paths[i:i + MAX_JSON_COLUMNS]))
 
-        return ''.join(rv)
+        return rv
 
     rv = []
     for op in ['delete', 'insert', 'update']:
@@ -139,11 +332,13 @@ def get_stats_triggers(conn, table, is_rowid_table):
         maybe_old = 'NULL'
         maybe_new = 'NULL'
 
-        if op == 'delete' or op == 'update':
+        if op == 'delete':
             maybe_old = generate_json_object('old')
-
-        if op == 'insert' or op == 'update':
+        elif op == 'insert':
             maybe_new = generate_json_object('new')
+        elif op == 'update':
+            maybe_old = generate_json_diff('old')
+            maybe_new = generate_json_diff('new')
 
         maybe_rowid = 'NULL'
         if is_rowid_table and op == 'delete':
@@ -153,20 +348,173 @@ def get_stats_triggers(conn, table, is_rowid_table):
         elif is_rowid_table and op == 'update':
             maybe_rowid = '"old".rowid'
 
+        # Updates only matter if they touch a column we index, and actually change
+        # its value (or its type, eg 1 to 1.0).
+        event = op
+        maybe_when = ''
+        if op == 'update':
+            event = 'UPDATE OF {}'.format(', '.join(['"{}"'.format(column) for column in columns]))
+
+            # Very wide tables would exceed SQLite's expression depth limit.
+            if len(columns) <= MAX_WHEN_COLUMNS:
+                maybe_when = ' WHEN {}'.format(' OR '.join([
+                    'old."{column}" IS NOT new."{column}" OR typeof(old."{column}") != typeof(new."{column}")'.format(column=column) for column in columns
+                ]))
+
         sql = '''
-CREATE TRIGGER "{trigger_name}" AFTER {op} ON "{table}" FOR EACH ROW
+CREATE TRIGGER "{trigger_name}" AFTER {event} ON "{table}" FOR EACH ROW{maybe_when}
 BEGIN
-  INSERT INTO dux_pending_rows("table", "the_rowid", "old", "new") VALUES ('{table}', {maybe_rowid}, {maybe_old}, {maybe_new});
+  INSERT INTO dux_pending_rows("table", "the_rowid", "old", "new", "format") VALUES ('{table}', {maybe_rowid}, {maybe_old}, {maybe_new}, {format});
 END
-'''.format(trigger_name=trigger_name, op=op, table=table, maybe_rowid=maybe_rowid, maybe_old=maybe_old, maybe_new=maybe_new).strip()
+'''.format(trigger_name=trigger_name, event=event, table=table, maybe_when=maybe_when, maybe_rowid=maybe_rowid, maybe_old=maybe_old, maybe_new=maybe_new, format=PENDING_ROWS_FORMAT).strip()
 
 
         rv.append((trigger_name, table, sql))
     return rv
 
-def ensure_schema(conn):
-    def get_sql(table):
-        sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = ?", [table]).fetchone()
+def add_table(table):
+    def migrate(conn, schema):
+        if not get_table_shape(conn, schema, table):
+            conn.execute(table_schemas[table].replace('CREATE TABLE ', 'CREATE TABLE {}.'.format(schema), 1))
+    return migrate
+
+def add_column(table, column, definition, schema=None):
+    # schema overrides the stats schema, eg for the queue, which stays in main.
+    def migrate(conn, stats_schema):
+        table_schema = schema or stats_schema
+        shape = get_table_shape(conn, table_schema, table)
+
+        # Bundles don't have a queue.
+        if not shape:
+            return
+
+        columns = [row[0] for row in shape['columns']]
+        if not column in columns:
+            conn.execute('ALTER TABLE {}.{} ADD COLUMN {} {}'.format(table_schema, table, column, definition))
+    return migrate
+
+# Each migration brings the stats tables from the previous version to this one,
+# without losing the stats computed so far. Databases from before we recorded the
+# version in dux_meta run every migration, so each step is a no-op if it has
+# already been applied.
+#
+# ALTER TABLE adds columns at the end of a table, so new columns must be added
+# to the end of their CREATE statement, too.
+MIGRATIONS = [
+    (1, [add_table(DUX_TABLE_OPS)]),
+    (2, [
+        add_column(DUX_COLUMN_STATS, 'estimated', 'boolean not null default 0'),
+        add_column(DUX_COLUMN_STATS_OPS, 'partial_stats', 'text'),
+    ]),
+    (3, [
+        add_column(DUX_COLUMN_STATS_OPS, 'stats', 'boolean not null default 1'),
+        add_column(DUX_COLUMN_STATS_OPS, 'value_index', 'boolean not null default 1'),
+        add_column(DUX_COLUMN_STATS_OPS, 'max_length', 'integer not null default 100'),
+        add_column(DUX_TABLE_OPS, 'sample', 'real'),
+    ]),
+    (4, [add_table(DUX_META)]),
+    (5, [add_column(DUX_COLUMN_STATS_VALUES, 'display', 'text')]),
+    # The prefixes are filled in by ensure_prefix_tops.
+    (6, [add_table(DUX_COLUMN_STATS_PREFIXES)]),
+    # The trigrams are filled in by ensure_trigrams.
+    (7, [
+        add_table(DUX_COLUMN_STATS_TRIGRAMS),
+        add_column(DUX_COLUMN_STATS_OPS, 'trigrams', 'boolean not null default 0'),
+    ]),
+    # Existing values keep their substr(lower(value), 1, 20) keys until rekey_value_index
+    # replaces them.
+    (8, [add_column(DUX_COLUMN_STATS_OPS, 'key_length', 'integer not null default 0')]),
+    # Entries queued before this have no format, see fixup.
+    (9, [add_column(DUX_PENDING_ROWS, 'format', 'integer', schema='main')]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_table_shape(conn, schema, table):
+    # What matters about a table: its columns, keys and indexes. Unlike the CREATE
+    # statement in sqlite_master, this is the same whether a column was there from
+    # the start or was added by a migration.
+    columns = conn.execute('SELECT name, type, "notnull", dflt_value, pk FROM pragma_table_xinfo(?, ?) ORDER BY cid', [table, schema]).fetchall()
+
+    if not columns:
+        return None
+
+    return {
+        'columns': [tuple(row) for row in columns],
+        'indexes': sorted([tuple(row) for row in conn.execute('SELECT "unique", origin, partial FROM pragma_index_list(?, ?)', [table, schema])]),
+        'foreign_keys': sorted([tuple(row) for row in conn.execute('SELECT "table", "from", "to" FROM pragma_foreign_key_list(?, ?)', [table, schema])]),
+    }
+
+expected_table_shapes = {}
+
+def get_expected_table_shape(table):
+    if not expected_table_shapes:
+        conn = sqlite3.connect(':memory:')
+        for name, sql in table_schemas.items():
+            conn.execute(sql)
+            expected_table_shapes[name] = get_table_shape(conn, 'main', name)
+        conn.close()
+
+    return expected_table_shapes[table]
+
+def get_schema_version(conn, schema):
+    try:
+        row = conn.execute("SELECT value FROM {}.{} WHERE key = 'schema_version'".format(schema, DUX_META)).fetchone()
+    except sqlite3.OperationalError:
+        # No dux_meta table yet.
+        return 0
+
+    return int(row[0]) if row else 0
+
+def record_schema_version(conn, schema):
+    conn.execute(
+        "INSERT INTO {}.{}(key, value) VALUES ('schema_version', ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value".format(schema, DUX_META),
+        [str(SCHEMA_VERSION)]
+    )
+
+def migrate_schema(conn, tables, get_schema):
+    # Try to bring the tables up to date in place. Returns False, having made no
+    # changes, if that isn't possible, in which case they must be rebuilt.
+    stats_schema = get_schema(DUX_META)
+    version = get_schema_version(conn, stats_schema)
+
+    conn.execute('SAVEPOINT dux_migrate_schema')
+    try:
+        for migration_version, steps in MIGRATIONS:
+            if migration_version <= version:
+                continue
+
+            for step in steps:
+                step(conn, stats_schema)
+
+        # Anything we don't have a migration for, like dropping the queue after
+        # the indexer has consumed it, can't be done in place.
+        ok = all([get_table_shape(conn, get_schema(table), table) == get_expected_table_shape(table) for table in tables])
+    except sqlite3.OperationalError:
+        ok = False
+
+    if ok and version != SCHEMA_VERSION:
+        record_schema_version(conn, stats_schema)
+    elif not ok:
+        conn.execute('ROLLBACK TO dux_migrate_schema')
+
+    conn.execute('RELEASE dux_migrate_schema')
+    return ok
+
+def ensure_schema(conn, with_queue=True):
+    # Bundles have no queue, as the databases they're built for never change.
+    tables = {}
+    for table, sql in table_schemas.items():
+        if with_queue or table != DUX_PENDING_ROWS:
+            tables[table] = sql
+
+    stats_schema = get_stats_schema(conn)
+
+    def get_schema(table):
+        return 'main' if table == DUX_PENDING_ROWS else stats_schema
+
+    def get_sql(table, schema=None):
+        sql = conn.execute("SELECT sql FROM {}.sqlite_master WHERE name = ?".format(schema or get_schema(table)), [table]).fetchone()
 
         if not sql:
             return None
@@ -174,7 +522,20 @@ def ensure_schema(conn):
         return sql[0]
 
     all_ok = True
-    for k, v in table_schemas.items():
+    can_migrate = True
+
+    # If the stats tables were previously kept in the main database, drop them. They
+    # consumed the queue that the sidecar's copies depend on, so rebuild everything.
+    if stats_schema != 'main':
+        for table in reversed(list(tables.keys())):
+            if get_schema(table) == 'main' or not get_sql(table, 'main'):
+                continue
+
+            conn.execute('DROP TABLE main.{}'.format(table))
+            all_ok = False
+            can_migrate = False
+
+    for k, v in tables.items():
         if get_sql(k) != v:
             all_ok = False
             break
@@ -182,23 +543,114 @@ def ensure_schema(conn):
     if all_ok:
         return
 
-    # Drop all the tables, in reverse order so fkeys don't cause us grief.
-    for table in reversed(list(table_schemas.keys())):
-        conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+    # If we have any stats worth keeping, try to keep them.
+    if can_migrate and get_sql(DUX_COLUMN_STATS) and migrate_schema(conn, tables, get_schema):
+        return
 
-    for table, sql in table_schemas.items():
-        conn.execute(sql)
+    # Otherwise, we take a very brute force approach: drop all the tables, in
+    # reverse order so fkeys don't cause us grief.
+    for table in reversed(list(tables.keys())):
+        conn.execute('DROP TABLE IF EXISTS {}.{}'.format(get_schema(table), table))
+
+    for table, sql in tables.items():
+        conn.execute(sql.replace('CREATE TABLE ', 'CREATE TABLE {}.'.format(get_schema(table)), 1))
 
         roundtrip = get_sql(table)
         if roundtrip != sql:
             raise Exception('failed to create sql for table {}\nexpected: {}\nactual: {}'.format(table, sql, roundtrip))
 
+    with conn:
+        record_schema_version(conn, stats_schema)
+
 # A table is indexable if:
 # - not a virtual table (eg fts_posts)
 # - not a suffix of a virtual table (eg, fts_posts_idx)
 # - not a dux_ table
-def indexable_tables(conn):
-    return [row[0] for row in conn.execute("select name from sqlite_master sm where type = 'table' and not sql like 'CREATE VIRTUAL TABLE%' and not name like 'dux_%' and not exists(select 1 from sqlite_master sm2 where type = 'table' and sql like 'CREATE VIRTUAL TABLE%' and sm.name like sm2.name || '_%')")]
-
-def indexable_columns(conn, table):
-    return [row[0] for row in conn.execute('select name from pragma_table_info(?)', [table])]
+# - not excluded by the indexing policy
+def indexable_tables(conn, policy=None):
+    tables = [row[0] for row in conn.execute("select name from sqlite_master sm where type = 'table' and not sql like 'CREATE VIRTUAL TABLE%' and not name like 'dux_%' and not exists(select 1 from sqlite_master sm2 where type = 'table' and sql like 'CREATE VIRTUAL TABLE%' and sm.name like sm2.name || '_%')")]
+    return [table for table in tables if get_table_policy(policy, table) is not None]
+
+def indexable_columns(conn, table, policy=None):
+    columns = [row[0] for row in conn.execute('select name from pragma_table_info(?)', [table])]
+    return [column for column in columns if get_column_policy(policy, table, column) is not None]
+
+# The indexing policy is the indexing plugin setting. It maps table names to
+# false, to not index the table, or to an object like:
+#
+#   {
+#     "stats": true,       # keep dux_column_stats
+#     "values": true,      # keep dux_column_stats_values
+#     "max-length": 100,   # the longest string to put in dux_column_stats_values
+#     "key-length": 100,   # how many characters of each folded value to index
+#     "sample": 0.001,     # never backfill, estimate stats from this fraction of rows
+#     "trigrams": true,    # keep dux_column_stats_trigrams, for infix autosuggest
+#     "columns": {
+#       "body": {"values": false},
+#       "raw_json": false
+#     }
+#   }
+#
+# Columns inherit stats, values, max-length, key-length and trigrams from their table.
+DEFAULT_MAX_LENGTH = 100
+DEFAULT_KEY_LENGTH = 100
+
+def get_table_policy(policy, table):
+    table_policy = (policy or {}).get(table, True)
+
+    if table_policy is False:
+        return None
+
+    if table_policy is True:
+        return {}
+
+    return table_policy
+
+def get_table_sample(conn, policy, table):
+    # WITHOUT ROWID tables can't be sampled cheaply, so they're backfilled as usual.
+    sample = get_table_policy(policy, table).get('sample')
+    if sample is None or list(conn.execute('SELECT * FROM pragma_index_info(?)', [table])):
+        return None
+
+    return sample
+
+def get_column_policy(policy, table, column):
+    # Returns (stats, values, max_length, key_length), or None if the column isn't indexed at all.
+    table_policy = get_table_policy(policy, table)
+    if table_policy is None:
+        return None
+
+    column_policy = table_policy.get('columns', {}).get(column, True)
+    if column_policy is False:
+        return None
+
+    if column_policy is True:
+        column_policy = {}
+
+    stats = column_policy.get('stats', table_policy.get('stats', True))
+    values = column_policy.get('values', table_policy.get('values', True))
+    max_length = column_policy.get('max-length', table_policy.get('max-length', DEFAULT_MAX_LENGTH))
+    key_length = column_policy.get('key-length', table_policy.get('key-length', DEFAULT_KEY_LENGTH))
+
+    # A sample can't tell us every value.
+    if table_policy.get('sample') is not None:
+        values = False
+
+    if not stats and not values:
+        return None
+
+    return (bool(stats), bool(values), max_length, key_length)
+
+def get_column_trigrams(policy, table, column):
+    # Whether to keep dux_column_stats_trigrams for a column. They're off by default,
+    # as they take several times the space of the value index.
+    column_policy = get_column_policy(policy, table, column)
+    if column_policy is None or not column_policy[1]:
+        return False
+
+    table_policy = get_table_policy(policy, table)
+    column_config = table_policy.get('columns', {}).get(column, True)
+    if column_config is True:
+        column_config = {}
+
+    return bool(column_config.get('trigrams', table_policy.get('trigrams', False)))
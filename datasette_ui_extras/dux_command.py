@@ -4,11 +4,16 @@ import sqlite3
 import sqlite_sqlean
 import json
 import os
-from .column_stats_schema import ensure_schema_and_triggers
-from .column_stats import ensure_empty_rows_for_db, index_next_backfill_batch, index_pending_rows
+import pathlib
+import time
+import traceback
+import multiprocessing
+from datasette.utils import parse_metadata
+from .column_stats_schema import ensure_schema_and_triggers, ensure_schema, ensure_triggers, record_schema_fingerprint, bump_stats_generation, attach_sidecar, sidecar_path, DUX_SIDECAR_SCHEMA
+from .column_stats import ensure_empty_rows_for_db, sample_large_tables, index_next_backfill_batch, index_pending_rows, rebackfill_bulk_loaded_tables, plan_table_backfill, plan_backfill_batch, apply_backfill_plan, merge_backfill_plan, apply_value_index_deltas
 
 @hookimpl
-def prepare_connection(conn, database):
+def prepare_connection(conn, database, datasette):
     # Don't enable fkey checks on _internal, see https://github.com/simonw/datasette/issues/2032
     if database == '_internal':
         return
@@ -27,6 +32,19 @@ def prepare_connection(conn, database):
 
         # Foreign keys are great, databases should enforce them.
         conn.execute('PRAGMA foreign_keys = ON')
+
+        # Keep the stats tables in a separate file, so the indexer doesn't contend
+        # with other writers for the database's write lock.
+        if datasette is not None:
+            db = datasette.databases.get(database)
+            config = datasette.plugin_config('datasette-ui-extras', database=database) or {}
+
+            if db is not None and db.path:
+                if db.is_mutable and config.get('sidecar'):
+                    attach_sidecar(conn, db.path)
+                elif not db.is_mutable and sidecar_path(db.path).exists():
+                    # Immutable databases are served from a bundle built by datasette dux --bundle.
+                    attach_sidecar(conn, db.path, read_only=True)
     finally:
         conn.isolation_level = old_level
 
@@ -36,24 +54,302 @@ def dux_command(cli):
     @click.argument(
         "files", type=click.Path(exists=True), nargs=-1
     )
-    def dux(files):
+    @click.option(
+        "--sidecar", is_flag=True, help="Keep the stats tables in a separate <name>.dux.db file"
+    )
+    @click.option(
+        "--bundle", is_flag=True, help="Build the stats tables into a read-only <name>.dux.db file, for databases served with -i"
+    )
+    @click.option(
+        "-j", "--jobs", type=click.IntRange(min=1), default=1, help="Number of worker processes to compute stats with"
+    )
+    @click.option(
+        "--offline", is_flag=True, help="Build faster, assuming nothing else writes to the database(s) until we finish"
+    )
+    @click.option(
+        "-m", "--metadata", type=click.File(mode="r"), help="Path to the metadata file you serve with, to read the indexing policy from"
+    )
+    def dux(files, sidecar, bundle, jobs, offline, metadata):
         "Add datasette-ui-extras's triggers and stats tables to the given database(s)."
 
+        if metadata:
+            metadata = parse_metadata(metadata.read())
+
+        if jobs > 1:
+            dux_files_in_parallel([str(file) for file in files], jobs, sidecar=sidecar, bundle=bundle, offline=offline, metadata=metadata)
+            return
+
         for file in files:
-            dux_the_file(str(file))
+            policy = get_file_policy(metadata, str(file))
+            if bundle:
+                bundle_the_file(str(file), policy=policy)
+            else:
+                dux_the_file(str(file), sidecar=sidecar, offline=offline, policy=policy)
 
-def dux_the_file(file):
+def get_file_policy(metadata, file):
+    # The indexing setting that Datasette would see for the file, which is served as
+    # a database named after it. Database settings win over top-level settings.
+    if not metadata:
+        return None
+
+    name = pathlib.Path(file).stem
+    for plugins in [metadata.get('databases', {}).get(name, {}).get('plugins', {}), metadata.get('plugins', {})]:
+        config = plugins.get('datasette-ui-extras', None)
+        if config is not None:
+            return config.get('indexing', None)
+
+    return None
+
+def dux_the_file(file, sidecar=False, offline=False, policy=None):
+    conn = open_the_file(file, sidecar=sidecar, offline=offline, policy=policy)
+
+    if offline:
+        bulk_backfill(conn)
+
+    finish_the_file(conn, policy=policy)
+
+def bundle_the_file(file, policy=None):
+    # Compute the stats for a database that won't change, without modifying it:
+    # no triggers, no queue, just a sidecar that is attached read-only at startup.
+    # Nobody else writes to the bundle, so it's always built offline.
+    conn = open_the_file(file, bundle=True, policy=policy)
+    bulk_backfill(conn)
+    finish_the_file(conn, bundle=True, policy=policy)
+
+def open_the_file(file, sidecar=False, bundle=False, offline=False, policy=None):
+    # Open the file and make sure it has the stats tables, ready for indexing.
     conn = sqlite3.connect(str(file))
     conn.row_factory = sqlite3.Row
-    prepare_connection(conn, 'not-internal')
 
-    ensure_schema_and_triggers(conn)
-    ensure_empty_rows_for_db(conn)
+    if bundle:
+        # These would shadow the bundle's tables.
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name LIKE 'dux_%'").fetchone():
+            conn.close()
+            raise click.ClickException('{} has datasette-ui-extras tables, run datasette undux first'.format(file))
 
-    while index_next_backfill_batch(conn):
-        pass
+        bundle_file = str(sidecar_path(file))
+        for path in [bundle_file, bundle_file + '-wal', bundle_file + '-shm']:
+            if os.path.exists(path):
+                os.remove(path)
 
-    while index_pending_rows(conn):
+        attach_sidecar(conn, file)
+        ensure_schema(conn, with_queue=False)
+    else:
+        prepare_connection(conn, 'not-internal', None)
+
+        if sidecar:
+            attach_sidecar(conn, file)
+
+        # Offline, nothing else writes to the database, so there's nothing for the
+        # triggers to capture until we're done.
+        if offline:
+            ensure_schema(conn)
+        else:
+            ensure_schema_and_triggers(conn, policy)
+
+    ensure_empty_rows_for_db(conn, policy)
+    return conn
+
+def finish_the_file(conn, bundle=False, policy=None):
+    # Index whatever is left to do, then close the file.
+    if not bundle:
+        ensure_triggers(conn, policy)
+
+        # So that Datasette doesn't need to reconcile the database again at startup.
+        record_schema_fingerprint(conn, policy)
+
+    while index_next_backfill_batch(conn) or (not bundle and rebackfill_bulk_loaded_tables(conn)):
         pass
 
+    # Everything else has been backfilled, so this only samples the tables
+    # that the indexing policy says to sample.
+    sample_large_tables(conn)
+
+    if bundle:
+        # Fold the WAL back in, so the bundle is a single file that can be opened immutable.
+        conn.execute('PRAGMA {}.journal_mode = DELETE'.format(DUX_SIDECAR_SCHEMA))
+    else:
+        while index_pending_rows(conn):
+            pass
+
+        # So that a running Datasette drops what it has cached from the stats.
+        bump_stats_generation(conn)
+
     conn.close()
+
+# Worker processes and offline builds plan larger chunks than the background
+# indexer, as nobody is waiting on our write transactions, and fewer, larger
+# plans are cheaper to merge.
+BULK_BATCH_MS = 1000
+
+# Settings for offline builds. SQLite caps mmap_size at a compile-time limit,
+# usually 2GB.
+BULK_CACHE_SIZE_KB = 1024 * 1024
+BULK_MMAP_SIZE = 1024 * 1024 * 1024 * 16
+
+# Offline builds commit, and apply their buffered value index changes, once
+# this many rows have been read.
+BULK_COMMIT_ROWS = 500000
+
+def tune_for_bulk_build(conn):
+    # Use a big page cache and memory-mapped I/O, and keep temporary b-trees in memory.
+    # Returns the previous settings, for restore_pragmas.
+    saved = []
+    pragmas = [('temp_store', 'MEMORY')]
+    for row in conn.execute('PRAGMA database_list').fetchall():
+        if row[1] != 'temp':
+            pragmas.append(('{}.cache_size'.format(row[1]), -BULK_CACHE_SIZE_KB))
+            pragmas.append(('{}.mmap_size'.format(row[1]), BULK_MMAP_SIZE))
+
+    for pragma, value in pragmas:
+        saved.append((pragma, conn.execute('PRAGMA {}'.format(pragma)).fetchone()[0]))
+        conn.execute('PRAGMA {} = {}'.format(pragma, value))
+
+    return saved
+
+def restore_pragmas(conn, saved):
+    for pragma, value in saved:
+        conn.execute('PRAGMA {} = {}'.format(pragma, value))
+
+def new_bulk_state():
+    return {'rows': 0, 'value_deltas': {}}
+
+def apply_plan_in_bulk(conn, state, plan):
+    # Merge the plan into a long transaction, holding back its value index changes
+    # so that they can be applied all at once, in sorted order.
+    merge_backfill_plan(conn, plan, state['value_deltas'])
+    state['rows'] += plan['rows']
+
+    if state['rows'] >= BULK_COMMIT_ROWS:
+        commit_bulk(conn, state)
+
+def commit_bulk(conn, state):
+    apply_value_index_deltas(conn, state['value_deltas'])
+    conn.commit()
+
+    state['rows'] = 0
+    state['value_deltas'] = {}
+
+def bulk_backfill(conn):
+    saved = tune_for_bulk_build(conn)
+    state = new_bulk_state()
+
+    while True:
+        plan = plan_backfill_batch(conn, BULK_BATCH_MS)
+
+        if not plan:
+            break
+
+        apply_plan_in_bulk(conn, state, plan)
+
+    commit_bulk(conn, state)
+    restore_pragmas(conn, saved)
+
+# How often to report on tables that are still being indexed, in seconds.
+PROGRESS_INTERVAL = 10
+
+def dux_files_in_parallel(files, jobs, sidecar=False, bundle=False, offline=False, metadata=None):
+    # Worker processes plan the backfill of one table at a time on their own
+    # read-only connections, and send the plans back to us. We're the only
+    # writer: we apply each plan to its file, in the order it was made.
+    offline = offline or bundle
+    conns = {}
+    bulk_states = {}
+    saved_pragmas = {}
+    policies = {}
+    for file in files:
+        policies[file] = get_file_policy(metadata, file)
+        conns[file] = open_the_file(file, sidecar=sidecar, bundle=bundle, offline=offline, policy=policies[file])
+
+        if offline:
+            saved_pragmas[file] = tune_for_bulk_build(conns[file])
+            bulk_states[file] = new_bulk_state()
+
+    units = multiprocessing.Queue()
+    num_units = 0
+    for file, conn in conns.items():
+        for table_name, in conn.execute('SELECT DISTINCT ids.name FROM dux_column_stats_ops ops JOIN dux_ids ids ON ids.id = ops.table_id WHERE pending ORDER BY ids.name'):
+            units.put((file, table_name))
+            num_units += 1
+
+    # Bounded, so that workers can't get too far ahead of us.
+    results = multiprocessing.Queue(jobs * 2)
+
+    workers = []
+    for i in range(min(jobs, num_units)):
+        units.put(None)
+        worker = multiprocessing.Process(target=plan_table_backfill_worker, args=[units, results, sidecar or bundle], daemon=True)
+        worker.start()
+        workers.append(worker)
+
+    try:
+        progress = {}
+        last_report = time.time()
+        remaining = num_units
+        while remaining:
+            kind, file, table_name, payload = results.get()
+            key = (file, table_name)
+
+            if kind == 'error':
+                raise click.ClickException('failed to index {} in {}:\n{}'.format(table_name, file, payload))
+
+            if not key in progress:
+                progress[key] = [time.time(), 0]
+
+            if kind == 'plan' and offline:
+                apply_plan_in_bulk(conns[file], bulk_states[file], payload)
+                progress[key][1] += payload['rows']
+            elif kind == 'plan':
+                apply_backfill_plan(conns[file], payload)
+                progress[key][1] += payload['rows']
+            elif kind == 'done':
+                remaining -= 1
+                report_progress(file, table_name, progress.pop(key), done=True)
+
+            if time.time() - last_report >= PROGRESS_INTERVAL:
+                for (file, table_name), started_and_rows in progress.items():
+                    report_progress(file, table_name, started_and_rows)
+
+                last_report = time.time()
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+    for file, conn in conns.items():
+        if offline:
+            commit_bulk(conn, bulk_states[file])
+            restore_pragmas(conn, saved_pragmas[file])
+
+        finish_the_file(conn, bundle=bundle, policy=policies[file])
+
+def plan_table_backfill_worker(units, results, attach):
+    # Take tables from units until we reach the None sentinel, sending each
+    # table's plans to results, followed by a done message.
+    for file, table_name in iter(units.get, None):
+        try:
+            conn = sqlite3.connect(pathlib.Path(file).resolve().as_uri() + '?mode=ro', uri=True)
+            conn.row_factory = sqlite3.Row
+
+            if attach:
+                attach_sidecar(conn, file)
+
+            for plan in plan_table_backfill(conn, table_name, BULK_BATCH_MS):
+                results.put(('plan', file, table_name, plan))
+
+            conn.close()
+            results.put(('done', file, table_name, None))
+        except:
+            results.put(('error', file, table_name, traceback.format_exc()))
+            return
+
+def report_progress(file, table_name, started_and_rows, done=False):
+    started, rows = started_and_rows
+    elapsed = max(time.time() - started, 0.001)
+
+    click.echo('{} {}: {} rows{}, {:.0f} rows/s'.format(
+        file,
+        table_name,
+        rows,
+        '' if done else ' so far',
+        rows / elapsed
+    ), err=True)
@@ -1,4 +1,4 @@
-from .column_stats import autosuggest_column
+from .autosuggest_cache import get_autosuggest_cache, cached_autosuggest_column
 from .utils import get_editable_columns
 from datasette.utils import path_from_row_pks
 
@@ -93,7 +93,7 @@ async def omnisearch(datasette, db, table, q):
     return row_results + fkey_results + string_results
 
 def suggest_string_results(datasette, conn, db, table, link_table, column, q, verb, template):
-    hits = autosuggest_column(conn, table, column, q)
+    hits = cached_autosuggest_column(get_autosuggest_cache(datasette), db, conn, table, column, q)
 
     rv = []
     for hit in hits[0:3]:
@@ -105,7 +105,7 @@ def suggest_string_results(datasette, conn, db, table, link_table, column, q, ve
     return rv
 
 def suggest_fkey_results(datasette, conn, db, table, link_table, my_column, other_table, other_column, other_label_column, q):
-    hits = autosuggest_column(conn, other_table, other_label_column, q)
+    hits = cached_autosuggest_column(get_autosuggest_cache(datasette), db, conn, other_table, other_label_column, q)
 
     rv = []
     for hit in hits[0:3]:
@@ -128,7 +128,7 @@ def suggest_row_results(datasette, conn, db, table, link_table, column, q):
     #       to do the filter could be quite bad.
     #
     #       We may want to forbid table != link_table? :(
-    hits = autosuggest_column(conn, table, column, q)
+    hits = cached_autosuggest_column(get_autosuggest_cache(datasette), db, conn, table, column, q)
 
     rv = []
     for hit in hits[0:3]:
@@ -3,6 +3,7 @@ import click
 import sqlite3
 import json
 import os
+from .column_stats_schema import sidecar_path
 
 @hookimpl(specname='register_commands')
 def undux_command(cli):
@@ -21,3 +22,10 @@ def undux_command(cli):
 
             for table, in list(conn.execute("select name from sqlite_master where name like 'dux_%' and type = 'table'")):
                 conn.execute('DROP TABLE "{}"'.format(table))
+
+            conn.close()
+
+            sidecar = str(sidecar_path(file))
+            for path in [sidecar, sidecar + '-wal', sidecar + '-shm']:
+                if os.path.exists(path):
+                    os.remove(path)
@@ -1,7 +1,15 @@
 import sqlite3
+import asyncio
+import json
 import pytest
+from types import SimpleNamespace
 
-from datasette_ui_extras.dux_command import dux_the_file
+from datasette_ui_extras.dux_command import dux_the_file, bundle_the_file, dux_files_in_parallel, prepare_connection
+from datasette.app import Datasette
+from datasette_ui_extras import column_stats
+from datasette_ui_extras.autosuggest_cache import AutosuggestCache
+from datasette_ui_extras.column_stats import sample_large_tables, autosuggest_column, value_index_key, rebackfill_bulk_loaded_tables, ensure_empty_rows_for_db, index_next_backfill_batch, index_pending_rows, plan_backfill_batch, apply_backfill_plan, index_db, data_version_changed, close_data_version_connections, note_stats_change
+from datasette_ui_extras.column_stats_schema import ensure_schema_and_triggers, ensure_schema, sidecar_path, is_schema_reconciled, get_schema_version, get_stats_generation, SCHEMA_VERSION
 
 def test_compute_column_stats(tmp_path):
     db_name = tmp_path / "db.sqlite"
@@ -23,3 +31,1326 @@ def test_compute_column_stats(tmp_path):
     # Confirm that we can drain the queue of pending rows
     dux_the_file(db_name)
 
+
+COUNT_COLUMNS = ['count', 'nulls', 'integers', 'reals', 'texts', 'blobs', 'json_strings', 'json_arrays', 'json_objects', 'texts_whitespace', 'texts_newline']
+
+def get_counts(db_name):
+    conn = sqlite3.connect(db_name)
+    rv = {}
+    for row in conn.execute('SELECT t.name, c.name, {} FROM dux_column_stats s JOIN dux_ids t ON t.id = s.table_id JOIN dux_ids c ON c.id = s.column_id'.format(', '.join(COUNT_COLUMNS))):
+        rv[(row[0], row[1])] = row[2:]
+    conn.close()
+    return rv
+
+def get_values(db_name):
+    conn = sqlite3.connect(db_name)
+    rv = {}
+    for row in conn.execute('SELECT t.name, c.name, value, hash, count FROM dux_column_stats_values v JOIN dux_ids t ON t.id = v.table_id JOIN dux_ids c ON c.id = v.column_id'):
+        rv[row[0:4]] = row[4]
+    conn.close()
+    return rv
+
+def test_pending_rows_match_backfill(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text, tags text, age integer, blobby blob)")
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    with conn:
+        for i in range(50):
+            conn.execute("INSERT INTO data(id, title, tags, age, blobby) VALUES (?, ?, ?, ?, ?)", [i, 'title {}'.format(i % 7), '["a", "b{}"]'.format(i % 3), i if i % 2 else None, b'xy' if i % 5 == 0 else None])
+        conn.execute("UPDATE data SET title = 'renamed', age = 1.5 WHERE id < 10")
+        conn.execute("UPDATE data SET tags = '[\"c\"]' WHERE id % 4 = 0")
+        conn.execute("DELETE FROM data WHERE id > 40")
+    conn.close()
+
+    # Drain the pending rows, then compare to a from-scratch backfill.
+    dux_the_file(db_name)
+    incremental_counts = get_counts(db_name)
+    incremental_values = get_values(db_name)
+    assert incremental_counts[('data', 'title')][0] == 41
+
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute('DELETE FROM dux_column_stats')
+        conn.execute('DELETE FROM dux_column_stats_values')
+        conn.execute('DELETE FROM dux_column_stats_ops')
+    conn.close()
+
+    dux_the_file(db_name)
+    assert get_counts(db_name) == incremental_counts
+    assert get_values(db_name) == incremental_values
+
+def test_value_index_pks(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text)")
+        conn.execute("INSERT INTO data(id, title) VALUES (1, 'Foo'), (2, 'Foo')")
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("INSERT INTO data(id, title) VALUES (3, 'Foo'), (4, 'Bar')")
+        conn.execute("UPDATE data SET title = 'Bar' WHERE id = 1")
+        conn.execute("DELETE FROM data WHERE id = 4")
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    rows = conn.execute('SELECT value, count, pks FROM dux_column_stats_values ORDER BY value').fetchall()
+    conn.close()
+
+    assert [(value, count, json.loads(pks)) for value, count, pks in rows] == [
+        ('bar', 1, [{'id': 1}]),
+        ('foo', 2, [{'id': 2}, {'id': 3}]),
+    ]
+
+def test_value_index_pks_match_backfill(tmp_path):
+    # The pks we remove must match the ones the backfill stored, whatever they contain.
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE places(name text primary key, title text)")
+        conn.executemany("INSERT INTO places(name, title) VALUES (?, ?)", [['Zürich', 'City'], ['東京', 'City'], ['Paris', 'City']])
+        conn.execute("CREATE TABLE readings(value real primary key, title text)")
+        conn.executemany("INSERT INTO readings(value, title) VALUES (?, ?)", [[1e20, 'Big'], [0.5, 'Big']])
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("DELETE FROM places WHERE name IN ('Zürich', '東京')")
+        conn.execute("DELETE FROM readings WHERE value = 1e20")
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    rows = conn.execute('SELECT value, count, pks FROM dux_column_stats_values ORDER BY value').fetchall()
+    conn.close()
+
+    assert [(value, count, json.loads(pks)) for value, count, pks in rows] == [
+        ('big', 1, [{'value': 0.5}]),
+        ('city', 1, [{'name': 'Paris'}]),
+        ('paris', 1, [{'name': 'Paris'}]),
+    ]
+
+def test_value_index_key():
+    conn = sqlite3.connect(':memory:')
+    prepare_connection(conn, 'not-internal', None)
+
+    for item in ['Hello World', 'ÉCOLE Ünïcode values that are quite long', '日本語のテキスト']:
+        # The hash matches SQLite's, see lookup_display_value.
+        assert value_index_key(item)[1] == conn.execute('SELECT substr(md5(?1), 1, 8)', [item]).fetchone()[0]
+
+        # Columns that haven't been rekeyed yet keep the original keys.
+        assert value_index_key(item, 0) == conn.execute('SELECT substr(lower(?1), 1, 20), substr(md5(?1), 1, 8)', [item]).fetchone()
+
+    assert value_index_key('ÉCOLE Ünïcode values that are quite long')[0] == 'ecole unicode values that are quite long'
+    assert value_index_key('ÉCOLE Ünïcode values that are quite long', 10)[0] == 'ecole unic'
+    assert value_index_key('Straße')[0] == 'strasse'
+    assert value_index_key('ＡＢＣ')[0] == 'abc'
+    assert value_index_key('日本語のテキスト')[0] == '日本語のテキスト'
+
+def test_backfill_scans_table_once(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text, other text)")
+        conn.executemany("INSERT INTO data(title, other) VALUES (?, ?)", [['title {}'.format(i), 'other'] for i in range(2500)])
+    conn.close()
+
+    conn = sqlite3.connect(db_name)
+    conn.row_factory = sqlite3.Row
+    prepare_connection(conn, 'not-internal', None)
+    ensure_schema_and_triggers(conn)
+    ensure_empty_rows_for_db(conn)
+
+    # All 3 columns are indexed together: 2 full chunks, then 1 partial chunk.
+    batches = 0
+    while index_next_backfill_batch(conn):
+        batches += 1
+    assert batches == 3
+
+    # A column added later gets its own pass.
+    conn.execute("ALTER TABLE data ADD COLUMN added text")
+    ensure_empty_rows_for_db(conn)
+    batches = 0
+    while index_next_backfill_batch(conn):
+        batches += 1
+    assert batches == 3
+
+    counts = dict(conn.execute('SELECT ids.name, count FROM dux_column_stats stats JOIN dux_ids ids ON ids.id = stats.column_id').fetchall())
+    assert counts == {'id': 2500, 'title': 2500, 'other': 2500, 'added': 2500}
+    conn.close()
+
+def test_backfill_adapts_chunk_size(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text)")
+        conn.executemany("INSERT INTO data(title) VALUES (?)", [['title {}'.format(i)] for i in range(5000)])
+    conn.close()
+
+    conn = sqlite3.connect(db_name)
+    conn.row_factory = sqlite3.Row
+    prepare_connection(conn, 'not-internal', None)
+    ensure_schema_and_triggers(conn)
+    ensure_empty_rows_for_db(conn)
+
+    assert index_next_backfill_batch(conn, target_ms=50)
+    # The first chunk of an unfamiliar table is small, and we remember how fast it went.
+    assert conn.execute('SELECT last_key FROM dux_column_stats_ops LIMIT 1').fetchone()[0] == '{"id":100}'
+    rows_per_ms = conn.execute('SELECT rows_per_ms FROM dux_table_ops').fetchone()[0]
+    assert rows_per_ms > 0
+
+    while index_next_backfill_batch(conn, target_ms=50):
+        pass
+
+    counts = [row[0] for row in conn.execute('SELECT count FROM dux_column_stats')]
+    assert counts == [5000, 5000]
+    conn.close()
+
+def test_stale_backfill_plan_is_discarded(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text)")
+        conn.executemany("INSERT INTO data(title) VALUES (?)", [['title {}'.format(i)] for i in range(10)])
+    conn.close()
+
+    conn = sqlite3.connect(db_name)
+    conn.row_factory = sqlite3.Row
+    prepare_connection(conn, 'not-internal', None)
+    ensure_schema_and_triggers(conn)
+    ensure_empty_rows_for_db(conn)
+
+    plan = plan_backfill_batch(conn)
+    assert index_next_backfill_batch(conn)
+
+    # The plan was made before the columns moved on, so applying it is a no-op.
+    apply_backfill_plan(conn, plan)
+    counts = [row[0] for row in conn.execute('SELECT count FROM dux_column_stats')]
+    assert counts == [10, 10]
+    conn.close()
+
+@pytest.mark.asyncio
+async def test_index_db(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text)")
+        conn.executemany("INSERT INTO data(title) VALUES (?)", [['title {}'.format(i % 3)] for i in range(1000)])
+    conn.close()
+
+    datasette = Datasette(files=[db_name])
+    await datasette.invoke_startup()
+    db = datasette.get_database('db')
+    await db.execute_write_fn(ensure_empty_rows_for_db)
+
+    while await index_db(db):
+        pass
+
+    counts = [row[0] for row in await db.execute('SELECT count FROM dux_column_stats')]
+    assert counts == [1000, 1000]
+
+    await db.execute_write("INSERT INTO data(title) VALUES ('title 0')")
+
+    while await index_db(db):
+        pass
+
+    counts = [row[0] for row in await db.execute('SELECT count FROM dux_column_stats')]
+    assert counts == [1001, 1001]
+
+@pytest.mark.asyncio
+async def test_index_db_drains_during_backfill(tmp_path, monkeypatch):
+    monkeypatch.setattr(column_stats, 'SAMPLED_STATS_MIN_ROWS', 1000)
+    monkeypatch.setattr(column_stats, 'SAMPLED_STATS_ROWS', 100)
+
+    db_names = []
+    for name in ['db', 'exact']:
+        db_name = tmp_path / "{}.sqlite".format(name)
+        conn = sqlite3.connect(db_name)
+        with conn:
+            conn.execute("CREATE TABLE data(id integer primary key, title text, age integer)")
+            conn.executemany("INSERT INTO data(id, title, age) VALUES (?, ?, ?)", [[i, 'title {}'.format(i % 7), i if i % 2 else None] for i in range(3000)])
+        conn.close()
+        db_names.append(db_name)
+
+    datasette = Datasette(files=[db_names[0]])
+    await datasette.invoke_startup()
+    db = datasette.get_database('db')
+    await db.execute_write_fn(ensure_empty_rows_for_db)
+    await db.execute_write_fn(sample_large_tables)
+
+    # Get the backfill part of the way through the table...
+    state = {}
+    async def get_last_key():
+        return list(await db.execute("SELECT DISTINCT last_key FROM dux_column_stats_ops"))[0][0]
+
+    while await get_last_key() == '{}':
+        await index_db(db, state=state)
+    last_id = json.loads(await get_last_key())['id']
+    assert 0 < last_id < 1000
+
+    # ...then change rows on both sides of where it's got to.
+    changes = [
+        "UPDATE data SET title = 'changed', age = 1 WHERE id IN (0, 2, {0}, {1}, 2000)".format(last_id, last_id + 1),
+        "DELETE FROM data WHERE id IN (1, 3, {})".format(last_id + 2),
+        "INSERT INTO data(id, title, age) VALUES (5000, 'new', 5000)",
+    ]
+    for change in changes:
+        await db.execute_write(change)
+
+    # The changes are drained without waiting for the backfill to finish.
+    while list(await db.execute('SELECT count(*) FROM dux_pending_rows'))[0][0]:
+        await index_db(db, state=state)
+    assert list(await db.execute("SELECT count(*) FROM dux_column_stats_ops WHERE pending"))[0][0] == 3
+    assert list(await db.execute("SELECT count(*) FROM dux_column_stats WHERE estimated"))[0][0] == 3
+
+    while await index_db(db, state=state):
+        pass
+
+    conn = sqlite3.connect(db_names[1])
+    with conn:
+        for change in changes:
+            conn.execute(change)
+    conn.close()
+    dux_the_file(db_names[1])
+
+    assert get_counts(db_names[0]) == get_counts(db_names[1])
+    assert get_values(db_names[0]) == get_values(db_names[1])
+
+@pytest.mark.asyncio
+async def test_index_loop_concurrency(tmp_path, monkeypatch):
+    # One big database and two small ones.
+    db_names = []
+    for name, rows in [('big', 20000), ('small1', 10), ('small2', 10)]:
+        db_name = tmp_path / "{}.sqlite".format(name)
+        conn = sqlite3.connect(db_name)
+        with conn:
+            conn.execute("CREATE TABLE data(id integer primary key, title text)")
+            conn.executemany("INSERT INTO data(title) VALUES (?)", [['title {}'.format(i % 3)] for i in range(rows)])
+        conn.close()
+        db_names.append(db_name)
+
+    datasette = Datasette(files=db_names, metadata={
+        'plugins': {
+            'datasette-ui-extras': {
+                'indexer-concurrency': 1,
+                'index-batch-ms': 1,
+            }
+        }
+    })
+    await datasette.invoke_startup()
+
+    # Record how many databases are being indexed at once, and when each runs out of work.
+    index_db = column_stats.index_db
+    active = []
+    max_active = [0]
+    log = []
+    async def tracked_index_db(db, *args, **kwargs):
+        active.append(db.name)
+        max_active[0] = max(max_active[0], len(active))
+        try:
+            rv = await index_db(db, *args, **kwargs)
+        finally:
+            active.remove(db.name)
+        log.append((db.name, rv))
+        return rv
+    monkeypatch.setattr(column_stats, 'index_db', tracked_index_db)
+
+    async def is_drained(name):
+        rows = await datasette.get_database(name).execute('SELECT count(*), sum(pending) FROM dux_column_stats_ops')
+        return tuple(rows.first()) == (2, 0)
+
+    task = asyncio.create_task(column_stats.index_loop(datasette, ['big', 'small1', 'small2']))
+    try:
+        for i in range(600):
+            if all([await is_drained(name) for name in ['big', 'small1', 'small2']]):
+                break
+            await asyncio.sleep(0.05)
+    finally:
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    for name in ['big', 'small1', 'small2']:
+        counts = [row[0] for row in await datasette.get_database(name).execute('SELECT count FROM dux_column_stats')]
+        assert counts == ([20000, 20000] if name == 'big' else [10, 10])
+
+    # The cap was respected, and the small databases didn't wait for the big one.
+    assert max_active[0] == 1
+    last_big = max([i for i, (name, rv) in enumerate(log) if name == 'big' and rv])
+    for name in ['small1', 'small2']:
+        assert log.index((name, False)) < last_big
+
+def test_data_version_changed(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    conn.execute("CREATE TABLE data(id integer primary key)")
+    conn.commit()
+
+    db = SimpleNamespace(path=str(db_name))
+    data_versions = {}
+    assert data_version_changed(data_versions, 'db', db)
+    assert not data_version_changed(data_versions, 'db', db)
+
+    conn.execute("INSERT INTO data(id) VALUES (1)")
+    conn.commit()
+    assert data_version_changed(data_versions, 'db', db)
+    assert not data_version_changed(data_versions, 'db', db)
+    conn.close()
+
+    version_conn = data_versions['db'][0]
+    close_data_version_connections(data_versions)
+    assert data_versions == {}
+    with pytest.raises(sqlite3.ProgrammingError):
+        version_conn.execute('PRAGMA data_version')
+
+    # With a sidecar, the stats generation is read from it.
+    dux_the_file(db_name, sidecar=True)
+    data_version_changed(data_versions, 'db', db, sidecar=True)
+    assert get_stats_generation(data_versions['db'][0]) == 1
+    close_data_version_connections(data_versions)
+
+def test_update_trigger_skips_no_op_updates(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text, score)")
+        conn.execute("INSERT INTO data(id, title, score) VALUES (1, 'title', 1)")
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    def pending():
+        return conn.execute('SELECT count(*) FROM dux_pending_rows').fetchone()[0]
+
+    with conn:
+        conn.execute("UPDATE data SET title = 'title', score = 1")
+    assert pending() == 0
+
+    with conn:
+        conn.execute("UPDATE data SET score = 1.0")
+    assert pending() == 1
+
+    with conn:
+        conn.execute("UPDATE data SET title = 'new title'")
+    assert pending() == 2
+    conn.close()
+
+def test_pending_row_payloads(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text, image blob)")
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("INSERT INTO data(id, title, image) VALUES (1, 'title', ?)", [b'x' * 100000])
+        conn.execute("UPDATE data SET title = 'new title'")
+
+    payloads = [(json.loads(row[0]) if row[0] else None, json.loads(row[1])) for row in conn.execute('SELECT old, new FROM dux_pending_rows ORDER BY id')]
+    assert payloads == [
+        (None, {'id': 1, 'title': 'title', 'image': [100000]}),
+        ({'id': 1, 'title': 'title'}, {'id': 1, 'title': 'new title'}),
+    ]
+
+    # Entries written by older versions of the triggers can still be consumed.
+    with conn:
+        conn.execute('''INSERT INTO dux_pending_rows("table", the_rowid, old, new) VALUES ('data', 2, NULL, '{"id_literal":2,"title_literal":"legacy","image_blob":"3132"}')''')
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    stats = conn.execute("SELECT count, texts, blobs, blobs_max_length FROM dux_column_stats WHERE column_id = (SELECT id FROM dux_ids WHERE name = 'image')").fetchone()
+    assert stats == (2, 0, 2, 100000)
+    values = [row[0] for row in conn.execute('SELECT value FROM dux_column_stats_values ORDER BY value')]
+    assert values == ['legacy', 'new title']
+    conn.close()
+
+def test_pending_row_payload_format(tmp_path):
+    # Columns whose names look like the original payload format's keys aren't
+    # mistaken for it.
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE t(name text, photo_blob blob, note_literal text)")
+        conn.execute("INSERT INTO t(name, photo_blob, note_literal) VALUES ('a', X'00', 'x')")
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("UPDATE t SET photo_blob = X'0102'")
+        conn.execute("UPDATE t SET note_literal = 'y'")
+    assert [row[0] for row in conn.execute('SELECT format FROM dux_pending_rows')] == [1, 1]
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    assert conn.execute("SELECT count, blobs, blobs_max_length FROM dux_column_stats WHERE column_id = (SELECT id FROM dux_ids WHERE name = 'photo_blob')").fetchone() == (1, 1, 2)
+    assert [row[0] for row in conn.execute("SELECT display FROM dux_column_stats_values WHERE column_id = (SELECT id FROM dux_ids WHERE name = 'note_literal')")] == ['y']
+
+    # Only entries without a format are checked for the original format's keys.
+    with conn:
+        conn.execute("CREATE TABLE u(id_literal integer primary key, note_blob text)")
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("INSERT INTO u(id_literal, note_blob) VALUES (1, 'not hex_blob')")
+        conn.execute('''INSERT INTO dux_pending_rows("table", the_rowid, old, new) VALUES ('u', 2, NULL, '{"id_literal_literal":2,"note_blob_literal":"legacy_blob"}')''')
+    assert [tuple(row) for row in conn.execute("SELECT format FROM dux_pending_rows")] == [(1,), (None,)]
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    assert [row[0] for row in conn.execute("SELECT display FROM dux_column_stats_values WHERE column_id = (SELECT id FROM dux_ids WHERE name = 'note_blob') ORDER BY display")] == ['legacy_blob', 'not hex_blob']
+    assert conn.execute("SELECT count, texts FROM dux_column_stats WHERE column_id = (SELECT id FROM dux_ids WHERE name = 'note_blob')").fetchone() == (2, 2)
+    conn.close()
+
+def test_pending_rows_are_coalesced(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text, age integer)")
+        conn.execute("CREATE TABLE tags(name text primary key, label text) WITHOUT ROWID")
+        conn.execute("INSERT INTO data(id, title, age) VALUES (1, 'a', 1), (2, 'b', 2), (3, 'c', 3)")
+        conn.execute("INSERT INTO tags(name, label) VALUES ('x', 'X'), ('y', 'Y')")
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    with conn:
+        # Churn, ending back at the original value.
+        for i in range(20):
+            conn.execute("UPDATE data SET title = ? WHERE id = 1", ['t{}'.format(i)])
+        conn.execute("UPDATE data SET title = 'a' WHERE id = 1")
+
+        # Changes to different columns across several updates.
+        conn.execute("UPDATE data SET title = 'bb' WHERE id = 2")
+        conn.execute("UPDATE data SET age = 20 WHERE id = 2")
+        conn.execute("UPDATE data SET title = 'bbb' WHERE id = 2")
+
+        # Update then delete; insert, update then delete; delete then re-insert.
+        conn.execute("UPDATE data SET title = 'cc' WHERE id = 3")
+        conn.execute("DELETE FROM data WHERE id = 3")
+        conn.execute("INSERT INTO data(id, title, age) VALUES (4, 'd', 4)")
+        conn.execute("UPDATE data SET title = 'dd' WHERE id = 4")
+        conn.execute("DELETE FROM data WHERE id = 4")
+        conn.execute("DELETE FROM data WHERE id = 1")
+        conn.execute("INSERT INTO data(id, title, age) VALUES (1, 'aa', 1)")
+
+        conn.execute("UPDATE tags SET label = 'XX' WHERE name = 'x'")
+        conn.execute("UPDATE tags SET label = 'XXX' WHERE name = 'x'")
+        conn.execute("UPDATE tags SET name = 'z' WHERE name = 'y'")
+    conn.close()
+
+    dux_the_file(db_name)
+    incremental_counts = get_counts(db_name)
+    incremental_values = get_values(db_name)
+
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute('DELETE FROM dux_column_stats')
+        conn.execute('DELETE FROM dux_column_stats_values')
+        conn.execute('DELETE FROM dux_column_stats_ops')
+    conn.close()
+
+    dux_the_file(db_name)
+    assert get_counts(db_name) == incremental_counts
+    assert get_values(db_name) == incremental_values
+
+def test_pending_rows_time_budget(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text)")
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    conn.row_factory = sqlite3.Row
+    prepare_connection(conn, 'not-internal', None)
+    with conn:
+        conn.executemany("INSERT INTO data(title) VALUES (?)", [['title {}'.format(i % 7)] for i in range(250)])
+
+    # Once the budget is spent, we stop after the sub-batch we're on, and have
+    # applied everything we've consumed.
+    assert index_pending_rows(conn, time_budget=0)
+    assert conn.execute('SELECT count(*) FROM dux_pending_rows').fetchone()[0] == 250 - column_stats.PENDING_ROWS_SUB_BATCH_SIZE
+    assert conn.execute("SELECT count FROM dux_column_stats WHERE column_id = (SELECT id FROM dux_ids WHERE name = 'title')").fetchone()[0] == column_stats.PENDING_ROWS_SUB_BATCH_SIZE
+
+    while index_pending_rows(conn, time_budget=0):
+        pass
+    assert conn.execute("SELECT sum(count) FROM dux_column_stats_values").fetchone()[0] == 250
+    conn.close()
+
+def test_bulk_load_is_rebackfilled(tmp_path, monkeypatch):
+    monkeypatch.setattr(column_stats, 'BULK_LOAD_MIN_PENDING', 10)
+
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text)")
+        conn.execute("CREATE TABLE other(id integer primary key, title text)")
+        conn.execute("INSERT INTO data(id, title) VALUES (1, 'a'), (2, 'b')")
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.executemany("INSERT INTO data(id, title) VALUES (?, ?)", [[i, 'title {}'.format(i % 3)] for i in range(3, 20)])
+        conn.execute("INSERT INTO other(id, title) VALUES (1, 'x')")
+    conn.close()
+
+    conn = sqlite3.connect(db_name)
+    prepare_connection(conn, 'not-internal', None)
+    assert rebackfill_bulk_loaded_tables(conn)
+
+    # Only the bulk-loaded table is reset; other tables' changes are still drained.
+    assert conn.execute('SELECT DISTINCT "table" FROM dux_pending_rows').fetchall() == [('other',)]
+    assert conn.execute("SELECT DISTINCT last_key, pending FROM dux_column_stats_ops WHERE table_id = (SELECT id FROM dux_ids WHERE name = 'data')").fetchall() == [('{}', 1)]
+    assert not rebackfill_bulk_loaded_tables(conn)
+    conn.close()
+
+    dux_the_file(db_name)
+    counts = get_counts(db_name)
+    values = get_values(db_name)
+    assert counts[('data', 'title')][0] == 19
+    assert counts[('other', 'title')][0] == 1
+
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute('DELETE FROM dux_column_stats')
+        conn.execute('DELETE FROM dux_column_stats_values')
+        conn.execute('DELETE FROM dux_column_stats_ops')
+    conn.close()
+
+    dux_the_file(db_name)
+    assert get_counts(db_name) == counts
+    assert get_values(db_name) == values
+
+@pytest.mark.asyncio
+async def test_sidecar(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text)")
+        conn.execute("INSERT INTO data(id, title) VALUES (1, 'Foo'), (2, 'Bar')")
+    conn.close()
+
+    # Start without a sidecar, then switch to one.
+    dux_the_file(db_name)
+    dux_the_file(db_name, sidecar=True)
+    assert sidecar_path(db_name) == tmp_path / "db.dux.sqlite"
+
+    conn = sqlite3.connect(db_name)
+    assert [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'dux_%'")] == ['dux_pending_rows']
+    conn.close()
+
+    conn = sqlite3.connect(sidecar_path(db_name))
+    assert conn.execute("SELECT count FROM dux_column_stats_values WHERE value = 'foo'").fetchall() == [(1,)]
+    conn.close()
+
+    datasette = Datasette(files=[db_name], metadata={
+        'plugins': {
+            'datasette-ui-extras': {
+                'sidecar': True
+            }
+        }
+    })
+    await datasette.invoke_startup()
+    db = datasette.get_database('db')
+    await db.execute_write_fn(ensure_empty_rows_for_db)
+    await db.execute_write("INSERT INTO data(id, title) VALUES (3, 'Foo')")
+
+    while await index_db(db):
+        pass
+
+    assert [row[0] for row in await db.execute("SELECT count FROM dux_column_stats_values WHERE value = 'foo'")] == [2]
+    assert [row[0] for row in await db.execute("SELECT count(*) FROM main.dux_pending_rows")] == [0]
+
+@pytest.mark.asyncio
+async def test_bundle(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text)")
+        conn.execute("INSERT INTO data(id, title) VALUES (1, 'Foo'), (2, 'Bar'), (3, 'Foo')")
+    conn.close()
+
+    with open(db_name, 'rb') as f:
+        before = f.read()
+
+    bundle_the_file(db_name)
+
+    # The database itself is untouched.
+    with open(db_name, 'rb') as f:
+        assert f.read() == before
+
+    datasette = Datasette(immutables=[db_name])
+    await datasette.invoke_startup()
+    db = datasette.get_database('db')
+
+    assert [row[0] for row in await db.execute("SELECT count FROM dux_column_stats WHERE column_id = (SELECT id FROM dux_ids WHERE name = 'title')")] == [3]
+
+    def suggest(conn):
+        return autosuggest_column(conn, 'data', 'title', 'fo')
+    assert await db.execute_fn(suggest) == [{'value': 'Foo', 'count': 2, 'pks': [{'id': 1}, {'id': 3}]}]
+
+def test_dux_files_in_parallel(tmp_path):
+    db_names = []
+    for name in ['serial', 'parallel1', 'parallel2']:
+        db_name = tmp_path / "{}.sqlite".format(name)
+        conn = sqlite3.connect(db_name)
+        with conn:
+            conn.execute("CREATE TABLE data(id integer primary key, title text, tags text)")
+            conn.execute("CREATE TABLE other(name text primary key, age integer) WITHOUT ROWID")
+            conn.executemany("INSERT INTO data(id, title, tags) VALUES (?, ?, ?)", [[i, 'title {}'.format(i % 7), '["a", "b{}"]'.format(i % 3)] for i in range(2500)])
+            conn.executemany("INSERT INTO other(name, age) VALUES (?, ?)", [['name {}'.format(i), i] for i in range(1500)])
+        conn.close()
+        db_names.append(db_name)
+
+    dux_the_file(db_names[0])
+    dux_files_in_parallel([str(db_name) for db_name in db_names[1:]], 2)
+
+    for db_name in db_names[1:]:
+        assert get_counts(db_name) == get_counts(db_names[0])
+        assert get_values(db_name) == get_values(db_names[0])
+
+def test_offline_build(tmp_path):
+    db_names = []
+    for name in ['online', 'offline']:
+        db_name = tmp_path / "{}.sqlite".format(name)
+        conn = sqlite3.connect(db_name)
+        with conn:
+            conn.execute("CREATE TABLE data(id integer primary key, title text, tags text)")
+            conn.executemany("INSERT INTO data(id, title, tags) VALUES (?, ?, ?)", [[i, 'title {}'.format(i % 7), '["a", "b{}"]'.format(i % 3)] for i in range(2500)])
+        conn.close()
+        db_names.append(db_name)
+
+    dux_the_file(db_names[0])
+    dux_the_file(db_names[1], offline=True)
+
+    assert get_counts(db_names[1]) == get_counts(db_names[0])
+    assert get_values(db_names[1]) == get_values(db_names[0])
+
+    # The triggers are installed once the build is done.
+    conn = sqlite3.connect(db_names[1])
+    with conn:
+        conn.execute("INSERT INTO data(id, title) VALUES (2500, 'title 0')")
+    conn.close()
+
+    dux_the_file(db_names[1])
+    assert get_counts(db_names[1])[('data', 'title')][0] == 2501
+
+def test_sampled_stats(tmp_path, monkeypatch):
+    monkeypatch.setattr(column_stats, 'SAMPLED_STATS_MIN_ROWS', 1000)
+    monkeypatch.setattr(column_stats, 'SAMPLED_STATS_ROWS', 100)
+
+    db_names = []
+    for name in ['sampled', 'exact']:
+        db_name = tmp_path / "{}.sqlite".format(name)
+        conn = sqlite3.connect(db_name)
+        with conn:
+            conn.execute("CREATE TABLE data(id integer primary key, title text, age integer)")
+            conn.executemany("INSERT INTO data(id, title, age) VALUES (?, ?, ?)", [[i, 'title {}'.format(i % 7), i if i % 2 else None] for i in range(2500)])
+            conn.execute("CREATE TABLE small(id integer primary key, title text)")
+            conn.execute("INSERT INTO small(id, title) VALUES (1, 'a')")
+        conn.close()
+        db_names.append(db_name)
+
+    dux_the_file(db_names[1])
+
+    conn = sqlite3.connect(db_names[0])
+    conn.row_factory = sqlite3.Row
+    prepare_connection(conn, 'not-internal', None)
+    ensure_schema_and_triggers(conn)
+    ensure_empty_rows_for_db(conn)
+    sample_large_tables(conn)
+
+    def get_stats():
+        return {(row[0], row[1]): (row[2], row[3]) for row in conn.execute('SELECT t.name, c.name, count, estimated FROM dux_column_stats s JOIN dux_ids t ON t.id = s.table_id JOIN dux_ids c ON c.id = s.column_id')}
+
+    # Only the big table is estimated; its count is extrapolated from the sample.
+    assert get_stats() == {
+        ('data', 'id'): (2500, 1),
+        ('data', 'title'): (2500, 1),
+        ('data', 'age'): (2500, 1),
+        ('small', 'id'): (0, 0),
+        ('small', 'title'): (0, 0),
+    }
+
+    # A partial backfill leaves the estimates in place...
+    while index_next_backfill_batch(conn):
+        if conn.execute("SELECT pending FROM dux_column_stats_ops ops JOIN dux_ids ids ON ids.id = ops.table_id WHERE ids.name = 'data'").fetchone()[0]:
+            assert get_stats()[('data', 'age')][1] == 1
+
+    # ...until it's complete.
+    conn.close()
+    assert get_counts(db_names[0]) == get_counts(db_names[1])
+
+def test_sampled_stats_pending_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(column_stats, 'SAMPLED_STATS_MIN_ROWS', 1000)
+    monkeypatch.setattr(column_stats, 'SAMPLED_STATS_ROWS', 100)
+    monkeypatch.setattr(column_stats, 'BACKFILL_CHUNK_SIZE', 500)
+
+    db_names = []
+    for name in ['sampled', 'exact']:
+        db_name = tmp_path / "{}.sqlite".format(name)
+        conn = sqlite3.connect(db_name)
+        with conn:
+            conn.execute("CREATE TABLE data(id integer primary key, title text, age integer)")
+            conn.executemany("INSERT INTO data(id, title, age) VALUES (?, ?, ?)", [[i, 'title {}'.format(i % 7), i if i % 2 else None] for i in range(2500)])
+        conn.close()
+        db_names.append(db_name)
+
+    dux_the_file(db_names[1])
+
+    conn = sqlite3.connect(db_names[0])
+    conn.row_factory = sqlite3.Row
+    prepare_connection(conn, 'not-internal', None)
+    ensure_schema_and_triggers(conn)
+    ensure_empty_rows_for_db(conn)
+    sample_large_tables(conn)
+
+    # Scan the first 1,000 rows...
+    index_next_backfill_batch(conn)
+    index_next_backfill_batch(conn)
+    assert [tuple(row) for row in conn.execute("SELECT DISTINCT last_key FROM dux_column_stats_ops")] == [('{"id":999}',)]
+
+    # ...then change rows on both sides of where the backfill has got to.
+    for db_name in db_names:
+        changes = sqlite3.connect(db_name)
+        with changes:
+            changes.execute("UPDATE data SET title = 'changed', age = 1 WHERE id IN (0, 2, 999, 1000, 2000)")
+            changes.execute("DELETE FROM data WHERE id IN (1, 3, 1001)")
+            changes.execute("INSERT INTO data(id, title, age) VALUES (3000, 'new', 3000)")
+        changes.close()
+
+    dux_the_file(db_names[1])
+    index_pending_rows(conn)
+    assert conn.execute("SELECT count(*) FROM dux_column_stats WHERE estimated").fetchone()[0] == 3
+
+    while index_next_backfill_batch(conn):
+        pass
+
+    conn.close()
+    assert get_counts(db_names[0]) == get_counts(db_names[1])
+
+def test_indexing_policy(tmp_path):
+    db_name = tmp_path / "policy.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE posts(id integer primary key, title text, body text, raw text)")
+        conn.executemany("INSERT INTO posts(id, title, body, raw) VALUES (?, ?, ?, ?)", [[i, 'title {}'.format(i % 3), 'body {}'.format(i % 3), 'raw'] for i in range(100)])
+        conn.execute("CREATE TABLE audit(id integer primary key, action text)")
+        conn.execute("INSERT INTO audit(id, action) VALUES (1, 'login')")
+        conn.execute("CREATE TABLE events(id integer primary key, kind text)")
+        conn.executemany("INSERT INTO events(id, kind) VALUES (?, ?)", [[i, 'click'] for i in range(1000)])
+    conn.close()
+
+    policy = {
+        'posts': {
+            'max-length': 5,
+            'columns': {
+                'body': {'values': False},
+                'raw': False,
+            },
+        },
+        'audit': False,
+        'events': {'sample': 0.1},
+    }
+    dux_the_file(db_name, policy=policy)
+
+    conn = sqlite3.connect(db_name)
+    conn.row_factory = sqlite3.Row
+    prepare_connection(conn, 'not-internal', None)
+
+    def get_stats():
+        return {(row[0], row[1]): (row[2], row[3]) for row in conn.execute('SELECT t.name, c.name, count, estimated FROM dux_column_stats s JOIN dux_ids t ON t.id = s.table_id JOIN dux_ids c ON c.id = s.column_id')}
+
+    def get_values():
+        return sorted(set([(row[0], row[1]) for row in conn.execute('SELECT t.name, c.name FROM dux_column_stats_values v JOIN dux_ids t ON t.id = v.table_id JOIN dux_ids c ON c.id = v.column_id')]))
+
+    # Sampled tables get estimated stats from a fraction of their rows.
+    assert get_stats() == {
+        ('posts', 'id'): (100, 0),
+        ('posts', 'title'): (100, 0),
+        ('posts', 'body'): (100, 0),
+        ('events', 'id'): (1000, 1),
+        ('events', 'kind'): (1000, 1),
+    }
+
+    # 'title 0' is too long for the value index.
+    assert get_values() == []
+
+    # Only posts has triggers, and they don't capture raw.
+    triggers = [row[0] for row in conn.execute("SELECT tbl_name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'dux_stats_%'")]
+    assert set(triggers) == {'posts'}
+    with conn:
+        conn.execute("INSERT INTO posts(id, title, body, raw) VALUES (100, 'new', 'new', 'new')")
+    assert 'raw' not in json.loads(conn.execute('SELECT new FROM dux_pending_rows').fetchone()[0])
+    while index_pending_rows(conn):
+        pass
+    assert get_stats()[('posts', 'body')] == (101, 0)
+    assert get_values() == [('posts', 'title')]
+
+    # Changing the policy for a column starts it over.
+    policy['posts']['columns']['body'] = True
+    ensure_empty_rows_for_db(conn, policy)
+    assert get_stats()[('posts', 'body')] == (0, 0)
+    while index_next_backfill_batch(conn):
+        pass
+    assert get_stats()[('posts', 'body')] == (101, 0)
+    assert get_values() == [('posts', 'body'), ('posts', 'title')]
+    conn.close()
+
+@pytest.mark.asyncio
+async def test_startup_skips_reconciled_databases(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text)")
+    conn.close()
+
+    dux_the_file(db_name)
+
+    datasette = Datasette(files=[db_name])
+    await datasette.invoke_startup()
+    assert datasette._dux_reconciled_dbs == {'db'}
+
+    # Changing the schema or the indexing policy means we have to reconcile again.
+    conn = sqlite3.connect(db_name)
+    assert is_schema_reconciled(conn)
+    assert not is_schema_reconciled(conn, {'data': False})
+
+    with conn:
+        conn.execute("ALTER TABLE data ADD COLUMN body text")
+    assert not is_schema_reconciled(conn)
+    conn.close()
+
+    datasette = Datasette(files=[db_name])
+    await datasette.invoke_startup()
+    assert datasette._dux_reconciled_dbs == set()
+
+def test_schema_migrations(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text)")
+        conn.executemany("INSERT INTO data(title) VALUES (?)", [['title {}'.format(i % 3)] for i in range(100)])
+    conn.close()
+
+    dux_the_file(db_name)
+    before = get_counts(db_name)
+    before_values = get_values(db_name)
+
+    # Roll the stats tables back to how they were before we had migrations.
+    conn = sqlite3.connect(db_name)
+    with conn:
+        for table, column in [('dux_column_stats', 'estimated'), ('dux_column_stats_ops', 'partial_stats'), ('dux_column_stats_ops', 'stats'), ('dux_column_stats_ops', 'value_index'), ('dux_column_stats_ops', 'max_length'), ('dux_column_stats_ops', 'trigrams'), ('dux_column_stats_ops', 'key_length'), ('dux_pending_rows', 'format')]:
+            conn.execute('ALTER TABLE {} DROP COLUMN {}'.format(table, column))
+        conn.execute('DROP TABLE dux_table_ops')
+        conn.execute('DROP TABLE dux_meta')
+
+    # Upgrading keeps the stats we have.
+    ensure_schema(conn)
+    assert get_schema_version(conn, 'main') == SCHEMA_VERSION
+    conn.close()
+    assert get_counts(db_name) == before
+    assert get_values(db_name) == before_values
+
+    # A change we have no migration for rebuilds the tables.
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute('ALTER TABLE dux_column_stats_values ADD COLUMN surprise text')
+    ensure_schema(conn)
+    assert conn.execute('SELECT count(*) FROM dux_column_stats_values').fetchone()[0] == 0
+    assert get_schema_version(conn, 'main') == SCHEMA_VERSION
+    conn.close()
+
+def test_autosuggest_uses_display_values(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text, tags text)")
+        conn.execute("""INSERT INTO data(id, title, tags) VALUES (1, 'Foo', '["Fig", "Fog"]'), (2, 'Bar', '["Fig"]'), (3, 'Foo', '[]')""")
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    prepare_connection(conn, 'not-internal', None)
+
+    # Autosuggest doesn't need the rows themselves...
+    with conn:
+        conn.execute('DROP TRIGGER dux_stats_delete_data')
+        conn.execute('DELETE FROM data')
+    assert autosuggest_column(conn, 'data', 'title', 'fo') == [{'value': 'Foo', 'count': 2, 'pks': [{'id': 1}, {'id': 3}]}]
+    assert autosuggest_column(conn, 'data', 'tags', 'f') == [{'value': 'Fig', 'count': 2, 'pks': [{'id': 1}, {'id': 2}]}, {'value': 'Fog', 'count': 1, 'pks': [{'id': 1}]}]
+
+    # ...unless they predate display values.
+    with conn:
+        conn.execute('UPDATE dux_column_stats_values SET display = NULL')
+        conn.execute("INSERT INTO data(id, title) VALUES (1, 'Foo')")
+    assert autosuggest_column(conn, 'data', 'title', 'fo') == [{'value': 'Foo', 'count': 2, 'pks': [{'id': 1}, {'id': 3}]}]
+    assert autosuggest_column(conn, 'data', 'tags', 'f') == []
+    conn.close()
+
+def test_autosuggest_cache(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text, tags text)")
+        conn.executemany("INSERT INTO data(id, title, tags) VALUES (?, ?, ?)", [[i, 'Title {}'.format(i % 50), '["tag {}"]'.format(i % 3)] for i in range(500)])
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    conn.row_factory = sqlite3.Row
+    prepare_connection(conn, 'not-internal', None)
+
+    cache = AutosuggestCache(1024 * 1024)
+    assert cache.suggest('db', 'data', 'title', 'title 1') is None
+
+    # Once loaded, the cache gives the same answers as the value index.
+    cache.load('db', conn, 'data', 'title')
+    for q in ['t', 'title 1', 'TITLE 4', 'title 49', 'nope']:
+        assert cache.suggest('db', 'data', 'title', q) == autosuggest_column(conn, 'data', 'title', q)
+
+    # The indexer's changes are applied as they happen.
+    with conn:
+        conn.execute("INSERT INTO data(id, title) VALUES (1000, 'Title 1x')")
+        conn.execute("DELETE FROM data WHERE title = 'Title 12'")
+    touched = set()
+    while index_pending_rows(conn, touched=touched):
+        pass
+    cache.refresh_values('db', conn, touched)
+    assert cache.suggest('db', 'data', 'title', 'title 1') == autosuggest_column(conn, 'data', 'title', 'title 1')
+    assert [hit['value'] for hit in cache.suggest('db', 'data', 'title', 'title 1x')] == ['Title 1x']
+    assert cache.suggest('db', 'data', 'title', 'title 12') == []
+
+    # Columns are evicted to stay within the budget, least recently used first.
+    cache.load('db', conn, 'data', 'tags')
+    assert cache.suggest('db', 'data', 'tags', 'tag') is not None
+    cache.budget_bytes = cache.columns[('db', 'data', 'tags')]['size'] + 1
+    cache.load('db', conn, 'data', 'id')
+    cache.refresh_values('db', conn, [])
+    assert cache.suggest('db', 'data', 'title', 'title') is None
+    assert cache.suggest('db', 'data', 'tags', 'tag') is not None
+
+    # The indexer checks the stats generation on its read-only connection.
+    data_versions = {}
+    def check_stats_generation():
+        data_version_changed(data_versions, 'db', SimpleNamespace(path=str(db_name)))
+        cache.check_stats_generation('db', get_stats_generation(data_versions['db'][0]))
+    check_stats_generation()
+
+    # Changes to the data, which come back to us through the queue, and changes
+    # to the stats that we made ourselves, leave the cache alone.
+    other = sqlite3.connect(db_name)
+    with other:
+        other.execute("INSERT INTO data(id, title, tags) VALUES (2000, 'Other', '[]')")
+    other.close()
+    note_stats_change(conn, cache, 'db')
+    check_stats_generation()
+    assert cache.suggest('db', 'data', 'tags', 'tag') is not None
+
+    # Changes to the stats made by another process invalidate everything.
+    dux_the_file(db_name)
+    check_stats_generation()
+    assert cache.suggest('db', 'data', 'tags', 'tag') is None
+    close_data_version_connections(data_versions)
+    conn.close()
+
+def test_prefix_tops(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text)")
+        # Lots of rare values that sort before a few common ones.
+        conn.executemany("INSERT INTO data(title) VALUES (?)", [['a{:03}'.format(i)] for i in range(300)])
+        conn.executemany("INSERT INTO data(title) VALUES (?)", [['az {}'.format(i % 3)] for i in range(60)])
+    conn.close()
+
+    dux_the_file(db_name)
+
+    conn = sqlite3.connect(db_name)
+    conn.row_factory = sqlite3.Row
+    prepare_connection(conn, 'not-internal', None)
+
+    def suggest(q):
+        return [(hit['value'], hit['count']) for hit in autosuggest_column(conn, 'data', 'title', q)]
+
+    def expected(q):
+        rows = conn.execute("SELECT display, count FROM dux_column_stats_values WHERE value >= ? AND value < ? || x'ffffffff' ORDER BY count DESC, value, hash LIMIT 10", [q, q]).fetchall()
+        return [tuple(row) for row in rows]
+
+    assert suggest('a')[0:3] == [('az 0', 20), ('az 1', 20), ('az 2', 20)]
+    assert suggest('a') == expected('a')
+
+    # The cache keeps its own top values, so it needn't scan every entry either.
+    cache = AutosuggestCache(1024 * 1024)
+    cache.load('db', conn, 'data', 'title')
+    assert sorted(cache.columns[('db', 'data', 'title')]['tops']) == ['a', 'a0', 'a1', 'a2', 'az']
+    assert cache.suggest('db', 'data', 'title', 'a') == autosuggest_column(conn, 'data', 'title', 'a')
+
+    # The top values are maintained as counts change, including when the most
+    # common values go away.
+    with conn:
+        conn.execute("DELETE FROM data WHERE title IN ('az 0', 'az 1')")
+        conn.executemany("INSERT INTO data(title) VALUES (?)", [['a{:03}'.format(i % 15)] for i in range(45)])
+        conn.executemany("INSERT INTO data(title) VALUES (?)", [['b']] * 5)
+    touched = set()
+    while index_pending_rows(conn, touched=touched):
+        pass
+    cache.refresh_values('db', conn, touched)
+
+    for q in ['a', 'a0', 'az', 'b']:
+        assert suggest(q) == expected(q)
+        assert cache.suggest('db', 'data', 'title', q) == autosuggest_column(conn, 'data', 'title', q)
+    assert suggest('a')[0] == ('az 2', 20)
+
+    # Databases indexed before we kept the top values get them at startup.
+    prefixes = [row[0] for row in conn.execute('SELECT prefix FROM dux_column_stats_prefixes ORDER BY prefix')]
+    with conn:
+        conn.execute('DELETE FROM dux_column_stats_prefixes')
+    ensure_empty_rows_for_db(conn)
+    assert [row[0] for row in conn.execute('SELECT prefix FROM dux_column_stats_prefixes ORDER BY prefix')] == prefixes
+    for q in ['a', 'a0', 'az', 'b']:
+        assert suggest(q) == expected(q)
+    conn.close()
+
+def test_prefix_tops_after_backfill(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text)")
+        conn.executemany("INSERT INTO data(title) VALUES (?)", [['a{:03}'.format(i % 300)] for i in range(2500)])
+    conn.close()
+
+    conn = sqlite3.connect(db_name)
+    conn.row_factory = sqlite3.Row
+    prepare_connection(conn, 'not-internal', None)
+    ensure_schema_and_triggers(conn)
+    ensure_empty_rows_for_db(conn)
+
+    def suggest(q):
+        return [(hit['value'], hit['count']) for hit in autosuggest_column(conn, 'data', 'title', q)]
+
+    def expected(q):
+        rows = conn.execute("SELECT display, count FROM dux_column_stats_values WHERE value >= ? AND value < ? || x'ffffffff' ORDER BY count DESC, value, hash LIMIT 10", [q, q]).fetchall()
+        return [tuple(row) for row in rows]
+
+    def get_tops():
+        return [tuple(row) for row in conn.execute('SELECT prefix, top, floor FROM dux_column_stats_prefixes ORDER BY prefix')]
+
+    # The prefix tops aren't kept up to date while the column is being backfilled,
+    # including for changes to rows it has already scanned.
+    assert index_next_backfill_batch(conn)
+    with conn:
+        conn.executemany("INSERT INTO data(id, title) VALUES (?, ?)", [[-i, 'b'] for i in range(1, 6)])
+    while index_pending_rows(conn):
+        pass
+    assert get_tops() == []
+
+    # They're built when it's done.
+    while index_next_backfill_batch(conn):
+        pass
+    tops = get_tops()
+    assert [top[0] for top in tops] == ['a', 'a0', 'a1', 'a2', 'b']
+    for q in ['a', 'a1', 'b']:
+        assert suggest(q) == expected(q)
+
+    # Counts in the tops can lag behind, but a rebuild would pick the same entries.
+    with conn:
+        conn.executemany("INSERT INTO data(title) VALUES (?)", [['a{:03}'.format(i % 30)] for i in range(100)])
+        conn.execute("DELETE FROM data WHERE title IN ('a005', 'a006')")
+    while index_pending_rows(conn):
+        pass
+    for q in ['a', 'a0', 'a1', 'b']:
+        assert suggest(q) == expected(q)
+
+    def get_entries(tops):
+        return [(prefix, sorted([entry[0:2] for entry in json.loads(top)])) for prefix, top, floor in tops]
+
+    tops = get_tops()
+    with conn:
+        conn.execute('DELETE FROM dux_column_stats_prefixes')
+    ensure_empty_rows_for_db(conn)
+    assert get_entries(get_tops()) == get_entries(tops)
+    conn.close()
+
+def test_trigrams(tmp_path, monkeypatch):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE people(id integer primary key, name text, city text)")
+        conn.executemany("INSERT INTO people(name, city) VALUES (?, ?)", [['John Smith', 'Smithers'], ['John Smith', 'Boston'], ['Jane Smithson', 'Boston'], ['Alice Jones', 'Boston']])
+    conn.close()
+
+    policy = {'people': {'columns': {'name': {'trigrams': True}}}}
+    dux_the_file(db_name, policy=policy)
+
+    conn = sqlite3.connect(db_name)
+    conn.row_factory = sqlite3.Row
+    prepare_connection(conn, 'not-internal', None)
+
+    def suggest(column, q):
+        return [(hit['value'], hit['count']) for hit in autosuggest_column(conn, 'people', column, q)]
+
+    # Columns with trigrams find values that contain the query, most common first.
+    assert suggest('name', 'smith') == [('John Smith', 2), ('Jane Smithson', 1)]
+    assert suggest('name', 'SMITHS') == [('Jane Smithson', 1)]
+    # All of the query's trigrams appear in 'Alice Jones', but not the query itself.
+    assert suggest('name', 'jonesice') == []
+    # Short queries still use prefixes.
+    assert suggest('name', 'jo') == [('John Smith', 2)]
+    # Other columns only match prefixes.
+    assert suggest('city', 'smith') == [('Smithers', 1)]
+    assert suggest('city', 'ston') == []
+
+    # Only the AUTOSUGGEST_WINDOW most common candidates are considered.
+    monkeypatch.setattr(column_stats, 'AUTOSUGGEST_WINDOW', 1)
+    assert suggest('name', 'smith') == [('John Smith', 2)]
+    monkeypatch.undo()
+
+    # The trigrams follow the value index as rows change.
+    with conn:
+        conn.execute("DELETE FROM people WHERE name = 'Jane Smithson'")
+        conn.execute("INSERT INTO people(name, city) VALUES ('Blacksmith', 'Boston')")
+    while index_pending_rows(conn):
+        pass
+
+    assert suggest('name', 'smith') == [('John Smith', 2), ('Blacksmith', 1)]
+    assert conn.execute("SELECT count(*) FROM dux_column_stats_trigrams WHERE value = 'jane smithson'").fetchone()[0] == 0
+
+    # Turning trigrams on builds them from the value index, and turning them off drops them.
+    policy['people']['columns']['city'] = {'trigrams': True}
+    ensure_empty_rows_for_db(conn, policy)
+    assert suggest('city', 'ston') == [('Boston', 3)]
+
+    del policy['people']['columns']['name']
+    ensure_empty_rows_for_db(conn, policy)
+    assert suggest('name', 'smith') == []
+    assert conn.execute("SELECT count(*) FROM dux_column_stats_trigrams WHERE column_id = (SELECT id FROM dux_ids WHERE name = 'name')").fetchone()[0] == 0
+    conn.close()
+
+def test_trigrams_most_common(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE people(id integer primary key, name text)")
+        conn.executemany("INSERT INTO people(name) VALUES (?)", [['Agent Smith {:03}'.format(i)] for i in range(column_stats.AUTOSUGGEST_WINDOW + 50)])
+        conn.executemany("INSERT INTO people(name) VALUES (?)", [['Zed Smith']] * 3)
+        conn.executemany("INSERT INTO people(name) VALUES (?)", [['Zed Smythe']] * 5)
+    conn.close()
+
+    dux_the_file(db_name, policy={'people': {'columns': {'name': {'trigrams': True}}}})
+
+    conn = sqlite3.connect(db_name)
+    conn.row_factory = sqlite3.Row
+    prepare_connection(conn, 'not-internal', None)
+
+    hits = [(hit['value'], hit['count']) for hit in autosuggest_column(conn, 'people', 'name', 'smith')]
+
+    # The most common value sorts after more than AUTOSUGGEST_WINDOW others that match.
+    assert len(hits) == column_stats.AUTOSUGGEST_LIMIT
+    assert hits[0] == ('Zed Smith', 3)
+    assert hits[1] == ('Agent Smith 000', 1)
+    conn.close()
+
+def test_folded_keys(tmp_path):
+    db_name = tmp_path / "db.sqlite"
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.execute("CREATE TABLE data(id integer primary key, title text)")
+        conn.executemany("INSERT INTO data(title) VALUES (?)", [['École primaire'], ['ÉCOLE primaire'], ['ecole secondaire'], ['Über alles']])
+        conn.executemany("INSERT INTO data(title) VALUES (?)", [['a long title, number {}'.format(i)] for i in range(300)])
+    conn.close()
+
+    policy = {'data': {'key-length': 10}}
+    dux_the_file(db_name, policy=policy)
+
+    conn = sqlite3.connect(db_name)
+    conn.row_factory = sqlite3.Row
+    prepare_connection(conn, 'not-internal', None)
+
+    def suggest(q):
+        return sorted([hit['value'] for hit in autosuggest_column(conn, 'data', 'title', q)])
+
+    # Case and accents don't matter.
+    assert suggest('eco') == ['ecole secondaire', 'ÉCOLE primaire', 'École primaire']
+    assert suggest('ÉCOLE P') == ['ÉCOLE primaire', 'École primaire']
+    assert suggest('uber') == ['Über alles']
+
+    # Queries longer than the key length are checked against the whole value.
+    assert suggest('a long title, number 299') == ['a long title, number 299']
+    hits = suggest('a long title, number 29')
+    assert len(hits) == 10 and all([hit.startswith('a long title, number 29') for hit in hits])
+
+    # The cache agrees.
+    cache = AutosuggestCache(1024 * 1024)
+    cache.load('db', conn, 'data', 'title')
+    for q in ['eco', 'ÉCOLE P', 'a long title, number 299']:
+        assert sorted([hit['value'] for hit in cache.suggest('db', 'data', 'title', q)]) == suggest(q)
+
+    # Changing the key length rekeys the values, without losing their counts or
+    # starting over.
+    counts = conn.execute('SELECT display, count FROM dux_column_stats_values ORDER BY display').fetchall()
+    ensure_empty_rows_for_db(conn)
+    assert conn.execute('SELECT max(length(value)) FROM dux_column_stats_values').fetchone()[0] == len('a long title, number 100')
+    assert conn.execute('SELECT display, count FROM dux_column_stats_values ORDER BY display').fetchall() == counts
+    assert conn.execute('SELECT count(*) FROM dux_column_stats_ops WHERE pending').fetchone()[0] == 0
+    assert suggest('ÉCOLE P') == ['ÉCOLE primaire', 'École primaire']
+    assert conn.execute("SELECT prefix FROM dux_column_stats_prefixes WHERE prefix = 'ec'").fetchone()
+
+    # Entries from before we stored display values get them from the table.
+    def get_values():
+        return [tuple(row) for row in conn.execute('SELECT value, hash, count, pks, display FROM dux_column_stats_values ORDER BY value, hash')]
+
+    stats = [tuple(row) for row in conn.execute('SELECT * FROM dux_column_stats')]
+    with conn:
+        conn.execute('UPDATE dux_column_stats_values SET display = NULL')
+    ensure_empty_rows_for_db(conn, policy)
+    assert conn.execute('SELECT display, count FROM dux_column_stats_values ORDER BY display').fetchall() == counts
+    assert conn.execute('SELECT max(length(value)) FROM dux_column_stats_values').fetchone()[0] == 10
+    assert suggest('ÉCOLE P') == ['ÉCOLE primaire', 'École primaire']
+
+    # If they can't, the column keeps its keys, and nothing is reset.
+    with conn:
+        conn.execute("UPDATE dux_column_stats_values SET display = NULL, pks = '[{\"id\":100000}]' WHERE value = 'uber alles'")
+    values = get_values()
+    ensure_empty_rows_for_db(conn)
+    assert get_values() == values
+    assert [tuple(row) for row in conn.execute('SELECT * FROM dux_column_stats')] == stats
+    assert tuple(conn.execute('SELECT key_length, pending FROM dux_column_stats_ops WHERE column_id = (SELECT id FROM dux_ids WHERE name = ?)', ['title']).fetchone()) == (10, 0)
+    assert suggest('ÉCOLE P') == ['ÉCOLE primaire', 'École primaire']
+    conn.close()